@@ -0,0 +1,23 @@
+import os
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+
+@pytest.fixture
+def server_url(monkeypatch):
+    """Runs the Flask server with an empty in-memory database in a thread
+    """
+    import health_db_server
+    from health_db_storage import create_storage
+    monkeypatch.setattr(health_db_server, "storage",
+                        create_storage("memory"))
+    monkeypatch.setattr(health_db_server, "storage_pid", os.getpid())
+    health_db_server.patient_cache.clear()
+    server = make_server("127.0.0.1", 0, health_db_server.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    health_db_server.patient_cache.clear()
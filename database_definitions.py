@@ -1,4 +1,5 @@
 from pymodm import MongoModel, fields
+from pymongo import IndexModel
 
 
 class Patient(MongoModel):
@@ -8,8 +9,57 @@ class Patient(MongoModel):
     The fields are self-descriptive.  It is used for accessing the MongoDB
     database through the PyMODM package.
 
+    In MongoDB, the test results are not stored in the patient document, but
+    in `ResultBucket` documents.  `tests` is filled in from those when a
+    patient is read.  `version` goes up whenever tests are added, so that a
+    change can be noticed without reading the tests.  Older databases
+    have the tests stored in the `tests` list of the patient document, which
+    can be moved into buckets with `health_db_migrate.py`.
+
     """
     name = fields.CharField()
     id = fields.IntegerField(primary_key=True)
     blood_type = fields.CharField()
     tests = fields.ListField()
+    version = fields.IntegerField(blank=True)
+
+    class Meta:
+        indexes = [IndexModel([("blood_type", 1)])]
+
+
+class ResultBucket(MongoModel):
+    """ Database format for a bucket of test results
+
+    The test results of a patient are stored in "buckets", each holding up
+    to `health_db_storage.BUCKET_SIZE` tests, so that no document grows
+    without limit and a patient can be read without all of their tests.
+    New tests go into the patient's one bucket with `open` set, and a full
+    bucket is closed when a new one is opened.  `number` is the time in
+    nanoseconds when the bucket was opened, so reading the buckets in order
+    of `number` gives the tests from oldest to newest.  Buckets made from
+    tests that were stored in the patient document by an older version of
+    the server have negative numbers, so they come before all others.
+    `start` and `end` are the times the first and last tests in the bucket
+    were stored, and an index on (`patient_id`, `start`) finds the buckets
+    holding a patient's tests from a given time.  `names` lists the names of
+    the tests in the bucket so that buckets holding a given test can be found
+    with an index.  `groups` names the groups of tests written to the bucket,
+    so that a batch of tests that is sent again is not stored twice.
+
+    """
+    patient_id = fields.IntegerField()
+    number = fields.IntegerField()
+    count = fields.IntegerField()
+    start = fields.DateTimeField(blank=True)
+    end = fields.DateTimeField(blank=True)
+    tests = fields.ListField()
+    names = fields.ListField()
+    groups = fields.ListField(blank=True)
+    open = fields.BooleanField(blank=True)
+
+    class Meta:
+        indexes = [IndexModel([("patient_id", 1), ("number", 1)]),
+                   IndexModel([("patient_id", 1)], unique=True,
+                              partialFilterExpression={"open": True}),
+                   IndexModel([("patient_id", 1), ("start", 1)]),
+                   IndexModel([("names", 1)])]
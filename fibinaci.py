@@ -4,7 +4,7 @@ import logging
 def fibinaci(input_list):
     next_entry = input_list[-2] + input_list[-1]
     input_list.append(next_entry)
-    logging.info("This iteration is {}".format(input_list))
+    logging.info("Entry {} is {}".format(len(input_list), next_entry))
     if next_entry <= 100:
         fibinaci(input_list)
     else:
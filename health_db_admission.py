@@ -0,0 +1,90 @@
+"""Admission control for the routes of the health database server
+
+When the database slows down, each request takes longer, so more requests
+are in progress at once.  Without a limit they pile up in the server's
+worker threads until every one of them waits for the database and times
+out, and new requests wait behind them.  An `AdmissionLimiter` lets only a
+fixed number of requests work at the same time.  A few more may wait for a
+short time for their turn.  Any request beyond that is refused straight
+away, so the server can answer it with status code 503 and a `Retry-After`
+header.  The requests that are let in then still finish in a reasonable
+time, instead of all requests becoming slow.
+
+The server uses one limiter for the routes that write to the database and
+another for the routes that only read, so that a burst of writes cannot
+stop patients' results from being read, and the other way around.
+
+"""
+import threading
+import time
+
+
+class AdmissionLimiter:
+    """Limits the number of requests in progress and waiting
+
+    Args:
+        max_active (int): largest number of requests let in at the same
+            time, or 0 for no limit
+        max_waiting (int): largest number of requests waiting to be let in
+        wait_timeout (float): seconds a request may wait before it is
+            refused
+
+    """
+    def __init__(self, max_active, max_waiting=0, wait_timeout=1.0):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Lets a request in, waiting for a free place if needed
+
+        Returns:
+            bool: True if the request may go ahead, in which case `release`
+                must be called when it is finished, or False if it is refused
+        """
+        with self._condition:
+            if self.max_active <= 0 or self.active < self.max_active:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            deadline = time.monotonic() + self.wait_timeout
+            try:
+                while self.active >= self.max_active:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        """Marks a request that was let in as finished"""
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        """Returns counts describing the limiter
+
+        Returns:
+            dict: with keys "active", "waiting", "max_active", "max_waiting",
+                "admitted" and "rejected"
+        """
+        with self._condition:
+            return {"active": self.active, "waiting": self.waiting,
+                    "max_active": self.max_active,
+                    "max_waiting": self.max_waiting,
+                    "admitted": self.admitted, "rejected": self.rejected}
@@ -0,0 +1,172 @@
+"""Asynchronous version of the health database server
+
+This module provides the same routes as `health_db_server.py` (`/`,
+`/new_patient`, `/add_test` and `/get_results/<patient_id>`) using Quart, a
+version of Flask in which route functions are `async` coroutines.  While a
+coroutine waits for the database, the event loop handles other requests, so
+one server process can have hundreds of requests in progress at the same
+time instead of one per worker thread.
+
+The input validation and result formatting functions are imported from
+`health_db_server.py` so that both servers behave the same.  Database access
+goes through the asynchronous storage objects of
+`health_db_async_storage.py`.
+
+The server can be run directly, or with an ASGI server such as Hypercorn:
+
+    hypercorn health_db_async_server:app
+
+"""
+import os
+
+from quart import Quart, request
+
+from health_db_async_storage import create_async_storage
+from health_db_cache import PatientCache
+from health_db_logging import configure_logging
+from health_db_server import validate_new_patient, validate_add_test
+from health_db_server import parse_results_query, generate_results
+
+
+# Define variable to contain Quart class for server
+app = Quart(__name__)
+
+# Cache of recently used patient records, see find_patient()
+patient_cache = PatientCache(
+    max_size=int(os.environ.get("HEALTH_DB_CACHE_SIZE", 1000)),
+    ttl=float(os.environ.get("HEALTH_DB_CACHE_TTL", 30)),
+    negative_ttl=float(os.environ.get("HEALTH_DB_CACHE_NEGATIVE_TTL", 1)))
+
+# Asynchronous storage object, created by initialize_server()
+storage = None
+
+
+def initialize_server(backend=None):
+    """Initializes server conditions
+
+    The queued log of `health_db_logging.configure_logging` is set up and
+    the asynchronous storage object is created.  The
+    backend is chosen in the same way as for
+    `health_db_server.initialize_server`, using the HEALTH_DB_BACKEND,
+    HEALTH_DB_MONGODB_URI and HEALTH_DB_SQLITE_PATH environment variables.
+    For the "mongodb" backend, the connection string must be given in
+    HEALTH_DB_MONGODB_URI.
+
+    Note:  This function does not need a unit test.
+
+    Args:
+        backend (str): "mongodb", "sqlite" or "memory", or None to use the
+            HEALTH_DB_BACKEND environment variable
+    """
+    global storage
+    configure_logging("health_db_server.log")
+    if backend is None:
+        backend = os.environ.get("HEALTH_DB_BACKEND", "mongodb")
+    storage = create_async_storage(
+        backend, os.environ.get("HEALTH_DB_MONGODB_URI"),
+        os.environ.get("HEALTH_DB_SQLITE_PATH", "health_db.sqlite"))
+    patient_cache.clear()
+
+
+@app.route("/", methods=["GET"])
+async def status():
+    """Used to indicate that the server is running
+    """
+    return "Server is on"
+
+
+@app.route("/new_patient", methods=["POST"])
+async def new_patient():
+    """Implements /new_patient route, see `health_db_server.new_patient`
+
+    Returns:
+        str, int: message including patient data if successfully added to the
+                  database or error message if not, followed by a status code
+    """
+    in_data = await request.get_json()
+    error_string, status_code = validate_new_patient(in_data)
+    if error_string is not True:
+        return error_string, status_code
+    generation = patient_cache.generation()
+    added_patient = await storage.add_patient(in_data["name"],
+                                              in_data["id"],
+                                              in_data["blood_type"])
+    patient_cache.put(in_data["id"], added_patient, generation,
+                      changed=True)
+    return "Added patient {}".format(added_patient)
+
+
+@app.route("/add_test", methods=["POST"])
+async def add_test():
+    """Implements /add_test route, see `health_db_server.add_test`
+
+    Returns:
+        str, int: message saying test data successfully added to the
+                  database or error message if not, followed by a status code
+    """
+    in_data = await request.get_json()
+    error_string, status_code = validate_add_test(in_data)
+    if error_string is not True:
+        return error_string, status_code
+    was_added = await storage.add_test(in_data["id"], in_data["test_name"],
+                                       in_data["test_result"])
+    patient_cache.invalidate(in_data["id"])
+    if was_added is False:
+        return "Patient ID {} not found in database".format(in_data["id"]), 400
+    return "Added test to patient id {}".format(in_data["id"]), 200
+
+
+async def find_patient(id_no):
+    """Retrieves patient record, using the patient cache when possible
+
+    See `health_db_server.find_patient`.
+
+    Args:
+        id_no (int): id number of patient to be found in database
+
+    Returns:
+        Patient or bool: Patient instance if patient found in database, False
+            if not
+    """
+    patient = patient_cache.get(id_no)
+    if patient is not None:
+        return patient
+    generation = patient_cache.generation()
+    patient = await storage.find_patient(id_no)
+    patient_cache.put(id_no, patient, generation)
+    return patient
+
+
+@app.route("/get_results/<patient_id>", methods=["GET"])
+async def get_results(patient_id):
+    """Implements /get_results route, see `health_db_server.get_results`
+
+    The same `limit`, `offset`, `order` and `test_name` query parameters are
+    supported.
+
+    Args:
+        patient_id (str): the patient id taken from the variable URL
+
+    Returns:
+        str, int: An error message if patient_id was invalid or a results
+        string containing the patient data, plus a status code.
+    """
+    results_query, status_code = parse_results_query(request.args)
+    if status_code != 200:
+        return results_query, status_code
+    try:
+        id_no = int(patient_id)
+    except ValueError:
+        return "Patient id was not a valid integer", 400
+    if results_query is None:
+        patient = await find_patient(id_no)
+    else:
+        patient = await storage.find_patient_tests(id_no, **results_query)
+    if patient is False:
+        return "Patient id of {} does not exist in database".format(id_no), 400
+    return generate_results(patient), 200
+
+
+if __name__ == '__main__':
+    initialize_server()
+    app.run()
@@ -0,0 +1,218 @@
+"""Asynchronous storage backends for the async health database server
+
+The async server in `health_db_async_server.py` must not make calls that
+block while waiting for the database, because a blocked call stops every
+other request being handled by the event loop.  The classes in this module
+have the same methods as those in `health_db_storage.py`, but each method is
+a coroutine that is used with `await`:
+
+* `MotorStorage` uses Motor, the asyncio driver for MongoDB, so that waiting
+  for MongoDB does not block the event loop.
+* `ThreadedStorage` wraps one of the ordinary storage objects, such as the
+  SQLite storage, and runs each of its methods in a worker thread of the
+  event loop's default executor.  SQLite runs inside the server process and
+  answers quickly, so a thread is only needed for the short time of each
+  call.
+
+"""
+import asyncio
+from datetime import datetime
+import functools
+import uuid
+
+import pymongo
+import pymongo.errors
+
+from database_definitions import Patient, ResultBucket
+from health_db_storage import create_storage, bucket_updates, first_version
+from health_db_storage import bucket_tests_pipeline, bucket_requests
+from health_db_storage import requests_to_resend, BUCKET_WRITE_ATTEMPTS
+
+
+def create_async_storage(backend, mongodb_uri=None, sqlite_path=None):
+    """Creates the asynchronous storage object for the given backend name
+
+    Args:
+        backend (str): one of "mongodb", "sqlite" or "memory"
+        mongodb_uri (str): connection string, used by the "mongodb" backend
+        sqlite_path (str): database filename, used by the "sqlite" backend
+
+    Returns:
+        MotorStorage or ThreadedStorage: the storage object
+    """
+    if backend == "mongodb":
+        return MotorStorage(mongodb_uri)
+    return ThreadedStorage(create_storage(backend, mongodb_uri, sqlite_path))
+
+
+class ThreadedStorage:
+    """Runs the methods of an ordinary storage object in worker threads
+
+    Any method of the wrapped storage object can be called on this object,
+    and it returns a coroutine that runs the method in the default executor
+    of the running event loop and gives back its result.
+
+    Args:
+        storage (MongoStorage or SQLiteStorage): the storage object to wrap
+
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def run_in_thread(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, functools.partial(method, *args, **kwargs))
+
+        return run_in_thread
+
+
+class MotorStorage:
+    """Stores patient records in MongoDB using the Motor asyncio driver
+
+    The documents have the same format as those written by
+    `health_db_storage.MongoStorage`, including the `ResultBucket` documents
+    holding the tests, so both servers can share a database.  Documents are
+    converted to and from `Patient` instances with PyMODM's `to_son` and
+    `from_document`, which do not use the database.
+
+    Motor is only imported when this class is used, so the other backends
+    can be used without it being installed.
+
+    Args:
+        connection_string (str): MongoDB connection string, which must
+            include the database name
+
+    """
+    def __init__(self, connection_string):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        self.client = AsyncIOMotorClient(connection_string)
+        database = self.client.get_default_database()
+        self.collection = database[Patient._mongometa.collection_name]
+        self.buckets = database[ResultBucket._mongometa.collection_name]
+        self.indexes_created = False
+
+    async def add_patient(self, patient_name, id_no, blood_type):
+        """Saves a new patient, replacing any patient with the same id
+
+        Returns:
+            Patient: contains the data saved to database
+        """
+        await self.buckets.delete_many({"patient_id": id_no})
+        patient = Patient(name=patient_name, id=id_no, blood_type=blood_type,
+                          version=first_version())
+        await self.collection.replace_one({"_id": id_no}, patient.to_son(),
+                                          upsert=True)
+        return patient
+
+    async def add_patients(self, patient_list):
+        """Adds many patients with a single unordered bulk insert
+
+        Returns:
+            list of int: index in `patient_list` of each patient that was not
+                added because its id already exists
+        """
+        documents = [Patient(name=patient["name"],
+                             id=patient["id"],
+                             blood_type=patient["blood_type"],
+                             version=first_version()).to_son()
+                     for patient in patient_list]
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            duplicates = [error["index"]
+                          for error in err.details["writeErrors"]
+                          if error["code"] == 11000]
+            if len(duplicates) != len(err.details["writeErrors"]):
+                raise
+            return sorted(duplicates)
+        return []
+
+    async def find_patient(self, id_no):
+        """Retrieves the patient document with the given id, and their tests
+
+        Returns:
+            Patient or bool: Patient instance if found, False if not
+        """
+        document = await self.collection.find_one({"_id": id_no},
+                                                  {"tests": 0})
+        if document is None:
+            return False
+        cursor = self.buckets.find({"patient_id": id_no},
+                                   {"_id": 0, "tests": 1}).sort("number", 1)
+        document["tests"] = [test async for bucket in cursor
+                             for test in bucket["tests"]]
+        return Patient.from_document(document)
+
+    async def patient_version(self, id_no):
+        """Returns the version number of a patient, or False if not found
+
+        See `health_db_storage.MongoStorage.patient_version`.
+        """
+        document = await self.collection.find_one({"_id": id_no},
+                                                  {"version": 1})
+        if document is None:
+            return False
+        return document.get("version", 0)
+
+    async def add_test(self, id_no, test_name, test_result):
+        """Appends a test to a patient's open bucket
+
+        See `health_db_storage.MongoStorage.add_tests`.
+
+        Returns:
+            bool: True if the test was added, False if the patient was not
+                found
+        """
+        if not self.indexes_created:
+            await self.buckets.create_indexes(ResultBucket._mongometa.indexes)
+            self.indexes_created = True
+        requests = bucket_requests(bucket_updates(
+            id_no, [(test_name, test_result)], datetime.utcnow(),
+            uuid.uuid4().hex))
+        for attempt in range(BUCKET_WRITE_ATTEMPTS - 1):
+            try:
+                await self.buckets.bulk_write(requests)
+                break
+            except pymongo.errors.BulkWriteError as err:
+                requests = requests_to_resend(requests, err)
+        else:
+            await self.buckets.bulk_write(requests)
+        result = await self.collection.update_one({"_id": id_no},
+                                                  {"$inc": {"version": 1}})
+        if result.matched_count == 0:
+            await self.buckets.delete_many({"patient_id": id_no})
+            return False
+        return True
+
+    async def find_patient_tests(self, id_no, limit=None, offset=0,
+                                 newest_first=False, test_name=None):
+        """Retrieves a patient with only a selection of their test results
+
+        See `health_db_storage.MongoStorage.find_patient_tests`.
+
+        Returns:
+            Patient or bool: Patient instance with the selected tests if
+                found, False if not
+        """
+        document = await self.collection.find_one({"_id": id_no},
+                                                  {"tests": 0})
+        if document is None:
+            return False
+        pipeline = bucket_tests_pipeline(id_no, limit, offset, newest_first,
+                                         test_name)
+        document["tests"] = [selected["tests"] async for selected
+                             in self.buckets.aggregate(pipeline)]
+        return Patient.from_document(document)
+
+    async def delete_patient(self, id_no):
+        """Deletes a patient and their tests
+
+        Returns:
+            None
+        """
+        await self.collection.delete_one({"_id": id_no})
+        await self.buckets.delete_many({"patient_id": id_no})
@@ -0,0 +1,486 @@
+"""Benchmarks for the health database server
+
+This module contains functions that time different parts of the
+health_db_server code so that changes made for performance reasons can be
+checked against the previous way of doing things.  Each benchmark prints a
+small table to the console and returns its measurements so they can also be
+used from other code.
+
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+from database_definitions import Patient
+
+
+def add_test_result_by_save(in_data):
+    """Adds a test to a patient record by reading and re-saving the document
+
+    This is the way `add_test_result` used to work, when the tests were
+    stored in the patient document, kept here so it can be compared against
+    the current atomic update of a result bucket.  The patient document is
+    read from the database, the new test is appended to its `tests` list,
+    and then the whole document is written back to the database.
+
+    Args:
+        in_data (dict):  dictionary containing patient id, test name and result
+
+    Returns:
+        None
+    """
+    patient = Patient.objects.raw({"_id": in_data["id"]}).first()
+    patient.tests.append((in_data["test_name"], in_data["test_result"]))
+    patient.save()
+
+
+def validate_server_input_by_loop(in_data, expected_keys):
+    """Validates input by walking the expected keys on every call
+
+    This is the way `validate_server_input` used to work, kept here so it can
+    be compared against the compiled validators of `health_db_validation`.
+
+    Args:
+        in_data (any type): the input data to a route
+        expected_keys (dict): needed keys and their data types
+
+    Returns:
+        str or bool , int: True, 200 if valid, otherwise an error message
+            and 400
+    """
+    if type(in_data) is not dict:
+        return "The input was not a dictionary.", 400
+    for key in expected_keys:
+        if key not in in_data:
+            return "The key {} is missing from input".format(key), 400
+        if type(in_data[key]) is not expected_keys[key]:
+            return "The key {} has the wrong data type".format(key), 400
+    return True, 200
+
+
+def time_function(function, argument, repeats):
+    """Returns the average time, in milliseconds, to run a function
+
+    Args:
+        function (callable): the function to time
+        argument (any type): the single argument sent to the function
+        repeats (int): the number of times to run the function
+
+    Returns:
+        float: the average time per call in milliseconds
+    """
+    start = time.perf_counter()
+    for i in range(repeats):
+        function(argument)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def benchmark_add_test(history_sizes=(0, 100, 1000, 5000), repeats=20,
+                       patient_id=987654321):
+    """Compares the latency of adding a test as the test history grows
+
+    For each history size, a patient is created in the database with that
+    many tests already stored, and the time needed to add one more test is
+    measured.  For the old read-and-save approach, the tests are stored in
+    the patient document as they used to be.  For the current
+    `add_test_result` function, the patient is added again and the tests are
+    stored in result buckets with the storage object's `add_tests`, as the
+    server would have stored them.  The patient is deleted afterwards.  This
+    benchmark compares two ways of using MongoDB, so the server must be
+    initialized with the "mongodb" storage backend.
+
+    Args:
+        history_sizes (iterable of int): number of tests already stored for
+            the patient before timing begins
+        repeats (int): number of tests to add for each measurement
+        patient_id (int): id used for the temporary benchmark patient
+
+    Returns:
+        list of tuple: (history size, save time in ms, push time in ms)
+    """
+    import health_db_server
+    from health_db_server import add_test_result
+    storage = health_db_server.storage
+    in_data = {"id": patient_id, "test_name": "HDL", "test_result": 100}
+    measurements = []
+    print("{:>10} {:>12} {:>12}".format("tests", "save (ms)", "push (ms)"))
+    for size in history_sizes:
+        Patient(name="Benchmark Patient", id=patient_id, blood_type="O+",
+                tests=[("HDL", 100)] * size).save()
+        save_time = time_function(add_test_result_by_save, in_data, repeats)
+        storage.add_patient("Benchmark Patient", patient_id, "O+")
+        if size > 0:
+            storage.add_tests({patient_id: [("HDL", 100)] * size})
+        push_time = time_function(add_test_result, in_data, repeats)
+        storage.delete_patient(patient_id)
+        measurements.append((size, save_time, push_time))
+        print("{:>10} {:>12.2f} {:>12.2f}".format(size, save_time, push_time))
+    return measurements
+
+
+def benchmark_validation(repeats=200000):
+    """Compares validations per second of the old and compiled validators
+
+    The input of the /add_test route is validated `repeats` times with the
+    old loop that rebuilt its `expected_keys` dictionary on each request, and
+    with the validator that the server compiles once at startup.
+
+    Args:
+        repeats (int): number of validations for each measurement
+
+    Returns:
+        float, float: validations per second for the old loop and for the
+            compiled validator
+    """
+    from health_db_server import validate_add_test
+    in_data = {"id": 201, "test_name": "HDL", "test_result": 160}
+
+    def old_route_validation(in_data):
+        expected_keys = {"id": int, "test_name": str, "test_result": int}
+        return validate_server_input_by_loop(in_data, expected_keys)
+
+    loop_rate = 1000 / time_function(old_route_validation, in_data, repeats)
+    compiled_rate = 1000 / time_function(validate_add_test, in_data, repeats)
+    print("{:>12} {:>16}".format("validator", "validations/s"))
+    print("{:>12} {:>16,.0f}".format("loop", loop_rate))
+    print("{:>12} {:>16,.0f}".format("compiled", compiled_rate))
+    return loop_rate, compiled_rate
+
+
+def benchmark_encoding(number_of_tests=10000, repeats=20):
+    """Compares the time to encode /get_results answers and their size
+
+    A patient with `number_of_tests` tests is encoded `repeats` times as the
+    default text of `generate_results`, as JSON with the standard library
+    `json` module, with `health_db_encoding.encode` (which uses orjson if it
+    is installed), and as MessagePack if msgpack is installed.
+
+    Args:
+        number_of_tests (int): number of tests of the patient
+        repeats (int): number of times each encoding is timed
+
+    Returns:
+        list of tuple: (encoding name, time in ms, size in bytes)
+    """
+    import json
+    import health_db_encoding
+    from health_db_server import generate_results, results_data
+    patient = Patient(name="Benchmark Patient", id=1, blood_type="O+",
+                      tests=[["HDL", 40 + i % 60]
+                             for i in range(number_of_tests)])
+
+    def encode_text(patient):
+        return generate_results(patient).encode("utf-8")
+
+    def encode_stdlib_json(patient):
+        return json.dumps(results_data(patient)).encode("utf-8")
+
+    def encode_json(patient):
+        return health_db_encoding.encode(results_data(patient), "json")
+
+    def encode_msgpack(patient):
+        return health_db_encoding.encode(results_data(patient), "msgpack")
+
+    encoders = [("text", encode_text), ("json (stdlib)", encode_stdlib_json),
+                ("json", encode_json)]
+    if health_db_encoding.msgpack is not None:
+        encoders.append(("msgpack", encode_msgpack))
+    measurements = []
+    print("{:>14} {:>10} {:>12}".format("encoding", "time (ms)", "bytes"))
+    for name, encoder in encoders:
+        encode_time = time_function(encoder, patient, repeats)
+        size = len(encoder(patient))
+        measurements.append((name, encode_time, size))
+        print("{:>14} {:>10.2f} {:>12,}".format(name, encode_time, size))
+    return measurements
+
+
+class SlowStorage:
+    """Local database stand-in that adds a fixed delay to every call
+
+    Each method of the wrapped storage object waits `latency` seconds before
+    running, to act like a database on another computer.  `time.sleep` is
+    used, which blocks the calling thread the same way a network call made
+    with PyMODM does.
+
+    Args:
+        storage (SQLiteStorage): the storage object to wrap
+        latency (float): delay in seconds added to each call
+
+    """
+    def __init__(self, storage, latency):
+        self.storage = storage
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def slow_method(*args, **kwargs):
+            time.sleep(self.latency)
+            return method(*args, **kwargs)
+
+        return slow_method
+
+
+class SlowAsyncStorage(SlowStorage):
+    """Asynchronous version of `SlowStorage` for the async server
+
+    `asyncio.sleep` is used for the delay, which lets the event loop handle
+    other requests while waiting, the same way an asyncio database driver
+    does.
+    """
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def slow_method(*args, **kwargs):
+            await asyncio.sleep(self.latency)
+            return method(*args, **kwargs)
+
+        return slow_method
+
+
+def benchmark_async_server(number_of_requests=400, latency=0.02,
+                           flask_workers=8, async_concurrency=200):
+    """Compares throughput of the Flask and async servers when the database
+    is slow
+
+    Both servers use an in-memory SQLite database wrapped so that every call
+    takes an extra `latency` seconds.  `number_of_requests` requests for
+    /get_results are then sent to each server.  The Flask server handles
+    them with `flask_workers` threads, as a threaded WSGI server would.  The
+    async server is sent up to `async_concurrency` requests at once.  The
+    patient cache is turned off so every request reaches the database.  This
+    replaces the storage object of both server modules until it returns, so
+    it should not be run in a process that is also serving real requests.
+
+    Args:
+        number_of_requests (int): number of requests sent to each server
+        latency (float): delay in seconds added to each database call
+        flask_workers (int): number of threads handling Flask requests
+        async_concurrency (int): most requests in progress at once for the
+            async server
+
+    Returns:
+        float, float: requests per second for the Flask and async servers
+    """
+    import health_db_server
+    import health_db_async_server
+    from health_db_storage import create_storage
+    storage = create_storage("memory")
+    storage.add_patient("Benchmark Patient", 1, "O+")
+    storage.add_test(1, "HDL", 100)
+    url = "/get_results/1"
+
+    saved = (health_db_server.storage, health_db_server.storage_pid,
+             health_db_server.patient_cache.max_size,
+             health_db_async_server.storage,
+             health_db_async_server.patient_cache.max_size)
+    try:
+        health_db_server.storage = SlowStorage(storage, latency)
+        health_db_server.storage_pid = os.getpid()
+        health_db_server.patient_cache.max_size = 0
+
+        def flask_request(index):
+            return health_db_server.app.test_client().get(url).status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=flask_workers) as executor:
+            list(executor.map(flask_request, range(number_of_requests)))
+        flask_rate = number_of_requests / (time.perf_counter() - start)
+
+        health_db_async_server.storage = SlowAsyncStorage(storage, latency)
+        health_db_async_server.patient_cache.max_size = 0
+
+        async def send_async_requests():
+            client = health_db_async_server.app.test_client()
+            limit = asyncio.Semaphore(async_concurrency)
+
+            async def async_request():
+                async with limit:
+                    response = await client.get(url)
+                    return response.status_code
+
+            await asyncio.gather(*[async_request()
+                                   for i in range(number_of_requests)])
+
+        start = time.perf_counter()
+        asyncio.run(send_async_requests())
+        async_rate = number_of_requests / (time.perf_counter() - start)
+    finally:
+        (health_db_server.storage, health_db_server.storage_pid,
+         health_db_server.patient_cache.max_size,
+         health_db_async_server.storage,
+         health_db_async_server.patient_cache.max_size) = saved
+        health_db_server.patient_cache.clear()
+        health_db_async_server.patient_cache.clear()
+
+    print("{:>8} {:>14}".format("server", "requests/s"))
+    print("{:>8} {:>14.1f}".format("flask", flask_rate))
+    print("{:>8} {:>14.1f}".format("async", async_rate))
+    return flask_rate, async_rate
+
+
+def benchmark_logging(number_of_requests=2000, debug_sample=10):
+    """Compares request latency with logging off, written directly to the
+    log file, and queued
+
+    `number_of_requests` requests for /get_results are sent to the Flask
+    server one after another with each of these log setups:
+
+    * "off":  only WARNING and above are logged, so the DEBUG line written
+      for each request is skipped.
+    * "direct":  DEBUG records are written to the file by the request thread,
+      as `logging.basicConfig` does.
+    * "queued":  DEBUG records are written by the background thread of
+      `health_db_logging.QueuedLogging`.
+    * "sampled":  the same, keeping one in `debug_sample` DEBUG records.
+
+    The log files are written to a temporary folder, and the root logger is
+    put back as it was afterwards, even if a request fails.  Queued logging
+    set up by `configure_logging` has to be stopped while the setups are
+    timed, and is set up again with the same file.
+
+    Args:
+        number_of_requests (int): number of requests sent for each setup
+        debug_sample (int): sampling used for the "sampled" setup
+
+    Returns:
+        list of tuple: (setup name, mean latency in ms, p99 latency in ms)
+    """
+    import logging
+    import tempfile
+    import health_db_logging
+    import health_db_server
+    from health_db_loadtest import percentile
+    from health_db_logging import QueuedLogging, configure_logging
+    from health_db_logging import stop_logging
+    from health_db_storage import create_storage
+    storage = create_storage("memory")
+    storage.add_patient("Benchmark Patient", 1, "O+")
+    storage.add_tests({1: [("HDL", 100)] * 100})
+    original_storage = health_db_server.storage
+    original_pid = health_db_server.storage_pid
+    root = logging.getLogger()
+    original_level = root.level
+    original_logging = health_db_logging.active_logging
+    stop_logging()
+    original_handlers = list(root.handlers)
+    for handler in original_handlers:
+        root.removeHandler(handler)
+    health_db_server.storage = storage
+    health_db_server.storage_pid = os.getpid()
+    client = health_db_server.app.test_client()
+
+    def time_requests():
+        latencies = []
+        for i in range(number_of_requests):
+            start = time.perf_counter()
+            client.get("/get_results/1")
+            latencies.append(time.perf_counter() - start)
+        return sorted(latencies)
+
+    measurements = []
+    print("{:>8} {:>10} {:>10}".format("logging", "mean (ms)", "p99 (ms)"))
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            setups = ["off", "direct", "queued", "sampled"]
+            for name in setups:
+                filename = os.path.join(folder, name + ".log")
+                queued = None
+                direct = None
+                if name == "off":
+                    root.setLevel(logging.WARNING)
+                elif name == "direct":
+                    direct = logging.FileHandler(filename)
+                    root.addHandler(direct)
+                    root.setLevel(logging.DEBUG)
+                else:
+                    queued = QueuedLogging(
+                        filename, level=logging.DEBUG,
+                        debug_sample=debug_sample if name == "sampled" else 1)
+                    queued.start()
+                try:
+                    latencies = time_requests()
+                finally:
+                    if direct is not None:
+                        root.removeHandler(direct)
+                        direct.close()
+                    if queued is not None:
+                        queued.stop()
+                mean = sum(latencies) / len(latencies) * 1000
+                p99 = percentile(latencies, 0.99) * 1000
+                measurements.append((name, mean, p99))
+                print("{:>8} {:>10.3f} {:>10.3f}".format(name, mean, p99))
+    finally:
+        root.setLevel(original_level)
+        for handler in original_handlers:
+            root.addHandler(handler)
+        if original_logging is not None:
+            configure_logging(original_logging.filename,
+                              on_drop=original_logging.handler.on_drop,
+                              on_skip=original_logging.sampler.on_skip)
+        health_db_server.storage = original_storage
+        health_db_server.storage_pid = original_pid
+    return measurements
+
+
+def benchmark_image_loading(size=(4000, 3000), box=(400, 300), repeats=5):
+    """Compares the time to load a large photo for the GUI
+
+    A JPEG file of the given size is written to a temporary folder and then
+    loaded `repeats` times in each of these ways:
+
+    * "full decode":  every pixel is decoded and the image is then shrunk by
+      50%, as `health_db_gui.load_and_resize_image` used to do.
+    * "draft + fit":  `health_db_images.decode_image`, which decodes the
+      JPEG at a reduced scale and fits it in `box`.
+    * "cached":  `health_db_images.ImageCache.get`, which after the first
+      call returns the image it kept.
+
+    Args:
+        size (tuple of int): (width, height) of the photo
+        box (tuple of int): (width, height) the image is fitted in
+        repeats (int): number of times each way is timed
+
+    Returns:
+        list of tuple: (method name, time in ms)
+    """
+    import os
+    import tempfile
+    from PIL import Image
+    from health_db_images import ImageCache, decode_image
+
+    def full_decode(filename):
+        pil_image = Image.open(filename)
+        return pil_image.resize((round(pil_image.size[0] * 0.5),
+                                 round(pil_image.size[1] * 0.5)))
+
+    cache = ImageCache()
+    methods = [("full decode", full_decode),
+               ("draft + fit", lambda filename: decode_image(filename, box)),
+               ("cached", lambda filename: cache.get(filename, box))]
+    measurements = []
+    print("{:>12} {:>10}".format("method", "time (ms)"))
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "photo.jpeg")
+        gradient = Image.linear_gradient("L").resize(size)
+        Image.merge("RGB", (gradient, gradient.rotate(90),
+                            gradient.transpose(Image.FLIP_LEFT_RIGHT))
+                    ).save(filename, quality=90)
+        for name, method in methods:
+            load_time = time_function(method, filename, repeats)
+            measurements.append((name, load_time))
+            print("{:>12} {:>10.2f}".format(name, load_time))
+    return measurements
+
+
+if __name__ == '__main__':
+    from health_db_server import initialize_server
+    benchmark_validation()
+    benchmark_encoding()
+    benchmark_async_server()
+    benchmark_logging()
+    benchmark_image_loading()
+    initialize_server("mongodb")
+    benchmark_add_test()
@@ -0,0 +1,190 @@
+"""In-process cache of patient records for the health database server
+
+The `PatientCache` class keeps recently used patient records in memory so
+that the server does not need to go to the database every time the same
+patient is looked up.  It is used by `health_db_server.find_patient`.
+
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+# Smallest number of recent changes remembered by a PatientCache, see
+# PatientCache._record_change()
+MAX_CHANGES = 10000
+
+
+class PatientCache:
+    """Least-recently-used cache of patient records with a time limit
+
+    Records are stored by patient id.  When the cache holds `max_size`
+    records and a new one is added, the record that was used least recently
+    is removed.  A record older than `ttl` seconds is treated as missing so
+    that changes made by other server processes are eventually seen.
+
+    The value stored for an id can be a Patient or False.  Storing False
+    ("negative caching") remembers that an id is not in the database, so
+    repeated requests for an unknown id do not each go to the database.  This
+    is why `get` returns None, not False, when nothing is stored for an id.
+    False is only kept for `negative_ttl` seconds, which is much shorter than
+    `ttl`, so that a patient added by another server process is soon seen.
+
+    The functions that change the database are responsible for calling `put`
+    or `invalidate` so that the cache does not return out-of-date records.
+
+    A record read from the database can be out of date by the time it is
+    stored, if the patient was changed and invalidated while it was being
+    read.  To stop such a record from being stored, a reader takes a number
+    from `generation` before reading and passes it to `put`.  The cache
+    remembers the generation at which each id was last changed, and `put`
+    does not store a record for an id that was changed after the reader's
+    number was taken.  `invalidate` and a `put` with `changed=True`, made
+    by a function that has just written the record, count as changes, so a
+    record read before a newer one was written cannot replace it.  Ordinary
+    read-through `put` calls are not changes, so readers of the same
+    patient do not stop each other's records from being stored.
+
+    A lock is used so that the cache can be shared by the threads of the
+    Flask server.
+
+    Args:
+        max_size (int): largest number of records to keep.  A size of 0
+            turns the cache off.
+        ttl (float): number of seconds a record may be used for
+        negative_ttl (float): number of seconds False may be used for
+
+    """
+    def __init__(self, max_size=1000, ttl=30.0, negative_ttl=1.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._changes = OrderedDict()
+        self._oldest_change = 0
+        self._lock = threading.Lock()
+
+    def get(self, id_no):
+        """Returns the cached record for a patient id
+
+        Args:
+            id_no (int): patient id
+
+        Returns:
+            Patient, bool, or None: the cached Patient, False if the id is
+                cached as not being in the database, or None if the id is not
+                in the cache or its record has expired
+        """
+        with self._lock:
+            entry = self._entries.get(id_no)
+            if entry is None or time.monotonic() > entry[1]:
+                if entry is not None:
+                    del self._entries[id_no]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(id_no)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self):
+        """Returns the number to pass to `put` for a record about to be read
+        from the database
+
+        Returns:
+            int: the current generation of the cache
+        """
+        with self._lock:
+            return self._generation
+
+    def put(self, id_no, patient, generation=None, changed=False):
+        """Stores a record for a patient id
+
+        If `generation` is given and the id was changed since that
+        generation was taken, the record may be out of date, so it is not
+        stored.  A record stored since then is newer, so it is kept, unless
+        this record was just written (`changed`), in which case it is not
+        known which one is newer and it is removed.
+
+        Args:
+            id_no (int): patient id
+            patient (Patient or bool): the patient record, or False if the
+                patient is not in the database
+            generation (int): value of `generation()` taken before the
+                record was read or written, or None to store the record in
+                any case
+            changed (bool): True if the record was just written to the
+                database, False if it was only read
+
+        Returns:
+            bool: True if the record was stored
+        """
+        with self._lock:
+            stale = (generation is not None and
+                     self._changes.get(id_no, self._oldest_change)
+                     > generation)
+            if changed:
+                self._record_change(id_no)
+            if stale and changed:
+                self._entries.pop(id_no, None)
+            if stale or self.max_size <= 0:
+                return False
+            ttl = self.ttl if patient is not False else self.negative_ttl
+            self._entries[id_no] = (patient, time.monotonic() + ttl)
+            self._entries.move_to_end(id_no)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate(self, id_no):
+        """Removes any record stored for a patient id
+
+        Args:
+            id_no (int): patient id
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._record_change(id_no)
+            self._entries.pop(id_no, None)
+
+    def _record_change(self, id_no):
+        """Remembers the generation at which a patient id was changed
+
+        Only the most recent changes are remembered.  When an older one is
+        forgotten, its generation is kept in `_oldest_change` and used for
+        every id that is not remembered, which can only make `put` refuse a
+        record it could have stored.  The lock must be held.
+        """
+        self._generation += 1
+        self._changes[id_no] = self._generation
+        self._changes.move_to_end(id_no)
+        while len(self._changes) > max(self.max_size, MAX_CHANGES):
+            old_id, self._oldest_change = self._changes.popitem(last=False)
+
+    def clear(self):
+        """Removes all records and resets the hit and miss counters
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._changes.clear()
+            self._oldest_change = self._generation
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the current size and hit/miss counts of the cache
+
+        Returns:
+            dict: with keys "size", "max_size", "hits" and "misses"
+        """
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses}
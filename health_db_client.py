@@ -4,8 +4,208 @@ can call some of these function to interact with the server.  A new function
 called "main" can be used so this file can still be run independently to test
 the server.
 
+Requests are sent with a `HealthDbClient`, which keeps its connections to
+the server open between requests instead of opening a new one each time.
+The address of the server is taken from the HEALTH_DB_SERVER_URL environment
+variable, or is "http://127.0.0.1:5000" if that is not set.
+
+If the HEALTH_DB_CLIENT_SPOOL environment variable names a folder,
+`add_patient_to_server` does not wait for the server.  The patient is saved
+in a journal in that folder and sent later by a background thread, see
+`health_db_spool.py`.
+
 """
+import atexit
+import os
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_SERVER_URL = "http://127.0.0.1:5000"
+
+
+class HealthDbClient:
+    """Sends requests to the health database server
+
+    A `requests.Session` is used for all requests, so the TCP connection to
+    the server is kept open ("keep-alive") and reused by the next request
+    instead of being set up again for every call.  Up to `pool_size`
+    connections are kept, so that the same client can be used by several
+    threads at once.
+
+    Every request has a timeout, so a call cannot wait forever for a server
+    that does not answer.  Requests that did not reach the server because the
+    connection could not be made are tried again for every route.  GET
+    requests are also tried again if the connection fails part way through
+    or the server answers 502, 503 or 504, waiting `backoff_factor` seconds,
+    then twice as long, and so on, between tries, or as long as a
+    `Retry-After` header asks.  POST requests are not tried again in those
+    cases, since the server may already have stored the data and sending it
+    again would add it twice.
+
+    Args:
+        base_url (str): address of the server, or None to use the
+            HEALTH_DB_SERVER_URL environment variable
+        timeout (float or tuple): seconds to wait to connect and for an
+            answer, or a (connect, read) tuple
+        retries (int): largest number of times a request is tried again
+        backoff_factor (float): seconds to wait before the first retry
+        pool_size (int): number of connections kept open
+
+    """
+    def __init__(self, base_url=None, timeout=(3.05, 10), retries=3,
+                 backoff_factor=0.2, pool_size=10):
+        if base_url is None:
+            base_url = os.environ.get("HEALTH_DB_SERVER_URL",
+                                      DEFAULT_SERVER_URL)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["GET", "HEAD"]),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, path, params=None):
+        """Sends a GET request to a route of the server
+
+        Args:
+            path (str): route, such as "/get_results/201"
+            params (dict): query parameters
+
+        Returns:
+            requests.Response: the answer of the server
+        """
+        return self.session.get(self.base_url + path, params=params,
+                                timeout=self.timeout)
+
+    def post(self, path, in_data):
+        """Sends a POST request with JSON input to a route of the server
+
+        Args:
+            path (str): route, such as "/new_patient"
+            in_data (any type): data sent as JSON
+
+        Returns:
+            requests.Response: the answer of the server
+        """
+        return self.session.post(self.base_url + path, json=in_data,
+                                 timeout=self.timeout)
+
+    def status(self):
+        return self.get("/")
+
+    def ready(self):
+        return self.get("/ready")
+
+    def new_patient(self, name, id_no, blood_type):
+        return self.post("/new_patient", {"name": name, "id": id_no,
+                                          "blood_type": blood_type})
+
+    def new_patients(self, patient_list):
+        """`patient_list` is a list of /new_patient input dictionaries"""
+        return self.post("/new_patients", patient_list)
+
+    def add_test(self, id_no, test_name, test_result):
+        return self.post("/add_test", {"id": id_no, "test_name": test_name,
+                                       "test_result": test_result})
+
+    def add_tests(self, test_list):
+        """`test_list` is a list of /add_test input dictionaries"""
+        return self.post("/add_tests", test_list)
+
+    def get_results(self, patient_id, **query):
+        """`query` holds optional query parameters such as `limit=10`"""
+        return self.get("/get_results/{}".format(patient_id), query or None)
+
+    def blood_type_stats(self):
+        return self.get("/stats/blood_types")
+
+    def result_stats(self, **query):
+        """`query` holds optional query parameters such as `test_name="HDL"`
+        """
+        return self.get("/stats/tests", query or None)
+
+    def close(self):
+        """Closes the connections kept open"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def failed_records(kind, batch, answer):
+    """Finds the records of a batch that the server did not store
+
+    Args:
+        kind (str): "patients" or "tests"
+        batch (list of dict): the records sent
+        answer (list or dict): the JSON answer of /new_patients or /add_tests
+
+    Returns:
+        list of tuple: (record, message) for each record not stored
+    """
+    if kind == "patients":
+        return [(record, result.get("message", result["status"]))
+                for record, result in zip(batch, answer)
+                if result["status"] != "added"]
+    failures = [(batch[error["index"]], error["message"])
+                for error in answer["errors"]]
+    unknown_ids = set(answer["unknown_ids"])
+    failures.extend((record, "Unknown patient id {}".format(record["id"]))
+                    for record in batch if record.get("id") in unknown_ids)
+    return failures
+
+
+# Client used by add_patient_to_server(), created when it is first needed
+default_client = None
+
+# Spool used by add_patient_to_server() if HEALTH_DB_CLIENT_SPOOL is set
+default_spool = None
+
+
+def get_default_client():
+    """Returns the client shared by the functions of this module
+
+    Returns:
+        HealthDbClient: the client, created on the first call
+    """
+    global default_client
+    if default_client is None:
+        default_client = HealthDbClient()
+    return default_client
+
+
+def get_default_spool():
+    """Returns the spool used by `add_patient_to_server`, if any
+
+    The spool is made on the first call if the HEALTH_DB_CLIENT_SPOOL
+    environment variable names a folder.  It is closed when the program
+    exits, which waits a few seconds for the writes still in the journal to
+    be sent.  Writes that could not be sent are kept in the journal and sent
+    the next time the program runs.
+
+    Returns:
+        health_db_spool.WriteSpool or None: the spool, or None if the
+            variable is not set
+    """
+    global default_spool
+    folder = os.environ.get("HEALTH_DB_CLIENT_SPOOL")
+    if default_spool is None and folder:
+        from health_db_spool import WriteSpool
+        default_spool = WriteSpool(get_default_client(), folder)
+        atexit.register(default_spool.close)
+    return default_spool
 
 
 def add_patient_to_server(name_input, id_input, blood_type_input):
@@ -14,7 +214,12 @@ def add_patient_to_server(name_input, id_input, blood_type_input):
     This function takes patient information as parameter inputs and makes
     a post request to the health database server to store this patient
     information on the server.  It prints the server response to the
-    console as well as returns it to the caller.
+    console as well as returns it to the caller.  The request is sent with
+    the client from `get_default_client`, so calls reuse the same connection.
+
+    If a spool is set up (see `get_default_spool`), the patient is put in
+    the spool's journal instead and a message saying so is returned straight
+    away, without waiting for the server.
 
     Args:
         name_input (str): patient name
@@ -24,9 +229,17 @@ def add_patient_to_server(name_input, id_input, blood_type_input):
     Returns:
         str: server response string
     """
-    patient1 = {"name": name_input, "id": convert_id_to_int(id_input),
-                "blood_type": blood_type_input}
-    r = requests.post("http://127.0.0.1:5000/new_patient", json=patient1)
+    spool = get_default_spool()
+    if spool is not None:
+        spool.add_patient(name_input, convert_id_to_int(id_input),
+                          blood_type_input)
+        answer = "Patient {} saved, it will be sent to the server".format(
+            id_input)
+        print(answer)
+        return answer
+    r = get_default_client().new_patient(name_input,
+                                         convert_id_to_int(id_input),
+                                         blood_type_input)
     print(r.status_code)
     print(r.text)
     return r.text
@@ -38,6 +251,8 @@ def convert_id_to_int(id_input):
 
 
 def main():
+    client = get_default_client()
+
     # Successfully add patient
     add_patient_to_server("Ann Ables", "201", "A+")
 
@@ -46,39 +261,37 @@ def main():
 
     # Check for missing key
     patient3 = {"name": "Chris Cooper", "id": 202}
-    r = requests.post("http://127.0.0.1:5000/new_patient", json=patient3)
+    r = client.post("/new_patient", patient3)
     print(r.status_code)
     print(r.text)
 
     # Check for bad data type
     patient3 = {"name": "Chris Cooper", "id": "202", "blood_type": "AB+"}
-    r = requests.post("http://127.0.0.1:5000/new_patient", json=patient3)
+    r = client.post("/new_patient", patient3)
     print(r.status_code)
     print(r.text)
 
     # Successfully add test data
-    test1 = {"id": 201, "test_name": "HDL", "test_result": 160}
-    r = requests.post("http://127.0.0.1:5000/add_test", json=test1)
+    r = client.add_test(201, "HDL", 160)
     print(r.status_code)
     print(r.text)
 
     # Check if patient does not exist
-    test2 = {"id": 205, "test_name": "HDL", "test_result": 160}
-    r = requests.post("http://127.0.0.1:5000/add_test", json=test2)
+    r = client.add_test(205, "HDL", 160)
     print(r.status_code)
     print(r.text)
 
     # Successful Get Results
-    r = requests.get("http://127.0.0.1:5000/get_results/201")
+    r = client.get_results(201)
     print(r.status_code)
     print(r.text)
 
     # Bad Get Results
-    r = requests.get("http://127.0.0.1:5000/get_results/205")
+    r = client.get_results(205)
     print(r.status_code)
     print(r.text)
 
-    r = requests.get("http://127.0.0.1:5000/get_results/abc")
+    r = client.get_results("abc")
     print(r.status_code)
     print(r.text)
 
@@ -0,0 +1,101 @@
+"""Encoding of structured responses for the health database server
+
+Routes of the server answer with a plain text message by default.  A client
+program can instead ask for the same information as structured data, which
+it can use without having to parse the text:
+
+* JSON (`application/json`), encoded with orjson if it is installed, which
+  is several times faster than the `json` module of the standard library,
+  and otherwise with `json` without any extra spaces.
+* MessagePack (`application/msgpack`), a binary format like JSON that is
+  smaller and faster to encode and decode.  It is only offered if the
+  msgpack package is installed.
+
+The client chooses with the `Accept` header of the request or with the
+`format` query parameter (`text`, `json` or `msgpack`), see
+`choose_encoding`.
+
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Content type of each encoding
+MIMETYPES = {"text": "text/plain",
+             "json": "application/json",
+             "msgpack": "application/msgpack",
+             "ndjson": "application/x-ndjson"}
+
+
+def available_encodings():
+    """Returns the names of the encodings that can be used
+
+    Returns:
+        list of str: "text" first, since it is the default, followed by the
+            structured encodings whose packages are installed
+    """
+    encodings = ["text", "json", "ndjson"]
+    if msgpack is not None:
+        encodings.append("msgpack")
+    return encodings
+
+
+def choose_encoding(accept_mimetypes, format_name=None,
+                    allowed=("text", "json", "msgpack")):
+    """Chooses the encoding of a response
+
+    The `format` query parameter is used if it names an allowed encoding.
+    Otherwise, the best match for the `Accept` header is used.  Text is
+    chosen if the header accepts anything (`*/*`, as sent by browsers) or
+    if nothing else matches.  "application/x-msgpack" is also accepted for
+    MessagePack, since some clients use that name.
+
+    Args:
+        accept_mimetypes (werkzeug.datastructures.MIMEAccept): the parsed
+            `Accept` header, such as `request.accept_mimetypes`
+        format_name (str): value of the `format` query parameter, or None
+        allowed (tuple of str): the encodings the route can give
+
+    Returns:
+        str: "text", "json", "msgpack" or "ndjson"
+    """
+    encodings = [name for name in available_encodings() if name in allowed]
+    if format_name in encodings:
+        return format_name
+    offered = [MIMETYPES[name] for name in encodings]
+    if "msgpack" in encodings:
+        offered.append("application/x-msgpack")
+    best = accept_mimetypes.best_match(offered, default="text/plain")
+    if best == "application/x-msgpack":
+        return "msgpack"
+    for name in encodings:
+        if MIMETYPES[name] == best:
+            return name
+    return "text"
+
+
+def encode(data, encoding):
+    """Encodes structured data as JSON or MessagePack
+
+    Args:
+        data (dict or list): the data, made of dictionaries, lists, strings,
+            numbers, booleans and None
+        encoding (str): "json" or "msgpack"
+
+    Returns:
+        bytes: the encoded data
+    """
+    if encoding == "msgpack":
+        return msgpack.packb(data)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
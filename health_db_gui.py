@@ -1,23 +1,32 @@
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
+from PIL import ImageTk
 
 from health_db_client import add_patient_to_server
+from health_db_gui_tasks import TaskRunner
+from health_db_images import ImageCache
+
+
+# Images are resized to fit in a box of this (width, height)
+IMAGE_BOX = (400, 300)
+
+# Recently shown images, already resized, see health_db_images.py
+image_cache = ImageCache()
 
 
 def load_and_resize_image(filename):
     """ Creates a tkinter image variable that can be displayed on GUI
 
     This function receives a filename as a parameter.  This should be the
-    name of a file containing a digital image.  The file is first open
-    and stored as a Pillow image file.  It uses the Image.size property and
-    Image.resize() method to decrease the image size by 50%.  It then
-    converts the Pillow image to a tk image.
+    name of a file containing a digital image.  The image is resized to fit
+    in IMAGE_BOX, keeping its aspect ratio, by `image_cache`, which only
+    decodes the file if it was not shown recently, and decodes JPEG files
+    at a reduced scale.  It then converts the Pillow image to a tk image.
 
-    Note, while this code is written to decrease the size by 50%, a better
-    approach may be to determine the aspect ratio of the picture and then
-    adjust its size up or down to reach a default size.
+    The tk image must be made in the GUI thread, so when the file may be
+    slow to read, call `image_cache.get` in a worker thread first, as
+    `change_picture_cmd` does, and then this function finds it in the cache.
 
     Args:
         filename (str): the name of the file containing an image to be loaded
@@ -27,14 +36,7 @@ def load_and_resize_image(filename):
 
 
     """
-    pil_image = Image.open(filename)
-    original_size = pil_image.size
-    adj_factor = 0.5
-    new_width = round(original_size[0] * adj_factor)
-    new_height = round(original_size[1] * adj_factor)
-    resized_image = pil_image.resize((new_width, new_height))
-    tk_image = ImageTk.PhotoImage(resized_image)
-    return tk_image
+    return ImageTk.PhotoImage(image_cache.get(filename, IMAGE_BOX))
 
 
 def create_output(name, id, blood_letter, rh_factor, center):
@@ -76,6 +78,11 @@ def design_window():
     Ok button, this information is sent to the server.  Upon hitting the
     Cancel button, the window closes.
 
+    The request to the server is sent by a `TaskRunner` in a worker thread,
+    so the window keeps responding while it waits for the answer.  A moving
+    progress bar is shown and the Ok button is disabled until the answer
+    arrives.  Closing the window cancels the requests not yet sent.
+
     Returns: None
 
     """
@@ -91,6 +98,10 @@ def design_window():
         3. It updates the GUI based on the received results.  In this case,
         that includes printing to the console and updating a Label in the GUI.
 
+        Because step 2 waits for the server, it is run in a worker thread by
+        `tasks`, and step 3 is done by `show_answer` once the answer arrives.
+        Until then, the Ok button is disabled and the progress bar moves.
+
         Returns: None
 
         """
@@ -102,19 +113,46 @@ def design_window():
         center = donation_center_data.get()
 
         # Call external function to do the work that can be tested
-        out_string, answer = create_output(name, id, blood_letter, rh_factor,
-                                           center)
-
-        # Update GUI
+        set_busy(True)
+        tasks.submit(create_output, (name, id, blood_letter, rh_factor,
+                                     center),
+                     on_done=show_answer, on_error=show_error)
+
+    def show_answer(output):
+        """Updates the GUI with the result of `create_output`"""
+        out_string, answer = output
+        set_busy(False)
         print(out_string)
         output_string.configure(text=answer)
 
+    def show_error(error):
+        """Shows an error raised while sending data to the server"""
+        set_busy(False)
+        output_string.configure(text="Could not send to server: {}"
+                                .format(error))
+
+    def set_busy(busy):
+        """Shows or hides the progress bar and disables or enables the Ok
+        button
+        """
+        if busy:
+            ok_button.state(["disabled"])
+            progress_bar.grid()
+            progress_bar.start()
+        else:
+            ok_button.state(["!disabled"])
+            progress_bar.stop()
+            progress_bar.grid_remove()
+
     def cancel_cmd():
         """Closes window upon click of Cancel button
 
-        This function is connected to the "Cancel" button of the GUI.  It
-        destroys the root window causing the GUI interface to close.
+        This function is connected to the "Cancel" button of the GUI and to
+        the close button of the window.  It cancels the server requests not
+        yet sent, then destroys the root window causing the GUI interface to
+        close.
         """
+        tasks.close()
         root.destroy()
 
     def change_picture_cmd():
@@ -122,22 +160,34 @@ def design_window():
 
         This function opens a dialog box to allow the user to choose an image
         file.  If the user does not cancel the dialog box, the chosen filename
-        is sent to an external function for opening and resizing.  The
-        returned image is then added to the image_label widget for display
-        on the GUI.
+        is sent to an external function for opening and resizing, which is
+        run in a worker thread by `tasks` so that the window does not freeze
+        while a large file is decoded.  The returned image is then added to
+        the image_label widget for display on the GUI by `show_image`.
 
         """
         filename = filedialog.askopenfilename(initialdir="images")
         if filename == "":
             messagebox.showinfo("Cancel", "You cancelled the image load")
             return
-        tk_image = load_and_resize_image(filename)
+        tasks.submit(image_cache.get, (filename, IMAGE_BOX),
+                     on_done=show_image, on_error=show_image_error)
+
+    def show_image(pil_image):
+        """Displays a resized Pillow image in the image_label widget"""
+        tk_image = ImageTk.PhotoImage(pil_image)
         image_label.configure(image=tk_image)
         image_label.image = tk_image  # Stores image as part of widget to
         # prevent garbage collection and loss of image
 
+    def show_image_error(error):
+        messagebox.showerror("Image", "Could not load image: {}"
+                             .format(error))
+
     root = tk.Tk()
     root.title("Health Database GUI")
+    root.protocol("WM_DELETE_WINDOW", cancel_cmd)
+    tasks = TaskRunner(root.after)
     # root.geometry("10x2")
 
     top_label = ttk.Label(root, text="Blood Donor Database")
@@ -187,13 +237,20 @@ def design_window():
     ok_button = ttk.Button(root, text="Ok", command=ok_button_cmd)
     ok_button.grid(column=1, row=6)
 
+    # Moving bar shown while waiting for the server
+    progress_bar = ttk.Progressbar(root, mode="indeterminate", length=100)
+    progress_bar.grid(column=1, row=10)
+    progress_bar.grid_remove()
+
     cancel_button = ttk.Button(root, text="Cancel", command=cancel_cmd)
     cancel_button.grid(column=2, row=6)
 
-    # Creates a place holder for an image.
-    tk_image = load_and_resize_image("images/blank_pic.jpeg")
-    image_label = ttk.Label(root, image=tk_image)
+    # Creates a place holder for an image.  The label stays empty until the
+    # blank picture has been loaded by a worker thread.
+    image_label = ttk.Label(root)
     image_label.grid(column=0, row=7)
+    tasks.submit(image_cache.get, ("images/blank_pic.jpeg", IMAGE_BOX),
+                 on_done=show_image, on_error=show_image_error)
 
     # Creates a button to allow user to change the image
     change_picture_btn = ttk.Button(root, text="Change Picture",
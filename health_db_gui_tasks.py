@@ -0,0 +1,117 @@
+"""Runs slow work for the health database GUI without freezing the window
+
+tkinter draws the window and handles clicks from a single thread, the one
+running `root.mainloop()`.  While a button command is running, nothing else
+happens, so a command that waits for the server freezes the window until the
+server answers.  A `TaskRunner` runs such work in a pool of worker threads
+instead, and the command returns straight away.
+
+tkinter widgets must only be used from the main thread, so the workers do
+not touch the window.  Each finished task is put in a queue, and the runner
+checks the queue from the main thread every few milliseconds using
+`root.after`, calling the task's callback there.  The runner only checks
+while tasks are in progress.
+
+When the window is closed, `close` cancels the tasks that have not started.
+Tasks already running cannot be stopped, but their callbacks are not called,
+so they cannot try to update a window that no longer exists.
+
+This module does not import tkinter, so it can be tested without a display
+by giving it a stand-in for `root.after`.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+import queue
+
+
+class TaskRunner:
+    """Runs functions in worker threads and hands their results back to the
+    GUI thread
+
+    Args:
+        after (callable): `root.after` of the tkinter window, or anything
+            called the same way, `after(milliseconds, function)`
+        max_workers (int): number of worker threads
+        poll_ms (int): milliseconds between checks for finished tasks
+
+    """
+    def __init__(self, after, max_workers=2, poll_ms=50):
+        self.after = after
+        self.poll_ms = poll_ms
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="gui-task")
+        self.finished = queue.Queue()
+        self.pending = set()
+        self.polling = False
+        self.closed = False
+
+    def submit(self, function, args=(), on_done=None, on_error=None):
+        """Starts running `function(*args)` in a worker thread
+
+        Args:
+            function (callable): the work to do, which must not use any
+                tkinter widget
+            args (tuple): arguments for the function
+            on_done (callable): called in the GUI thread with the value
+                returned by the function
+            on_error (callable): called in the GUI thread with the exception
+                if the function raised one.  If None, the exception is
+                raised again in the GUI thread, where tkinter reports it.
+
+        Returns:
+            concurrent.futures.Future: the running task, which can be
+                cancelled with its `cancel` method before it starts
+        """
+        if self.closed:
+            raise RuntimeError("The task runner is closed")
+        future = self.executor.submit(function, *args)
+        self.pending.add(future)
+        future.add_done_callback(
+            lambda done: self.finished.put((done, on_done, on_error)))
+        if not self.polling:
+            self.polling = True
+            self.after(self.poll_ms, self.poll)
+        return future
+
+    def busy(self):
+        """Returns True if any task has not been handed back yet"""
+        return len(self.pending) > 0
+
+    def poll(self):
+        """Calls the callbacks of finished tasks
+
+        This runs in the GUI thread.  It schedules itself again with `after`
+        until there are no more tasks in progress.
+        """
+        try:
+            while True:
+                try:
+                    future, on_done, on_error = self.finished.get_nowait()
+                except queue.Empty:
+                    break
+                self.pending.discard(future)
+                if self.closed or future.cancelled():
+                    continue
+                error = future.exception()
+                if error is not None:
+                    if on_error is None:
+                        raise error
+                    on_error(error)
+                elif on_done is not None:
+                    on_done(future.result())
+        finally:
+            if self.pending and not self.closed:
+                self.after(self.poll_ms, self.poll)
+            else:
+                self.polling = False
+
+    def close(self):
+        """Cancels the tasks that have not started and stops all callbacks
+
+        Returns:
+            None
+        """
+        self.closed = True
+        for future in list(self.pending):
+            future.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,134 @@
+"""Loading of images for display in the health database GUI
+
+Photos from a camera are often several thousand pixels across, while the GUI
+shows them a few hundred pixels across.  Decoding every pixel of such a file
+and then shrinking the result wastes most of the work.  `decode_image` uses
+the "draft" mode of Pillow for JPEG files, which makes the JPEG decoder
+produce the image directly at 1/2, 1/4 or 1/8 of its size, the smallest of
+these that is still at least as large as needed.  The result is then resized
+to fit inside the target box without changing its aspect ratio, see
+`fit_size`.
+
+An `ImageCache` keeps the resized images that were used most recently, so
+showing an image again does not read the file at all.  Images are found in
+the cache by file name, the time the file was last changed, its size and the
+target box, so a file that is changed on disk is read again.  The cache
+holds at most `max_bytes` of decoded pixels, and removes the images used
+least recently to stay under it.
+
+This module does not use tkinter.  The Pillow images it returns can be made
+in a worker thread and then turned into `ImageTk.PhotoImage` objects in the
+GUI thread.
+
+"""
+from collections import OrderedDict
+import os
+import threading
+
+from PIL import Image
+
+
+def fit_size(size, box):
+    """Returns the largest size with the same aspect ratio that fits in a box
+
+    Args:
+        size (tuple of int): (width, height) of the image
+        box (tuple of int): (width, height) of the space available
+
+    Returns:
+        tuple of int: (width, height), each at least 1
+    """
+    scale = min(box[0] / size[0], box[1] / size[1])
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def decode_image(filename, box):
+    """Reads an image file and resizes it to fit in a box
+
+    Args:
+        filename (str): the name of the file containing an image
+        box (tuple of int): (width, height) the image must fit in
+
+    Returns:
+        PIL.Image.Image: the resized image
+    """
+    with Image.open(filename) as image:
+        new_size = fit_size(image.size, box)
+        if image.format == "JPEG":
+            image.draft("RGB", new_size)
+        image.load()
+        if image.size == new_size:
+            return image.copy()
+        return image.resize(new_size, Image.LANCZOS)
+
+
+class ImageCache:
+    """Keeps the most recently used resized images
+
+    Args:
+        max_bytes (int): largest total size of the decoded images kept
+
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename, box):
+        """Returns an image resized to fit in a box, from the cache if
+        possible
+
+        This can be called from any thread.
+
+        Args:
+            filename (str): the name of the file containing an image
+            box (tuple of int): (width, height) the image must fit in
+
+        Returns:
+            PIL.Image.Image: the resized image, which must not be changed by
+                the caller since it is shared with later calls
+        """
+        status = os.stat(filename)
+        key = (os.path.abspath(filename), status.st_mtime_ns, status.st_size,
+               tuple(box))
+        with self._lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+        image = decode_image(filename, box)
+        size = image_bytes(image)
+        with self._lock:
+            if key not in self.images:
+                self.images[key] = image
+                self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.images) > 1:
+                old_key, old_image = self.images.popitem(last=False)
+                self.total_bytes -= image_bytes(old_image)
+        return image
+
+    def clear(self):
+        """Removes all images from the cache"""
+        with self._lock:
+            self.images.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Returns counts describing the cache
+
+        Returns:
+            dict: with keys "images", "bytes", "hits" and "misses"
+        """
+        with self._lock:
+            return {"images": len(self.images), "bytes": self.total_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def image_bytes(image):
+    """Returns the approximate memory used by the pixels of an image"""
+    return image.width * image.height * len(image.getbands())
@@ -0,0 +1,339 @@
+"""Bulk loader for patients and test results
+
+This module reads patients or test results from a CSV or NDJSON (one JSON
+object per line) file and sends them to a running health database server
+through the /new_patients and /add_tests routes.  From the command line:
+
+    python health_db_loader.py patients.csv --concurrency 8
+    python health_db_loader.py tests.ndjson --checkpoint tests.checkpoint
+
+Each line of a patients file has `name`, `id` and `blood_type`, and each line
+of a tests file has `id`, `test_name` and `test_result`.  For a CSV file,
+these are the column names in the header line.  Which kind of file it is is
+worked out from the first record unless `--kind` is given.
+
+The file is read a little at a time, so files of any size can be loaded.
+The records are sent in batches of `--batch-size`, with up to
+`--concurrency` batches sent at the same time using a `HealthDbClient`,
+which keeps its connections open.  Progress is printed every few seconds.
+Records refused by the server, for example because of a validation error or
+an unknown patient id, are counted as failed, as are all the records of a
+batch whose answer could not be read.  If `--failures` is given, they are
+written to that file as NDJSON with the server's message, so that they can be
+corrected and loaded again.
+
+With `--checkpoint`, the number of records finished from the start of the
+file is saved after every batch.  If the load is stopped, running the same
+command again skips those records and carries on.  Batches that were being
+sent when the load stopped are sent again, so some test results may be
+stored twice, and patients that were already added are reported as
+duplicates.
+
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import requests
+
+from health_db_client import HealthDbClient, failed_records
+
+
+# Route used to send each kind of record
+ROUTES = {"patients": "/new_patients", "tests": "/add_tests"}
+
+# Fields whose values are sent as integers.  CSV files only contain text.
+INTEGER_FIELDS = ("id", "test_result")
+
+
+def read_records(filename, file_format=None):
+    """Reads the records of a CSV or NDJSON file one at a time
+
+    Args:
+        filename (str): name of the file
+        file_format (str): "csv" or "ndjson", or None to decide from the file
+            extension (".csv" is CSV, anything else NDJSON)
+
+    Returns:
+        generator: yields one dictionary per record
+    """
+    if file_format is None:
+        file_format = "csv" if filename.lower().endswith(".csv") else "ndjson"
+    with open(filename, "r", newline="") as in_file:
+        if file_format == "csv":
+            for row in csv.DictReader(in_file):
+                yield convert_record(row)
+        else:
+            for line in in_file:
+                if line.strip() != "":
+                    yield convert_record(json.loads(line))
+
+
+def convert_record(record):
+    """Converts the integer fields of a record from text
+
+    Values that are not valid integers are left as they are, so that the
+    server reports the error for that record.
+
+    Args:
+        record (dict): the record as read from the file
+
+    Returns:
+        dict: the record with integer fields converted
+    """
+    for key in INTEGER_FIELDS:
+        value = record.get(key)
+        if type(value) is str:
+            try:
+                record[key] = int(value)
+            except ValueError:
+                pass
+    return record
+
+
+def guess_kind(record):
+    """Returns "tests" if the record is a test result, otherwise "patients"
+    """
+    if "test_name" in record:
+        return "tests"
+    return "patients"
+
+
+def send_batch(client, kind, batch, retries=5):
+    """Sends one batch of records to the server
+
+    An answer of 503 means that the server was too busy to handle the batch
+    and did not store any of it, so the batch is sent again after the time
+    asked for by the `Retry-After` header, up to `retries` times.
+
+    Args:
+        client (HealthDbClient): client used to send the batch
+        kind (str): "patients" or "tests"
+        batch (list of dict): the records to send
+        retries (int): largest number of times a refused batch is sent again
+
+    Returns:
+        list of tuple: (record, message) for each record not stored
+    """
+    for attempt in range(retries + 1):
+        try:
+            r = client.post(ROUTES[kind], batch)
+        except requests.exceptions.RequestException as err:
+            return [(record, str(err)) for record in batch]
+        if r.status_code != 503 or attempt == retries:
+            break
+        time.sleep(float(r.headers.get("Retry-After", 1)))
+    if r.status_code != 200:
+        return [(record, r.text) for record in batch]
+    return failed_records(kind, batch, r.json())
+
+
+class LoadProgress:
+    """Keeps track of which records have been finished
+
+    Batches can finish in any order.  `done` is the number of records from
+    the start of the file for which every batch has finished, which is the
+    point a stopped load can safely carry on from.
+
+    Args:
+        done (int): number of records already finished
+
+    """
+    def __init__(self, done=0):
+        self.done = done
+        self.finished = {}
+
+    def finish(self, start, count):
+        """Marks the batch of `count` records starting at `start` finished
+
+        Returns:
+            bool: True if `done` increased
+        """
+        self.finished[start] = count
+        old_done = self.done
+        while self.done in self.finished:
+            self.done += self.finished.pop(self.done)
+        return self.done != old_done
+
+
+def load_checkpoint(filename, input_name):
+    """Returns the number of records finished by an earlier load
+
+    Args:
+        filename (str): checkpoint file, or None
+        input_name (str): name of the file being loaded
+
+    Returns:
+        int: number of records to skip, 0 if there is no checkpoint
+
+    Raises:
+        ValueError: if the checkpoint was made for a different file
+    """
+    if filename is None or not os.path.exists(filename):
+        return 0
+    with open(filename, "r") as in_file:
+        checkpoint = json.load(in_file)
+    if checkpoint["input"] != os.path.abspath(input_name):
+        raise ValueError("The checkpoint {} was made for {}"
+                         .format(filename, checkpoint["input"]))
+    return checkpoint["done"]
+
+
+def save_checkpoint(filename, input_name, done):
+    """Saves the number of records finished
+
+    The checkpoint is written to a temporary file which then replaces the old
+    one, so a load stopped while saving never leaves a damaged checkpoint.
+
+    Args:
+        filename (str): checkpoint file
+        input_name (str): name of the file being loaded
+        done (int): number of records finished from the start of the file
+
+    Returns:
+        None
+    """
+    temporary_name = filename + ".tmp"
+    with open(temporary_name, "w") as out_file:
+        json.dump({"input": os.path.abspath(input_name), "done": done},
+                  out_file)
+    os.replace(temporary_name, filename)
+
+
+def load_file(client, filename, kind=None, batch_size=100, concurrency=8,
+              checkpoint=None, failures=None, report_every=5.0,
+              file_format=None):
+    """Sends all the records of a file to the server
+
+    Args:
+        client (HealthDbClient): client used to send the records
+        filename (str): CSV or NDJSON file to load
+        kind (str): "patients" or "tests", or None to decide from the first
+            record
+        batch_size (int): number of records sent in one request
+        concurrency (int): largest number of requests sent at the same time
+        checkpoint (str): checkpoint file, or None to always start at the
+            beginning of the file
+        failures (str): file to which failed records are added, or None
+        report_every (float): seconds between progress reports
+        file_format (str): "csv" or "ndjson", see `read_records`
+
+    Returns:
+        dict: numbers of records "skipped" because of the checkpoint, "sent"
+            and "failed", the time taken in "seconds", and
+            "records_per_second"
+    """
+    skipped = load_checkpoint(checkpoint, filename)
+    records = itertools.islice(read_records(filename, file_format), skipped,
+                               None)
+    first = next(records, None)
+    if first is None:
+        return {"skipped": skipped, "sent": 0, "failed": 0, "seconds": 0.0,
+                "records_per_second": 0.0}
+    records = itertools.chain([first], records)
+    if kind is None:
+        kind = guess_kind(first)
+    failures_file = open(failures, "a") if failures is not None else None
+    progress = LoadProgress(skipped)
+    sent = 0
+    failed = 0
+    start_time = time.perf_counter()
+    last_report = start_time
+
+    def handle(future):
+        nonlocal failed
+        start, count, batch_failures = future.result()
+        failed += len(batch_failures)
+        if failures_file is not None:
+            for record, message in batch_failures:
+                failures_file.write(json.dumps({"record": record,
+                                                "message": message}) + "\n")
+            failures_file.flush()
+        if progress.finish(start, count) and checkpoint is not None:
+            save_checkpoint(checkpoint, filename, progress.done)
+
+    def send(start, batch):
+        try:
+            batch_failures = send_batch(client, kind, batch)
+        except Exception as err:
+            message = "{}: {}".format(type(err).__name__, err)
+            batch_failures = [(record, message) for record in batch]
+        return start, len(batch), batch_failures
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = set()
+            position = skipped
+            while True:
+                batch = list(itertools.islice(records, batch_size))
+                if len(batch) == 0:
+                    break
+                if len(in_flight) >= concurrency:
+                    finished, in_flight = wait(in_flight,
+                                               return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        handle(future)
+                in_flight.add(executor.submit(send, position, batch))
+                position += len(batch)
+                sent += len(batch)
+                now = time.perf_counter()
+                if now - last_report >= report_every:
+                    last_report = now
+                    print("{:,} records sent, {:,.0f} per second, {:,} failed"
+                          .format(sent, sent / (now - start_time), failed))
+            for future in wait(in_flight).done:
+                handle(future)
+    finally:
+        if failures_file is not None:
+            failures_file.close()
+    seconds = time.perf_counter() - start_time
+    return {"skipped": skipped, "sent": sent, "failed": failed,
+            "seconds": seconds, "records_per_second": sent / seconds}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load patients or test results from a CSV or NDJSON "
+                    "file into the health database server")
+    parser.add_argument("filename", help="CSV or NDJSON file to load")
+    parser.add_argument("--kind", choices=sorted(ROUTES),
+                        help="kind of record, found from the first record "
+                             "if not given")
+    parser.add_argument("--format", dest="file_format",
+                        choices=("csv", "ndjson"),
+                        help="file format, found from the extension if not "
+                             "given")
+    parser.add_argument("--server", default=None,
+                        help="server address, default HEALTH_DB_SERVER_URL "
+                             "or http://127.0.0.1:5000")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of requests sent at the same time")
+    parser.add_argument("--checkpoint",
+                        help="file in which progress is saved, so that a "
+                             "stopped load can be continued")
+    parser.add_argument("--failures",
+                        help="NDJSON file to which failed records are added")
+    parser.add_argument("--report-every", type=float, default=5.0,
+                        help="seconds between progress reports")
+    args = parser.parse_args(argv)
+    with HealthDbClient(args.server, pool_size=args.concurrency) as client:
+        summary = load_file(client, args.filename, args.kind,
+                            args.batch_size, args.concurrency,
+                            args.checkpoint, args.failures,
+                            args.report_every, args.file_format)
+    print("Finished: {:,} records sent in {:.1f} s ({:,.0f} per second), "
+          "{:,} failed, {:,} skipped from an earlier load"
+          .format(summary["sent"], summary["seconds"],
+                  summary["records_per_second"], summary["failed"],
+                  summary["skipped"]))
+    return 1 if summary["failed"] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
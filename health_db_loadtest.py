@@ -0,0 +1,345 @@
+"""Load test for the health database server
+
+This module sends many requests to the routes of `health_db_server.py` at
+the same time and measures how the server copes:  the number of requests
+handled per second and the 50th, 95th and 99th percentile response times
+("p50", "p95" and "p99").  The percentiles show the slow requests that an
+average would hide.
+
+The requests are sent to the Flask app in the same process using its test
+client, so no server needs to be started.  The database is replaced by an
+in-memory SQLite database, optionally wrapped in a `SlowStorage` from
+`health_db_benchmark.py` so that every database call takes extra time, as
+it would with a database on another computer.  Before the test, the
+database is filled with patients that each already have a number of tests,
+since the time needed by some routes depends on the size of the test history.
+
+The results are saved to a JSON file.  Two results files can then be
+compared to see whether a change made the server slower.  From the command
+line:
+
+    python health_db_loadtest.py run --output before.json
+    (make changes)
+    python health_db_loadtest.py run --output after.json
+    python health_db_loadtest.py compare before.json after.json
+
+`compare` exits with status 1 if any route became slower by more than the
+tolerance, so it can be used in automated checks.
+
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+
+# Relative number of requests sent to each route if no mix is given
+DEFAULT_MIX = {"new_patient": 1, "add_test": 3, "get_results": 6}
+
+# Percentiles recorded for each route, as (name, fraction)
+PERCENTILES = (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99))
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value below which the given fraction of values fall
+
+    The "nearest rank" method is used, so the answer is always one of the
+    values.
+
+    Args:
+        sorted_values (list of float): values sorted from smallest to largest
+        fraction (float): between 0 and 1, such as 0.95 for the 95th
+            percentile
+
+    Returns:
+        float: the percentile, or 0 if there are no values
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies, elapsed):
+    """Calculates the summary numbers for a list of response times
+
+    Args:
+        latencies (list of float): response times in seconds
+        elapsed (float): total duration of the test in seconds
+
+    Returns:
+        dict: number of requests, requests per second, and the p50, p95 and
+            p99 response times in milliseconds
+    """
+    sorted_values = sorted(latencies)
+    summary = {"requests": len(sorted_values),
+               "requests_per_second": len(sorted_values) / elapsed}
+    for name, fraction in PERCENTILES:
+        summary[name] = percentile(sorted_values, fraction) * 1000
+    return summary
+
+
+class RequestMaker:
+    """Creates the requests sent during a load test
+
+    Existing patients have ids 1 to `number_of_patients`.  New patients are
+    given ids above these, so each /new_patient request adds a different
+    patient.
+
+    Args:
+        number_of_patients (int): number of patients already in the database
+        seed (int): seed for the random choice of patients
+
+    """
+    def __init__(self, number_of_patients, seed=0):
+        self.number_of_patients = number_of_patients
+        self.random = random.Random(seed)
+        self.new_ids = itertools.count(number_of_patients + 1)
+        self._lock = threading.Lock()
+
+    def existing_id(self):
+        with self._lock:
+            return self.random.randint(1, self.number_of_patients)
+
+    def make(self, kind):
+        """Returns the method, URL and JSON input of a request
+
+        Args:
+            kind (str): "new_patient", "add_test" or "get_results"
+
+        Returns:
+            str, str, dict: "get" or "post", the URL, and the JSON input or
+                None
+        """
+        if kind == "new_patient":
+            return "post", "/new_patient", {"name": "Load Test",
+                                            "id": next(self.new_ids),
+                                            "blood_type": "O+"}
+        if kind == "add_test":
+            return "post", "/add_test", {"id": self.existing_id(),
+                                         "test_name": "HDL",
+                                         "test_result": 100}
+        if kind == "get_results":
+            return "get", "/get_results/{}".format(self.existing_id()), None
+        raise ValueError("Unknown request kind {}".format(kind))
+
+
+def run_load_test(mix=None, number_of_requests=2000, concurrency=8,
+                  history_size=100, number_of_patients=50, latency=0.0,
+                  seed=0):
+    """Sends a mix of requests to the server and measures the response times
+
+    The storage object of `health_db_server` is replaced for the duration of
+    the test and put back afterwards.  The patient cache is cleared before
+    and after, but otherwise left as configured.
+
+    Args:
+        mix (dict): relative number of requests for each of "new_patient",
+            "add_test" and "get_results", such as {"add_test": 1,
+            "get_results": 4}.  DEFAULT_MIX is used if None.
+        number_of_requests (int): total number of requests to send
+        concurrency (int): number of requests in progress at the same time
+        history_size (int): number of tests each patient has before the test
+        number_of_patients (int): number of patients added before the test
+        latency (float): delay in seconds added to every database call
+        seed (int): seed for the random order of requests, so that two runs
+            send the same requests
+
+    Returns:
+        dict: the settings used, summary numbers for all requests ("total")
+            and for each route ("routes"), and the number of requests that
+            did not return a 2xx status code ("errors")
+    """
+    import health_db_server
+    from health_db_benchmark import SlowStorage
+    from health_db_storage import create_storage
+    if mix is None:
+        mix = DEFAULT_MIX
+    settings = {"mix": mix, "number_of_requests": number_of_requests,
+                "concurrency": concurrency, "history_size": history_size,
+                "number_of_patients": number_of_patients, "latency": latency,
+                "seed": seed}
+
+    storage = create_storage("memory")
+    for id_no in range(1, number_of_patients + 1):
+        storage.add_patient("Load Test", id_no, "O+")
+    storage.add_tests({id_no: [("HDL", 100)] * history_size
+                       for id_no in range(1, number_of_patients + 1)})
+    if latency > 0:
+        storage = SlowStorage(storage, latency)
+
+    kinds = list(mix)
+    schedule = random.Random(seed).choices(
+        kinds, weights=[mix[kind] for kind in kinds], k=number_of_requests)
+    maker = RequestMaker(number_of_patients, seed)
+
+    def send(kind):
+        method, url, in_data = maker.make(kind)
+        start = time.perf_counter()
+        client = health_db_server.app.test_client()
+        r = getattr(client, method)(url, json=in_data)
+        return kind, time.perf_counter() - start, r.status_code
+
+    original_storage = health_db_server.storage
+    original_pid = health_db_server.storage_pid
+    health_db_server.storage = storage
+    health_db_server.storage_pid = os.getpid()
+    health_db_server.patient_cache.clear()
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            answers = list(executor.map(send, schedule))
+        elapsed = time.perf_counter() - start
+    finally:
+        health_db_server.storage = original_storage
+        health_db_server.storage_pid = original_pid
+        health_db_server.patient_cache.clear()
+
+    latencies = {kind: [] for kind in kinds}
+    errors = 0
+    for kind, seconds, status_code in answers:
+        latencies[kind].append(seconds)
+        if not 200 <= status_code < 300:
+            errors += 1
+    return {"settings": settings,
+            "total": summarize([seconds for kind, seconds, status_code
+                                in answers], elapsed),
+            "routes": {kind: summarize(latencies[kind], elapsed)
+                       for kind in kinds},
+            "errors": errors}
+
+
+def save_results(results, filename):
+    """Writes load test results to a JSON file
+
+    Args:
+        results (dict): results returned by `run_load_test`
+        filename (str): name of the file to write
+
+    Returns:
+        None
+    """
+    with open(filename, "w") as out_file:
+        json.dump(results, out_file, indent=2)
+
+
+def load_results(filename):
+    """Reads load test results from a JSON file
+
+    Args:
+        filename (str): name of the file written by `save_results`
+
+    Returns:
+        dict: the results
+    """
+    with open(filename, "r") as in_file:
+        return json.load(in_file)
+
+
+def compare_results(baseline, current, tolerance=0.10):
+    """Finds the measurements that became worse between two load tests
+
+    A percentile is worse if it increased, and requests per second is worse
+    if it decreased, by more than `tolerance` times the baseline value.  The
+    totals and every route found in both results are compared.
+
+    Args:
+        baseline (dict): results of the earlier test
+        current (dict): results of the later test
+        tolerance (float): allowed relative change, such as 0.10 for 10%
+
+    Returns:
+        list of str: one message for each measurement that became worse
+    """
+    pairs = [("total", baseline["total"], current["total"])]
+    for kind in baseline["routes"]:
+        if kind in current["routes"]:
+            pairs.append((kind, baseline["routes"][kind],
+                          current["routes"][kind]))
+    regressions = []
+    for name, before, after in pairs:
+        for key, fraction in PERCENTILES:
+            if after[key] > before[key] * (1 + tolerance):
+                regressions.append("{} {} rose from {:.2f} to {:.2f}".format(
+                    name, key, before[key], after[key]))
+        key = "requests_per_second"
+        if after[key] < before[key] * (1 - tolerance):
+            regressions.append("{} {} fell from {:.1f} to {:.1f}".format(
+                name, key, before[key], after[key]))
+    return regressions
+
+
+def print_results(results):
+    """Prints a table of load test results to the console"""
+    print("{:>12} {:>9} {:>10} {:>9} {:>9} {:>9}".format(
+        "route", "requests", "req/s", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+    rows = [("total", results["total"])] + list(results["routes"].items())
+    for name, summary in rows:
+        print("{:>12} {:>9} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            name, summary["requests"], summary["requests_per_second"],
+            summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]))
+    print("errors: {}".format(results["errors"]))
+
+
+def parse_mix(text):
+    """Converts a mix such as "add_test=1,get_results=4" into a dictionary"""
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test for the health database server")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run a load test")
+    run.add_argument("--output", default="loadtest_results.json",
+                     help="file to save the results in")
+    run.add_argument("--mix", type=parse_mix, default=None,
+                     help="request mix, such as "
+                          "new_patient=1,add_test=3,get_results=6")
+    run.add_argument("--requests", type=int, default=2000)
+    run.add_argument("--concurrency", type=int, default=8)
+    run.add_argument("--history", type=int, default=100,
+                     help="number of tests each patient starts with")
+    run.add_argument("--patients", type=int, default=50)
+    run.add_argument("--latency", type=float, default=0.0,
+                     help="seconds added to every database call")
+    run.add_argument("--seed", type=int, default=0)
+    compare = commands.add_parser("compare",
+                                  help="compare two results files")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        from health_db_server import initialize_server
+        initialize_server("memory")
+        results = run_load_test(args.mix, args.requests, args.concurrency,
+                                args.history, args.patients, args.latency,
+                                args.seed)
+        print_results(results)
+        save_results(results, args.output)
+        return 0
+    regressions = compare_results(load_results(args.baseline),
+                                  load_results(args.current),
+                                  args.tolerance)
+    for message in regressions:
+        print(message)
+    if len(regressions) > 0:
+        return 1
+    print("No regressions found")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""Queued logging for the health database servers
+
+With `logging.basicConfig(filename=...)`, every log record is written to the
+log file by the thread that made it, so a request that logs has to wait for
+the disk.  `QueuedLogging` instead gives the root logger a handler that only
+puts the record in a queue.  A background thread (a
+`logging.handlers.QueueListener`) takes records from the queue and writes
+them to the file, so the request carries on straight away.
+
+The queue holds at most `max_queue` records.  If the writer falls behind and
+the queue is full, new records are dropped rather than making requests wait.
+The number dropped is counted, and a warning giving the count is written to
+the log when logging is stopped.
+
+Two settings keep the volume of records down:
+
+* Levels for individual loggers, such as `{"werkzeug": "WARNING"}`, so that
+  a noisy library can be quietened without losing the server's own messages.
+* Sampling of DEBUG records:  with `debug_sample=10`, only one in every ten
+  DEBUG records of each logger is kept.  Sampling happens before the record
+  is formatted or queued, so the skipped records cost very little.
+
+The servers call `configure_logging`, which reads these settings from
+environment variables.
+
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only one in every `every` low-level records of each logger
+
+    Records above `level` always pass.  Each logger is counted separately,
+    so a logger that sends many records does not cause the records of
+    another logger to be skipped.
+
+    Args:
+        every (int): keep one record in this many, 1 keeps them all
+        level (int): records at this level or below are sampled
+        on_skip (callable): called with no arguments for each skipped
+            record, such as the `inc` method of a metrics counter
+
+    """
+    def __init__(self, every=1, level=logging.DEBUG, on_skip=None):
+        super().__init__()
+        self.every = max(1, every)
+        self.level = level
+        self.on_skip = on_skip
+        self.skipped = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno > self.level:
+            return True
+        with self._lock:
+            count = self._counts.get(record.name, 0)
+            self._counts[record.name] = count + 1
+            if count % self.every == 0:
+                return True
+            self.skipped += 1
+        if self.on_skip is not None:
+            self.on_skip()
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of waiting when the queue is
+    full
+
+    Args:
+        log_queue (queue.Queue): queue with a maximum size
+        on_drop (callable): called with no arguments for each dropped
+            record, such as the `inc` method of a metrics counter
+
+    """
+    def __init__(self, log_queue, on_drop=None):
+        super().__init__(log_queue)
+        self.on_drop = on_drop
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            if self.on_drop is not None:
+                self.on_drop()
+
+
+class QueuedLogging:
+    """Sends the records of the root logger to a file from a background
+    thread
+
+    Args:
+        filename (str): log file
+        level (int or str): level of the root logger
+        levels (dict): level of individual loggers, by logger name
+        debug_sample (int): keep one DEBUG record in this many per logger
+        max_queue (int): largest number of records waiting to be written
+        on_drop (callable): see `DroppingQueueHandler`
+        on_skip (callable): see `SamplingFilter`
+
+    """
+    def __init__(self, filename, level=logging.INFO, levels=None,
+                 debug_sample=1, max_queue=10000, on_drop=None,
+                 on_skip=None):
+        self.filename = filename
+        self.level = level
+        self.levels = levels or {}
+        self.queue = queue.Queue(max_queue)
+        self.file_handler = logging.FileHandler(filename, delay=True)
+        self.file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.handler = DroppingQueueHandler(self.queue, on_drop)
+        self.sampler = SamplingFilter(debug_sample, on_skip=on_skip)
+        self.handler.addFilter(self.sampler)
+        self.listener = logging.handlers.QueueListener(
+            self.queue, self.file_handler, respect_handler_level=True)
+        self.started = False
+
+    def start(self):
+        """Sets the logger levels, adds the queue handler to the root logger
+        and starts the background writer
+        """
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+        root.addHandler(self.handler)
+        self.listener.start()
+        self.started = True
+
+    def restart_after_fork(self):
+        """Starts a new background writer in a forked child process
+
+        The writer thread of the parent does not exist in the child, so the
+        records waiting in the queue copied from the parent would never be
+        written.  They are left for the parent, and a new queue and writer
+        are used instead.
+        """
+        if not self.started:
+            return
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.handler.queue = self.queue
+        self.listener = logging.handlers.QueueListener(
+            self.queue, self.file_handler, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Writes the records still queued, then removes the handler
+
+        If any records were dropped, a warning with their number is written
+        to the log file.
+        """
+        if not self.started:
+            return
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        self.started = False
+        if self.handler.dropped > 0:
+            self.file_handler.handle(logging.makeLogRecord(
+                {"name": __name__, "levelno": logging.WARNING,
+                 "levelname": "WARNING",
+                 "msg": "{} log records were dropped because the log queue "
+                        "was full".format(self.handler.dropped)}))
+        self.file_handler.close()
+
+    def stats(self):
+        """Returns counts describing the log queue
+
+        Returns:
+            dict: with keys "pending", "max_queue", "dropped" and "sampled_out"
+        """
+        return {"pending": self.queue.qsize(),
+                "max_queue": self.queue.maxsize,
+                "dropped": self.handler.dropped,
+                "sampled_out": self.sampler.skipped}
+
+
+def parse_levels(text):
+    """Converts levels such as "werkzeug=WARNING,pymongo=INFO" into a
+    dictionary
+
+    Args:
+        text (str): comma separated logger=LEVEL pairs, may be empty
+
+    Returns:
+        dict: level name by logger name
+    """
+    levels = {}
+    for part in text.split(","):
+        if part.strip() == "":
+            continue
+        name, level = part.split("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+# Queued logging set up by configure_logging()
+active_logging = None
+
+
+def configure_logging(filename="health_db_server.log", on_drop=None,
+                      on_skip=None):
+    """Sets up queued logging for a server
+
+    Logging set up by an earlier call is stopped first.  The settings are
+    read from these environment variables:
+
+    * HEALTH_DB_LOG_LEVEL:  level of the root logger (default INFO)
+    * HEALTH_DB_LOG_LEVELS:  levels of individual loggers, such as
+      "werkzeug=WARNING,health_db_server.requests=DEBUG"
+    * HEALTH_DB_LOG_DEBUG_SAMPLE:  keep one DEBUG record in this many for
+      each logger (default 1, keep all)
+    * HEALTH_DB_LOG_QUEUE_SIZE:  largest number of records waiting to be
+      written (default 10000)
+
+    Args:
+        filename (str): log file
+        on_drop (callable): called for each record dropped because the
+            queue was full
+        on_skip (callable): called for each DEBUG record skipped by sampling
+
+    Returns:
+        QueuedLogging: the logging set up
+    """
+    global active_logging
+    stop_logging()
+    active_logging = QueuedLogging(
+        filename,
+        level=os.environ.get("HEALTH_DB_LOG_LEVEL", "INFO").upper(),
+        levels=parse_levels(os.environ.get("HEALTH_DB_LOG_LEVELS", "")),
+        debug_sample=int(os.environ.get("HEALTH_DB_LOG_DEBUG_SAMPLE", 1)),
+        max_queue=int(os.environ.get("HEALTH_DB_LOG_QUEUE_SIZE", 10000)),
+        on_drop=on_drop, on_skip=on_skip)
+    active_logging.start()
+    return active_logging
+
+
+def stop_logging():
+    """Stops the logging set up by `configure_logging`, if any"""
+    global active_logging
+    if active_logging is not None:
+        active_logging.stop()
+        active_logging = None
+
+
+def restart_logging_after_fork():
+    """Gives a forked child process its own log writer thread"""
+    if active_logging is not None:
+        active_logging.restart_after_fork()
+
+
+os.register_at_fork(after_in_child=restart_logging_after_fork)
+atexit.register(stop_logging)
@@ -0,0 +1,269 @@
+"""Request and database timing metrics for the health database server
+
+The server keeps counts and timings of the requests it handles so that it
+can be seen where the time goes.  They are shown by the `/metrics` route in
+the Prometheus text format, which can be read by a Prometheus server or
+simply viewed in a browser.
+
+Three kinds of metric are provided:
+
+* `Counter`, a number that only goes up, such as the number of requests
+* `Gauge`, a number that can go up and down, such as the number of requests
+  waiting, which is read from a function when the metrics are shown
+* `Histogram`, which counts how many measurements, such as request times,
+  fell into each of a set of ranges ("buckets"), along with their sum
+
+Each metric can have labels, such as the route name, and keeps a separate
+value for each combination of label values.  Recording a value only takes a
+dictionary lookup and a few additions while holding a lock, so the metrics
+are cheap enough to leave on all the time.
+
+"""
+import bisect
+from functools import wraps
+import threading
+import time
+
+
+# Bucket upper limits in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """A count for each combination of label values
+
+    Args:
+        name (str): metric name, such as "health_db_requests_total"
+        help_text (str): one line description of the metric
+        label_names (tuple of str): names of the labels
+
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Adds `amount` to the count for the given label values
+
+        Args:
+            label_values (str): one value for each label name
+            amount (int or float): number to add
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.values[label_values] = (self.values.get(label_values, 0)
+                                         + amount)
+
+    def render(self):
+        """Returns the lines of this metric in Prometheus text format
+
+        Returns:
+            list of str: the lines, without line endings
+        """
+        with self._lock:
+            values = sorted(self.values.items())
+        return ["{}{} {}".format(self.name,
+                                 _format_labels(self.label_names, labels),
+                                 _format_number(value))
+                for labels, value in values]
+
+
+class Histogram:
+    """Counts measurements falling into each bucket, for each combination of
+    label values
+
+    Only the count of each bucket is kept, not the measurements themselves,
+    so the memory used does not grow.  Percentiles can be estimated from the
+    bucket counts by Prometheus.
+
+    Args:
+        name (str): metric name, such as "health_db_request_duration_seconds"
+        help_text (str): one line description of the metric
+        label_names (tuple of str): names of the labels
+        buckets (tuple of float): upper limit of each bucket, in increasing
+            order.  A final bucket with no upper limit is always added.
+
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Records one measurement for the given label values
+
+        Args:
+            value (float): the measurement, such as a time in seconds
+            label_values (str): one value for each label name
+
+        Returns:
+            None
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[label_values] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *label_values):
+        """Returns a decorator that records the run time of a function
+
+        The time is recorded in seconds even if the function raises an
+        exception.
+
+        Args:
+            label_values (str): one value for each label name
+
+        Returns:
+            callable: the decorator
+        """
+        def decorator(function):
+            @wraps(function)
+            def timed_function(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *label_values)
+            return timed_function
+        return decorator
+
+    def render(self):
+        """Returns the lines of this metric in Prometheus text format
+
+        Each bucket line counts the measurements less than or equal to its
+        upper limit ("le"), so the counts include those of smaller buckets.
+
+        Returns:
+            list of str: the lines, without line endings
+        """
+        with self._lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self.values.items())
+        label_names = self.label_names + ("le",)
+        lines = []
+        for labels, (counts, total) in values:
+            running_count = 0
+            limits = [_format_number(b) for b in self.buckets] + ["+Inf"]
+            for limit, count in zip(limits, counts):
+                running_count += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(label_names, labels + (limit,)),
+                    running_count))
+            label_text = _format_labels(self.label_names, labels)
+            lines.append("{}_sum{} {}".format(self.name, label_text,
+                                              _format_number(total)))
+            lines.append("{}_count{} {}".format(self.name, label_text,
+                                                running_count))
+        return lines
+
+
+class Gauge:
+    """A current value for each combination of label values
+
+    The values are not stored by the gauge but read from `function` each
+    time the metric is shown, so that they are always up to date and nothing
+    has to be done when they change.
+
+    Args:
+        name (str): metric name, such as "health_db_requests_waiting"
+        help_text (str): one line description of the metric
+        label_names (tuple of str): names of the labels
+        function (callable): called with no arguments, returns a dictionary
+            of value by tuple of label values
+
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.function = function
+
+    def render(self):
+        """Returns the lines of this metric in Prometheus text format
+
+        Returns:
+            list of str: the lines, without line endings
+        """
+        if self.function is None:
+            return []
+        return ["{}{} {}".format(self.name,
+                                 _format_labels(self.label_names, labels),
+                                 _format_number(value))
+                for labels, value in sorted(self.function().items())]
+
+
+class MetricsRegistry:
+    """Holds all the metrics shown by the /metrics route
+
+    Metrics are created with the `counter`, `gauge` and `histogram` methods,
+    which take the same arguments as the `Counter`, `Gauge` and `Histogram`
+    classes.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, label_names=(), function=None):
+        metric = Gauge(name, help_text, label_names, function)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in Prometheus text format
+
+        Returns:
+            str: the text, ending with a line ending
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(label_names, label_values):
+    """Returns the {name="value",...} part of a metric line"""
+    if len(label_names) == 0:
+        return ""
+    pairs = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                              .replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(label_names, label_values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_number(value):
+    """Returns a number as text, without a trailing .0 for whole numbers"""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
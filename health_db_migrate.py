@@ -0,0 +1,129 @@
+"""Moves test results out of patient documents into result buckets
+
+Older versions of the server stored the test results of a patient in the
+`tests` list of the patient document in MongoDB.  The server now stores them
+in `ResultBucket` documents (see `database_definitions.py`) and no longer
+reads the `tests` list, so existing databases must be converted with this
+tool.  Stop any server of the older version first, so that no tests are added
+to the old lists during the conversion.  From the command line:
+
+    HEALTH_DB_MONGODB_URI="mongodb+srv://..." python health_db_migrate.py
+
+The patients are converted in batches.  For each batch, the tests of every
+patient are split into buckets, the buckets are inserted, and then the
+`tests` lists are removed from the patient documents.  A patient whose list
+has been removed is finished, so the tool can be stopped at any time and run
+again to carry on where it stopped.  Converted tests are put in buckets with
+negative numbers so that they come before any tests added by the new
+server.  Buckets left by an earlier run that stopped part way through a batch
+are deleted before the batch is inserted again.
+
+"""
+import argparse
+import math
+import os
+import sys
+
+import pymongo
+
+from database_definitions import Patient, ResultBucket
+from health_db_storage import BUCKET_SIZE, create_storage
+
+
+def legacy_buckets(id_no, tests):
+    """Splits the tests from a patient document into bucket documents
+
+    The buckets are numbered from -n to -1, where n is the number of buckets
+    needed, so that they are read before bucket 0.  Their `start` and `end`
+    are not set because the times the tests were added are not known.
+
+    Args:
+        id_no (int): patient id number
+        tests (list): [test name, test result] lists from the patient
+            document, oldest first
+
+    Returns:
+        list of dict: the bucket documents
+    """
+    number_of_buckets = math.ceil(len(tests) / BUCKET_SIZE)
+    buckets = []
+    for index in range(number_of_buckets):
+        group = tests[index * BUCKET_SIZE:(index + 1) * BUCKET_SIZE]
+        buckets.append({"patient_id": id_no,
+                        "number": index - number_of_buckets,
+                        "count": len(group), "tests": group,
+                        "names": sorted({test[0] for test in group})})
+    return buckets
+
+
+def migrate_batch(documents):
+    """Converts the tests of one batch of patient documents
+
+    Args:
+        documents (list of dict): patient documents, each with its `_id` and
+            `tests` list
+
+    Returns:
+        int: the number of tests moved into buckets
+    """
+    patients = Patient._mongometa.collection
+    buckets = ResultBucket._mongometa.collection
+    ids = [document["_id"] for document in documents]
+    buckets.delete_many({"patient_id": {"$in": ids}, "number": {"$lt": 0}})
+    new_buckets = [bucket for document in documents
+                   for bucket in legacy_buckets(document["_id"],
+                                                document["tests"] or [])]
+    if len(new_buckets) > 0:
+        buckets.insert_many(new_buckets)
+    patients.bulk_write([pymongo.UpdateOne({"_id": id_no},
+                                           {"$unset": {"tests": ""}})
+                         for id_no in ids], ordered=False)
+    return sum(bucket["count"] for bucket in new_buckets)
+
+
+def migrate_embedded_tests(batch_size=100):
+    """Converts the tests of every patient that still has a `tests` list
+
+    The storage must already be connected, for example with
+    `health_db_storage.create_storage("mongodb", ...)`.
+
+    Args:
+        batch_size (int): number of patients converted at a time
+
+    Returns:
+        int, int: the number of patients and tests converted
+    """
+    patients = Patient._mongometa.collection
+    patient_total = 0
+    test_total = 0
+    while True:
+        documents = list(patients.find({"tests": {"$exists": True}},
+                                       {"tests": 1}).limit(batch_size))
+        if len(documents) == 0:
+            break
+        test_total += migrate_batch(documents)
+        patient_total += len(documents)
+        print("Converted {} patients, {} tests".format(patient_total,
+                                                       test_total))
+    return patient_total, test_total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move test results from patient documents into result "
+                    "buckets")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="number of patients converted at a time")
+    args = parser.parse_args(argv)
+    mongodb_uri = os.environ.get("HEALTH_DB_MONGODB_URI")
+    if mongodb_uri is None:
+        print("Set HEALTH_DB_MONGODB_URI to the MongoDB connection string")
+        return 1
+    create_storage("mongodb", mongodb_uri)
+    patient_total, test_total = migrate_embedded_tests(args.batch_size)
+    print("Finished: {} patients, {} tests".format(patient_total, test_total))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,130 @@
-import pymodm.errors
-from flask import Flask, request, jsonify
+import atexit
+import json
+from flask import Flask, request, jsonify, g, has_app_context
+from flask import Response, stream_with_context
 import logging
-from pymodm import connect, MongoModel, fields
-from database_definitions import Patient
+import os
+import threading
+import time
+import zlib
+from health_db_admission import AdmissionLimiter
+from health_db_cache import PatientCache
+from health_db_encoding import MIMETYPES, choose_encoding, encode
+from health_db_logging import configure_logging
+from health_db_metrics import MetricsRegistry
+from health_db_storage import create_storage
+from health_db_validation import compile_schema
+from health_db_write_behind import WriteBehindQueue
 
 
 # Define variable to contain Flask class for server
 app = Flask(__name__)
 
-
-def initialize_server():
+# Cache of recently used patient records, see find_patient().  Its size and
+# the number of seconds a record, or a missing patient, is kept can be set
+# with environment variables.
+patient_cache = PatientCache(
+    max_size=int(os.environ.get("HEALTH_DB_CACHE_SIZE", 1000)),
+    ttl=float(os.environ.get("HEALTH_DB_CACHE_TTL", 30)),
+    negative_ttl=float(os.environ.get("HEALTH_DB_CACHE_NEGATIVE_TTL", 1)))
+
+# Expected input of the POST routes.  These schemas are compiled into
+# validator functions once, when the server starts, instead of on every
+# request.  See health_db_validation.py for how a schema is written.
+NEW_PATIENT_SCHEMA = {"name": str, "id": int, "blood_type": str}
+ADD_TEST_SCHEMA = {"id": int, "test_name": str, "test_result": int}
+validate_new_patient = compile_schema(NEW_PATIENT_SCHEMA)
+validate_add_test = compile_schema(ADD_TEST_SCHEMA)
+
+# Limits on the number of requests handled at once, one for the routes that
+# write to the database and one for the routes that only read.  The routes
+# are put in these groups by the names of their functions in ROUTE_GROUPS.
+# See admit_request().
+admission_limiters = {
+    "write": AdmissionLimiter(
+        int(os.environ.get("HEALTH_DB_MAX_ACTIVE_WRITES", 16)),
+        int(os.environ.get("HEALTH_DB_MAX_WAITING_WRITES", 32)),
+        float(os.environ.get("HEALTH_DB_ADMISSION_TIMEOUT_MS", 1000)) / 1000),
+    "read": AdmissionLimiter(
+        int(os.environ.get("HEALTH_DB_MAX_ACTIVE_READS", 32)),
+        int(os.environ.get("HEALTH_DB_MAX_WAITING_READS", 64)),
+        float(os.environ.get("HEALTH_DB_ADMISSION_TIMEOUT_MS", 1000)) / 1000)}
+ROUTE_GROUPS = {"new_patient": "write", "new_patients": "write",
+                "add_test": "write", "add_tests": "write",
+                "get_results": "read", "blood_type_stats": "read",
+                "result_stats": "read"}
+
+# Storage object used for all database access, created by initialize_server().
+# See health_db_storage.py for the available backends.
+storage = None
+
+# Arguments used to create the storage object, kept so that a worker process
+# can create its own storage object after it is forked from the main process.
+storage_settings = None
+
+# Id of the process that created `storage`, see ensure_storage().  The lock
+# stops two threads of the same process from creating it at once.
+storage_pid = None
+storage_lock = threading.Lock()
+
+# Queue of tests waiting to be saved when write-behind mode is on, or None.
+# See start_write_behind().
+write_behind = None
+
+# Metrics shown by the /metrics route.  See health_db_metrics.py.
+metrics = MetricsRegistry()
+request_count = metrics.counter(
+    "health_db_requests_total", "Number of requests handled",
+    ("route", "method", "status"))
+request_latency = metrics.histogram(
+    "health_db_request_duration_seconds", "Time taken to handle a request",
+    ("route", "method"))
+database_latency = metrics.histogram(
+    "health_db_function_duration_seconds",
+    "Time spent in functions that use the database", ("function",))
+requests_rejected = metrics.counter(
+    "health_db_requests_rejected_total",
+    "Requests refused because the server was busy", ("group",))
+requests_active = metrics.gauge(
+    "health_db_requests_active", "Requests being handled", ("group",),
+    lambda: {(group,): limiter.stats()["active"]
+             for group, limiter in admission_limiters.items()})
+requests_waiting = metrics.gauge(
+    "health_db_requests_waiting", "Requests waiting to be handled",
+    ("group",),
+    lambda: {(group,): limiter.stats()["waiting"]
+             for group, limiter in admission_limiters.items()})
+log_records_dropped = metrics.counter(
+    "health_db_log_records_dropped_total",
+    "Log records dropped because the log queue was full")
+log_records_sampled_out = metrics.counter(
+    "health_db_log_records_sampled_out_total",
+    "DEBUG log records skipped by sampling")
+
+# Logger for the line written about every request, at DEBUG level.  Its
+# level can be set separately with HEALTH_DB_LOG_LEVELS, see
+# health_db_logging.configure_logging().
+request_log = logging.getLogger("health_db_server.requests")
+
+
+def initialize_server(backend=None):
     """ Initializes server conditions
 
-    This function initializes the server log as well as creates a connection
-    with the MongoDB database.  User will need to edit the connection string
+    This function initializes the server log as well as creates the storage
+    object through which the server reads and writes patient records.  The
+    storage backend is given by the `backend` parameter or, if that is None,
+    by the HEALTH_DB_BACKEND environment variable.  It can be:
+
+    * "mongodb" (the default): a connection is made with the MongoDB database
+      given by the HEALTH_DB_MONGODB_URI environment variable or, if that is
+      not set, by the connection string below.
+    * "sqlite": a SQLite database file named by the HEALTH_DB_SQLITE_PATH
+      environment variable (default "health_db.sqlite"), which is stored on
+      the same computer as the server.
+    * "memory": a SQLite database that is only kept in memory and is lost
+      when the server stops.  This is used for the unit tests.
+
+    For the "mongodb" backend, the user will need to edit the connection string
     to match their specific MongoDB connect string.  If you are posting to a
     public repository, you would want to make sure that your MongoDB database
     access ID and password were not stored in the code but rather protected
@@ -23,17 +134,331 @@ def initialize_server():
     repository, you can include your information as it will be necessary
     for the GitHub Actions tests.
 
-    Note:  Just because the `connect` function completes does not ensure that
-    the connection was actually made.  You will need to check that data is
-    successfully stored in your MongoDB database.
+    The MongoDB connection pool is set up from these environment variables:
+
+    * HEALTH_DB_MAX_POOL_SIZE:  largest number of connections (default 100)
+    * HEALTH_DB_MIN_POOL_SIZE:  connections kept open (default 0)
+    * HEALTH_DB_CONNECT_TIMEOUT_MS:  time allowed to open a connection
+      (default 5000)
+    * HEALTH_DB_SERVER_SELECTION_TIMEOUT_MS:  time allowed to find a usable
+      server before an operation fails (default 5000)
+    * HEALTH_DB_WAIT_QUEUE_TIMEOUT_MS:  time an operation may wait for a free
+      connection when all are in use (default: wait forever)
+
+    Just because the storage object is created does not ensure that a
+    connection was actually made.  In fact, the MongoDB client does not
+    connect until it is first used.  So, unless the HEALTH_DB_WARM_UP
+    environment variable is "0", `warm_up_storage` is called to check that
+    the database can be reached and to open the first connection, so that
+    the first real request does not have to wait for it.  The result is
+    printed.
+
+    This function is called when the server is run directly.  When the
+    server is run by a production server such as gunicorn
+    (`gunicorn health_db_server:app`), it is called by `ensure_storage`
+    before the first request of each worker process.  A database connection
+    must not be shared between processes, so a worker forked from a process
+    that already created its storage object gets a new one from
+    `reconnect_after_fork` instead.
+
+    If the HEALTH_DB_WRITE_BEHIND environment variable is "1", tests sent to
+    /add_test are saved in groups by a background thread, see
+    `start_write_behind`.
+
+    Log records are written to "health_db_server.log" by a background thread
+    so that requests do not wait for the disk.  The level, sampling and size
+    of the log queue are set with environment variables, see
+    `health_db_logging.configure_logging`.  The numbers of records dropped
+    and skipped are shown by the /metrics route.
 
     Note:  This function does not need a unit test.
+
+    Args:
+        backend (str): "mongodb", "sqlite" or "memory", or None to use the
+            HEALTH_DB_BACKEND environment variable
+    """
+    global storage, storage_settings, storage_pid
+    configure_logging("health_db_server.log",
+                      on_drop=log_records_dropped.inc,
+                      on_skip=log_records_sampled_out.inc)
+    if backend is None:
+        backend = os.environ.get("HEALTH_DB_BACKEND", "mongodb")
+    mongodb_uri = os.environ.get(
+        "HEALTH_DB_MONGODB_URI",
+        "mongodb+srv://<userid>:<pswd>@bme547.ba348.mongodb.net/health_db"
+        "?retryWrites=true&w=majority")
+    sqlite_path = os.environ.get("HEALTH_DB_SQLITE_PATH", "health_db.sqlite")
+    wait_queue_timeout = os.environ.get("HEALTH_DB_WAIT_QUEUE_TIMEOUT_MS")
+    pool_options = {
+        "max_pool_size": int(os.environ.get("HEALTH_DB_MAX_POOL_SIZE", 100)),
+        "min_pool_size": int(os.environ.get("HEALTH_DB_MIN_POOL_SIZE", 0)),
+        "connect_timeout_ms": int(
+            os.environ.get("HEALTH_DB_CONNECT_TIMEOUT_MS", 5000)),
+        "server_selection_timeout_ms": int(
+            os.environ.get("HEALTH_DB_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        "wait_queue_timeout_ms": None if wait_queue_timeout is None
+        else int(wait_queue_timeout)}
+    storage_settings = {"backend": backend, "mongodb_uri": mongodb_uri,
+                        "sqlite_path": sqlite_path,
+                        "pool_options": pool_options}
+    print("Connecting to {} storage...".format(backend))
+    storage = create_storage(**storage_settings)
+    storage_pid = os.getpid()
+    patient_cache.clear()
+    if os.environ.get("HEALTH_DB_WARM_UP", "1") != "0":
+        if warm_up_storage():
+            print("Connection to database succeeded.")
+        else:
+            print("Could not reach database, see health_db_server.log.")
+    close_write_behind()
+    if os.environ.get("HEALTH_DB_WRITE_BEHIND", "0") == "1":
+        start_write_behind()
+
+
+def warm_up_storage():
+    """Checks that the database can be reached and opens a connection
+
+    The `ping` method of the storage object is called.  For MongoDB, this
+    sends a `ping` command, which opens the first connection of the pool.
+    Any error is logged rather than raised so that the server can still
+    start and report the problem through the /ready route.
+
+    Returns:
+        bool: True if the database could be reached, False if not
+    """
+    try:
+        storage.ping()
+    except Exception as err:
+        logging.error("Database ping failed: {}".format(err))
+        return False
+    return True
+
+
+def ensure_storage():
+    """Creates the storage object of this process if it does not have one
+
+    This runs before every request.  The storage object belongs to the
+    process that created it, whose id is kept in `storage_pid`, so most of
+    the time this only compares two numbers.  Otherwise:
+
+    * If `initialize_server` has never been called, as when the server is
+      run with `gunicorn health_db_server:app`, it is called now, so each
+      worker sets itself up on its first request.
+    * If this process was forked from one that called `initialize_server`,
+      as with `gunicorn --preload` or a server that forks after starting,
+      `reconnect_after_fork` gives it its own storage object.
+
+    Processes forked for other reasons are not affected, since nothing is
+    done until one of them handles a request.
+
+    Returns:
+        None
+    """
+    if storage_pid == os.getpid():
+        return
+    with storage_lock:
+        if storage_pid == os.getpid():
+            return
+        if storage_settings is None:
+            initialize_server()
+        else:
+            reconnect_after_fork()
+
+
+def reconnect_after_fork():
+    """Creates a new storage object in a newly forked worker process
+
+    This is called by `ensure_storage` in a process forked from one that
+    already created its storage object.  A new storage object, and with it a
+    new connection pool, is created using the same settings as
+    `initialize_server`.  The database connections of the parent process are
+    not used by the child.
+
+    The "memory" backend is not recreated because its data only exists in
+    the memory of the process.
+
+    The background thread of the write-behind queue does not exist in the
+    child, so a new, empty queue is started.  Tests waiting in the copy of
+    the parent's queue are left for the parent to save.
+
+    Returns:
+        None
+    """
+    global storage, storage_pid, write_behind
+    if write_behind is not None:
+        write_behind = None
+        start_write_behind()
+    if storage_settings["backend"] != "memory":
+        storage = create_storage(**storage_settings)
+        patient_cache.clear()
+        if os.environ.get("HEALTH_DB_WARM_UP", "1") != "0":
+            warm_up_storage()
+    storage_pid = os.getpid()
+
+
+def start_write_behind():
+    """Starts write-behind mode for the /add_test route
+
+    In write-behind mode, /add_test puts each test in a `WriteBehindQueue`
+    and answers with status code 202 ("Accepted") without waiting for the
+    database.  A background thread waits a short time for more tests to
+    arrive and then saves all waiting tests with `flush_test_results`, so a
+    patient who receives a burst of tests gets one database update instead
+    of one per test.  The mode is set up by these environment variables:
+
+    * HEALTH_DB_WRITE_BEHIND_WINDOW_MS:  time to wait for more tests before
+      saving (default 50)
+    * HEALTH_DB_WRITE_BEHIND_MAX_PENDING:  largest number of tests that may
+      wait to be saved (default 10000).  When this many are waiting, /add_test
+      answers with status code 503 so that the client tries again later.
+    * HEALTH_DB_WRITE_BEHIND_DEAD_LETTER:  file to which tests are added if
+      they still cannot be saved when the server shuts down (default
+      "health_db_write_behind_dropped.ndjson")
+
+    If saving fails, the queue tries again, waiting longer after each
+    failure.  Tests still waiting when the server shuts down are saved by
+    `close_write_behind`, which is registered with `atexit`.
+
+    Returns:
+        None
+    """
+    global write_behind
+    write_behind = WriteBehindQueue(
+        flush_test_results,
+        window=float(os.environ.get("HEALTH_DB_WRITE_BEHIND_WINDOW_MS", 50))
+        / 1000,
+        max_pending=int(os.environ.get("HEALTH_DB_WRITE_BEHIND_MAX_PENDING",
+                                       10000)),
+        dead_letter_path=os.environ.get(
+            "HEALTH_DB_WRITE_BEHIND_DEAD_LETTER",
+            "health_db_write_behind_dropped.ndjson"))
+
+
+def close_write_behind():
+    """Saves all tests waiting in the write-behind queue and stops its thread
+
+    Nothing is done if write-behind mode is not on.  Tests that cannot be
+    saved are written to the dead letter file, see `start_write_behind`.
+
+    Returns:
+        None
+    """
+    global write_behind
+    if write_behind is not None:
+        write_behind.close()
+        write_behind = None
+
+
+atexit.register(close_write_behind)
+app.before_request(ensure_storage)
+
+
+@app.before_request
+def start_request_timer():
+    """Records when the handling of a request started, for the metrics
+    """
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def admit_request():
+    """Refuses the request if too many requests of its group are in progress
+
+    Requests to the routes in ROUTE_GROUPS must be let in by the
+    `AdmissionLimiter` of their group (see health_db_admission.py) before
+    they are handled.  When all places are taken, a request waits for a
+    short time for one to become free.  If it is still not let in, it is
+    answered with status code 503 and a `Retry-After` header so that the
+    caller tries again later, and the database is not touched.  The limits
+    are set with these environment variables:
+
+    * HEALTH_DB_MAX_ACTIVE_WRITES, HEALTH_DB_MAX_ACTIVE_READS:  largest
+      number of requests handled at once (default 16 and 32, 0 for no limit)
+    * HEALTH_DB_MAX_WAITING_WRITES, HEALTH_DB_MAX_WAITING_READS:  largest
+      number of requests waiting (default 32 and 64)
+    * HEALTH_DB_ADMISSION_TIMEOUT_MS:  longest time a request waits (default
+      1000)
+
+    The place is given back by `release_admission` when the request is
+    finished.
+
+    Returns:
+        None or flask.Response: None if the request may go ahead, or the 503
+            response
+    """
+    group = ROUTE_GROUPS.get(request.endpoint)
+    if group is None:
+        return None
+    if not admission_limiters[group].acquire():
+        requests_rejected.inc(group)
+        return encoded_error(response_encoding(),
+                             "The server is busy, try again later", 503,
+                             {"Retry-After": "1"})
+    g.admission_group = group
+    return None
+
+
+@app.teardown_request
+def release_admission(error=None):
+    """Gives back the place taken by `admit_request`
+
+    Flask calls this when the request is finished, even if the route raised
+    an exception.  For a streamed response, this is after the last line is
+    sent.
+    """
+    group = g.pop("admission_group", None)
+    if group is not None:
+        admission_limiters[group].release()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Counts the request and records how long it took
+
+    The route is recorded as its URL rule, such as
+    "/get_results/<patient_id>", so that all requests to one route are
+    counted together no matter which patient id was asked for.  Requests that
+    did not match any route are recorded as "unmatched".  For a streamed
+    response, the time taken is only until streaming starts.  A DEBUG line
+    giving the path, status code and time taken is also logged with
+    `request_log`.
+
+    Args:
+        response (flask.Response): the response that will be sent
+
+    Returns:
+        flask.Response: the same response
     """
-    logging.basicConfig(filename="health_db_server.log", level=logging.DEBUG)
-    print("Connecting to MongoDB...")
-    connect("mongodb+srv://<userid>:<pswd>@bme547.ba348.mongodb.net/health_db"
-            "?retryWrites=true&w=majority")
-    print("Connection attempt finished.")
+    if request.url_rule is None:
+        route = "unmatched"
+    else:
+        route = request.url_rule.rule
+    request_count.inc(route, request.method, str(response.status_code))
+    start = g.get("request_start")
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        request_latency.observe(elapsed, route, request.method)
+        if request_log.isEnabledFor(logging.DEBUG):
+            request_log.debug("{} {} {} {:.2f} ms".format(
+                request.method, request.path, response.status_code,
+                elapsed * 1000))
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def show_metrics():
+    """Returns the server metrics in Prometheus text format
+
+    The metrics include the number of requests to each route by status code,
+    a histogram of the time taken by each route, and a histogram of the time
+    spent in the `find_patient`, `add_database_entry` and `add_test_result`
+    functions, which is mostly time spent waiting for the database.
+
+    Returns:
+        flask.Response: the metrics as plain text
+    """
+    return Response(metrics.render(),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.route("/", methods=["GET"])
@@ -43,6 +468,36 @@ def status():
     return "Server is on"
 
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Used to indicate that the server is ready to handle requests
+
+    The `/` route only shows that the server process is running.  This route
+    also checks that the database can be reached, by calling
+    `warm_up_storage`, so that a load balancer can send requests only to
+    servers that can answer them.  The response is a dictionary of the form:
+
+    {"ready": bool, "database": "reachable" or "unreachable",
+     "pool": {"in_use": int, "open": int, "available": int, "max_size": int},
+     "admission": {"read": dict, "write": dict}}
+
+    where "pool" shows how many connections of the database connection pool
+    are in use and available, and "admission" shows how many read and write
+    requests are in progress and waiting (see `admit_request`).
+
+    Returns:
+        dict, int: the readiness information, followed by a status code of
+            200 if the database is reachable or 503 if not
+    """
+    reachable = warm_up_storage()
+    answer = {"ready": reachable,
+              "database": "reachable" if reachable else "unreachable",
+              "pool": storage.pool_stats(),
+              "admission": {group: limiter.stats()
+                            for group, limiter in admission_limiters.items()}}
+    return jsonify(answer), 200 if reachable else 503
+
+
 @app.route("/new_patient", methods=["POST"])
 def new_patient():
     """Implements /new_patient route for adding a new patient to server
@@ -60,20 +515,83 @@ def new_patient():
     successfully added, or a status code of 400 and an error message if there
     was a validation problem.
 
+    The caller can ask for JSON or MessagePack instead of text, see
+    `response_encoding`.  The answer is then {"name": str, "id": int,
+    "blood_type": str}, or {"error": str} if there was a problem.
+
     Returns:
         str, int: message including patient data if successfully added to the
                   database or error message if not, followed by a status code
 
     """
+    encoding = response_encoding()
     in_data = request.get_json()
-    expected_keys = {"name": str, "id": int, "blood_type": str}
-    error_string, status_code = validate_server_input(in_data, expected_keys)
+    error_string, status_code = validate_new_patient(in_data)
     if error_string is not True:
-        return error_string, status_code
+        return encoded_error(encoding, error_string, status_code)
     added_patient = add_database_entry(in_data["name"],
                                        in_data["id"],
                                        in_data["blood_type"])
-    return "Added patient {}".format(added_patient)
+    return encoded_response(encoding, "Added patient {}".format(added_patient),
+                            {"name": added_patient.name,
+                             "id": added_patient.id,
+                             "blood_type": added_patient.blood_type})
+
+
+def response_encoding(allowed=("text", "json", "msgpack")):
+    """Chooses how the response to the current request is encoded
+
+    Text is used unless the caller asks for something else with the `format`
+    query parameter or the `Accept` header, for example
+    `Accept: application/json` or `?format=msgpack`.  See
+    `health_db_encoding.choose_encoding`.
+
+    Args:
+        allowed (tuple of str): the encodings the route can give
+
+    Returns:
+        str: "text", "json", "msgpack" or "ndjson"
+    """
+    return choose_encoding(request.accept_mimetypes,
+                           request.args.get("format"), allowed)
+
+
+def encoded_response(encoding, text, data, status_code=200, headers=None):
+    """Makes the response of a route in the chosen encoding
+
+    Args:
+        encoding (str): encoding returned by `response_encoding`
+        text (str): the answer to send if the encoding is "text"
+        data (dict): the answer to send if the encoding is "json" or
+            "msgpack"
+        status_code (int): status code of the response
+        headers (dict): extra headers of the response
+
+    Returns:
+        str, int, dict or flask.Response: the response
+    """
+    if encoding not in ("json", "msgpack"):
+        return text, status_code, headers or {}
+    return Response(encode(data, encoding), status=status_code,
+                    headers=headers, mimetype=MIMETYPES[encoding])
+
+
+def encoded_error(encoding, message, status_code, headers=None):
+    """Makes an error response in the chosen encoding
+
+    For JSON and MessagePack, the message is sent as {"error": message}.
+
+    Args:
+        encoding (str): encoding returned by `response_encoding`
+        message (str): the error message
+        status_code (int): status code of the response
+        headers (dict): extra headers of the response
+
+    Returns:
+        str, int, dict or flask.Response: the response
+    """
+    return encoded_response(encoding, message, {"error": message},
+                            status_code, headers)
 
 
 def validate_server_input(in_data, expected_keys):
@@ -92,6 +610,14 @@ def validate_server_input(in_data, expected_keys):
 
     {"name": str, "id": int, "blood_type: str}
 
+    The dictionary is compiled into a validator function by
+    `health_db_validation.compile_schema`, which keeps the compiled function
+    so that the next call with the same dictionary does not compile it
+    again.  The routes of this server call validator functions that were
+    compiled once when the server started, such as `validate_new_patient`.
+    Besides Python data types, the values of the dictionary can also be any
+    of the other schema values described in `health_db_validation.py`.
+
     Args:
         in_data (any type): the input data to a route that has been
             deserialized from a JSON string.  Ideally, it is a dictionary.
@@ -105,29 +631,24 @@ def validate_server_input(in_data, expected_keys):
             unsuccessful.
 
     """
-    if type(in_data) is not dict:
-        return "The input was not a dictionary.", 400
-    for key in expected_keys:
-        if key not in in_data:
-            return "The key {} is missing from input".format(key), 400
-        if type(in_data[key]) is not expected_keys[key]:
-            return "The key {} has the wrong data type".format(key), 400
-    return True, 200
+    return compile_schema(expected_keys)(in_data)
 
 
+@database_latency.time("add_database_entry")
 def add_database_entry(patient_name, id_no, blood_type):
-    """Creates new patient database entry, updated for MongoDB/PyMODM
+    """Creates new patient database entry
 
-    This function receives information about the patient, creates an instance
-    of the Patient class for saving the data into a MongoDB database using the
-    PyMODM package, and saves that data set into the database.  Note that only
-    the `name`, `id` and `blood_type` fields are initialized.  Since the
-    `tests` list is empty, there is no need to initialize it here.  In fact,
-    doing so causes problems later.
+    This function receives information about the patient and sends it to the
+    storage backend to be saved.  For MongoDB, an instance of the Patient
+    class is created and saved into the database using the PyMODM package.
+    Any patient already saved with the same id is replaced.
 
     If the save to the database is successful, an instance of Patient
     containing the data saved to the database is created in the `answer`
-    variable which is returned.
+    variable which is returned.  This instance is also stored in the patient
+    cache, replacing anything cached for that id (such as a record saying
+    the id did not exist), unless the patient was changed by another request
+    while it was being saved.
 
     Args:
         patient_name (str): name of patient
@@ -138,13 +659,95 @@ def add_database_entry(patient_name, id_no, blood_type):
         Patient: contains the data saved to database
 
     """
-    patient_to_add = Patient(name=patient_name,
-                             id=id_no,
-                             blood_type=blood_type)
-    answer = patient_to_add.save()
+    generation = patient_cache.generation()
+    answer = storage.add_patient(patient_name, id_no, blood_type)
+    if has_app_context():
+        g.setdefault("loaded_patients", {}).pop(id_no, None)
+    patient_cache.put(id_no, answer, generation, changed=True)
     return answer
 
 
+@app.route("/new_patients", methods=["POST"])
+def new_patients():
+    """Implements /new_patients route for adding many patients to the server
+    database in one request
+
+    The /new_patients route is a POST request that should receive a
+    JSON-encoded list in which each entry has the same format as the input to
+    the /new_patient route:
+
+    [{"name": str, "id": int, "blood_type": str}, ...]
+
+    Each entry is validated with `validate_new_patient` using the same rules
+    as /new_patient.  The entries that pass validation are then added to the
+    database with one bulk insert by calling `add_database_entries`.  The
+    function returns a list with one status dictionary per entry, in the same
+    order as the input, along with a status code of 200.  If the input is not
+    a list, an error message and a status code of 400 are returned.
+
+    Returns:
+        list or str, int: list of status dictionaries for each entry, or an
+            error message, followed by a status code
+
+    """
+    in_data = request.get_json()
+    if type(in_data) is not list:
+        return "The input was not a list.", 400
+    results = []
+    valid_entries = []
+    for index, entry in enumerate(in_data):
+        error_string, status_code = validate_new_patient(entry)
+        if error_string is not True:
+            results.append({"status": "validation error",
+                            "message": error_string})
+            continue
+        results.append({"id": entry["id"], "status": "added"})
+        valid_entries.append((index, entry))
+    duplicates = add_database_entries([entry for index, entry
+                                       in valid_entries])
+    for position in duplicates:
+        index, entry = valid_entries[position]
+        results[index]["status"] = "duplicate id"
+        results[index]["message"] = \
+            "Patient id {} already exists".format(entry["id"])
+    return jsonify(results), 200
+
+
+def add_database_entries(patient_list):
+    """Creates many new patient database entries with one bulk insert
+
+    This function receives a list of dictionaries that each contain the
+    `name`, `id` and `blood_type` of a patient and sends them all to the
+    storage backend at once.  For MongoDB, the documents are sent with a
+    single unordered `insert_many` call.  The PyMongo driver splits very
+    large lists into as few messages as the server allows, so thousands of
+    patients need only a handful of round trips.
+
+    A patient that cannot be inserted does not stop the others.  Unlike
+    `add_database_entry`, an existing patient is never overwritten.  Instead,
+    the index of that patient in the list is returned to the caller.
+
+    Any cached record for the ids in the list is removed from the patient
+    cache, so the next call to `find_patient` gets them from the database.
+
+    Args:
+        patient_list (list of dict): the patients to add to the database
+
+    Returns:
+        list of int: index in `patient_list` of each patient that was not
+            added because its id already exists in the database
+
+    """
+    if len(patient_list) == 0:
+        return []
+    try:
+        duplicates = storage.add_patients(patient_list)
+    finally:
+        for patient in patient_list:
+            forget_patient(patient["id"])
+    return duplicates
+
+
 @app.route("/add_test", methods=["POST"])
 def add_test():
     """Implements /add_test route for adding a new test result to a patient
@@ -156,37 +759,125 @@ def add_test():
     {"id": int, "test_name": str, "test_result": int}
 
     The function then calls validation functions to ensure that the needed
-    keys and data types exist in the received JSON and that a patient with the
-    given id exists in the database.  A function is then called to add the
-    test results to the patient record.  The function returns to the
+    keys and data types exist in the received JSON.  A function is then called
+    to add the test results to the patient record.  That function also
+    reports whether a patient with the given id exists in the database, so no
+    separate lookup is needed.  The function returns to the
     caller either a status code of 200 and a success message, or a status code
     of 400 and an error message if there was a validation problem.
 
+    In write-behind mode (see `start_write_behind`), the patient is looked up
+    with `find_patient`, which usually finds it in the patient cache, and the
+    test is put in the write-behind queue to be saved shortly afterwards.
+    The status code is then 202, meaning the test was accepted but may not
+    yet be seen by /get_results, or 503 if the queue is full.
+
+    The caller can ask for JSON or MessagePack instead of text, see
+    `response_encoding`.  The answer is then {"id": int, "test_name": str,
+    "test_result": int, "status": "added" or "accepted"}, or {"error": str}
+    if there was a problem.
+
     Returns:
         str, int: message saying test data successfully added to the
                   database or error message if not, followed by a status code
     """
+    encoding = response_encoding()
     in_data = request.get_json()
-    expected_keys = {"id": int, "test_name": str, "test_result": int}
-    error_string, status_code = validate_server_input(in_data, expected_keys)
+    error_string, status_code = validate_add_test(in_data)
     if error_string is not True:
-        return error_string, status_code
-    does_patient_exist = find_patient(in_data["id"])
-    if does_patient_exist is False:
-        return "Patient ID {} not found in database".format(in_data["id"]), 400
-    add_test_result(in_data)
-    return "Added test to patient id {}".format(in_data["id"]), 200
+        return encoded_error(encoding, error_string, status_code)
+    if write_behind is not None:
+        return queue_test_result(in_data, encoding)
+    was_added = add_test_result(in_data)
+    if was_added is False:
+        return encoded_error(encoding, "Patient ID {} not found in database"
+                             .format(in_data["id"]), 400)
+    return encoded_response(encoding, "Added test to patient id {}"
+                            .format(in_data["id"]),
+                            added_test_data(in_data, "added"))
+
+
+def added_test_data(in_data, status):
+    """Returns the answer of the /add_test route for JSON or MessagePack
+
+    Args:
+        in_data (dict):  dictionary containing patient id, test name and result
+        status (str): "added" or "accepted"
+
+    Returns:
+        dict: the patient id, test name, test result and status
+    """
+    return {"id": in_data["id"], "test_name": in_data["test_name"],
+            "test_result": in_data["test_result"], "status": status}
+
+
+def queue_test_result(in_data, encoding="text"):
+    """Puts a test in the write-behind queue for the /add_test route
 
+    Args:
+        in_data (dict):  dictionary containing patient id, test name and result
+        encoding (str): encoding returned by `response_encoding`
+
+    Returns:
+        str, int: message and status code for the /add_test route
+    """
+    if find_patient(in_data["id"]) is False:
+        return encoded_error(encoding, "Patient ID {} not found in database"
+                             .format(in_data["id"]), 400)
+    if not write_behind.submit(in_data["id"], in_data["test_name"],
+                               in_data["test_result"]):
+        return encoded_error(
+            encoding, "Too many tests are waiting to be saved, try again "
+            "later", 503, {"Retry-After": "1"})
+    return encoded_response(encoding, "Accepted test for patient id {}"
+                            .format(in_data["id"]),
+                            added_test_data(in_data, "accepted"), 202)
+
+
+def flush_test_results(grouped, batch_id=None):
+    """Saves the tests collected by the write-behind queue
+
+    All tests are sent to the storage backend at once, and the changed
+    patients are removed from the patient cache.  The queue gives the same
+    `batch_id` again when it retries a batch that failed, so that the
+    storage backend does not store any of its tests twice.  The patients
+    were found when the tests were accepted, so a patient that is now
+    missing must have been deleted since.  Its tests are logged and dropped.
 
+    Args:
+        grouped (dict): patient id to list of (test_name, test_result)
+        batch_id (str): name of the batch, see `MongoStorage.add_tests`
+
+    Returns:
+        None
+    """
+    unknown_ids = storage.add_tests(grouped, batch_id)
+    for id_no in grouped:
+        forget_patient(id_no)
+    for id_no in unknown_ids:
+        logging.warning("Dropped {} queued tests for missing patient id {}"
+                        .format(len(grouped[id_no]), id_no))
+
+
+@database_latency.time("find_patient")
 def find_patient(id_no):
-    """Retrieves patient record from database based on patient id, Updated for
-    MongoDB/PyMODM
+    """Retrieves patient record from database based on patient id
 
-    This function searches the MongoDB "Patient" database for the record
-    with an "id" of that given as the "id_no" parameter.  If a match is
+    This function asks the storage backend for the record with an "id" of
+    that given as the "id_no" parameter.  For MongoDB, this searches the
+    "Patient" database for a document with that primary key.  If a match is
     found, that Patient instance is returned.  If no match is found, the
     boolean False is returned.
 
+    The patient cache is checked first.  If it has a record for this id, that
+    record is returned without going to the database.  Otherwise, the result
+    of the database search, including False for a missing patient, is stored
+    in the cache for the next call.  Storing False means that repeated
+    requests for an id that does not exist are also answered from memory,
+    for a short time.  The cache generation is taken before the search, so
+    that the result is not stored if another request changed the patient
+    while it was being read (see health_db_cache.py).
+
     Args:
         id_no (int): id number of patient to be found in database
 
@@ -194,34 +885,192 @@ def find_patient(id_no):
         Patient or bool: Patient instance if patient found in database, False
             if not
     """
-    try:
-        patient = Patient.objects.raw({"_id": id_no}).first()
-    except pymodm.errors.DoesNotExist:
-        patient = False
+    patient = patient_cache.get(id_no)
+    if patient is not None:
+        return patient
+    generation = patient_cache.generation()
+    patient = storage.find_patient(id_no)
+    patient_cache.put(id_no, patient, generation)
     return patient
 
 
+def get_patient(id_no):
+    """Retrieves patient record, reading it at most once per request
+
+    While a request is being handled, Flask provides the `g` object in which
+    data can be kept until the request is finished.  This function uses a
+    dictionary in `g` as an "identity map":  the first time a patient id is
+    asked for during a request, the record is obtained with `find_patient`
+    and stored in the dictionary.  Any later call for the same id during the
+    same request returns that same record.  So, the route helper functions
+    can each call `get_patient` without adding more trips to the database.
+
+    Outside of a request (for example, when called from a unit test), there
+    is no `g` object and `find_patient` is simply called.
+
+    Args:
+        id_no (int): id number of patient to be found in database
+
+    Returns:
+        Patient or bool: Patient instance if patient found in database, False
+            if not
+    """
+    if not has_app_context():
+        return find_patient(id_no)
+    loaded_patients = g.setdefault("loaded_patients", {})
+    if id_no not in loaded_patients:
+        loaded_patients[id_no] = find_patient(id_no)
+    return loaded_patients[id_no]
+
+
+def forget_patient(id_no):
+    """Removes a changed patient from the patient cache and from the identity
+    map of the current request
+
+    This is called by functions that change a patient record so that a later
+    call to `find_patient` or `get_patient` does not return the record as it
+    was before the change.
+
+    Args:
+        id_no (int): id number of the patient that was changed
+
+    Returns:
+        None
+    """
+    patient_cache.invalidate(id_no)
+    if has_app_context():
+        g.setdefault("loaded_patients", {}).pop(id_no, None)
+
+
+@database_latency.time("add_test_result")
 def add_test_result(in_data):
-    """Add test data to patient record, updated for MONGODB/PyMODM
+    """Add test data to patient record
+
+    This function sends the test name and result to the storage backend to
+    be added to the patient with the matching id.  For MongoDB, the test
+    count of the patient is increased with an atomic `$inc` update, and then
+    the `$push` operator appends the test to the result bucket it belongs in
+    (see `health_db_storage.MongoStorage`).  Only the new test travels to
+    the database, so the cost of adding a test does not grow with the number
+    of tests already stored, and two simultaneous updates to the same patient
+    cannot overwrite each other.
 
-    This function formats a tuple containing the test name and result.  Then,
-    it calls the function to obtain the patient document from the MongoDB
-    database.  Then, it appends the created tuple to the tests list of the
-    patient document.  The updated patient record is then saved to the MongoDB
-    database and returned.
+    The storage backend reports whether a patient with the given id was
+    found, which avoids having to call `find_patient` first.
+
+    Since the stored record has changed, any cached copy of it is removed
+    with `forget_patient`.
 
     Args:
         in_data (dict):  dictionary containing patient id, test name and result
 
     Returns:
-        Patient: the updated patient document, for testing purposes
+        bool: True if the test was added, False if no patient with the given
+            id exists in the database
 
     """
-    test_data_to_add = (in_data["test_name"], in_data["test_result"])
-    patient = find_patient(in_data["id"])
-    patient.tests.append(test_data_to_add)
-    patient.save()
-    return patient
+    was_added = storage.add_test(in_data["id"], in_data["test_name"],
+                                 in_data["test_result"])
+    forget_patient(in_data["id"])
+    return was_added
+
+
+@app.route("/add_tests", methods=["POST"])
+def add_tests():
+    """Implements /add_tests route for adding many test results, possibly
+    for many patients, in one request
+
+    The /add_tests route is a POST request that should receive a JSON-encoded
+    list in which each entry has the same format as the input to the
+    /add_test route:
+
+    [{"id": int, "test_name": str, "test_result": int}, ...]
+
+    Each entry is validated with `validate_add_test`.  The valid entries
+    are sent to `add_test_results`, which groups them by patient and stores
+    them with one bulk write.  Entries for patient ids that are not in the
+    database do not cause the whole request to fail.  Instead, those ids are
+    listed in the response.  The response is a dictionary of the form:
+
+    {"added": int, "unknown_ids": [int, ...],
+     "errors": [{"index": int, "message": str}, ...]}
+
+    where "errors" lists the position and message of each entry that failed
+    validation.  If the input is not a list, an error message and a status
+    code of 400 are returned.
+
+    Returns:
+        dict or str, int: summary of the results or an error message,
+            followed by a status code
+    """
+    in_data = request.get_json()
+    if type(in_data) is not list:
+        return "The input was not a list.", 400
+    errors = []
+    valid_entries = []
+    for index, entry in enumerate(in_data):
+        error_string, status_code = validate_add_test(entry)
+        if error_string is not True:
+            errors.append({"index": index, "message": error_string})
+            continue
+        valid_entries.append(entry)
+    added, unknown_ids = add_test_results(valid_entries)
+    return jsonify({"added": added, "unknown_ids": unknown_ids,
+                    "errors": errors}), 200
+
+
+def group_tests_by_patient(test_list):
+    """Groups test results by patient id
+
+    The order in which patients first appear and the order of the tests for
+    each patient are kept the same as in the input list.
+
+    Args:
+        test_list (list of dict): dictionaries containing patient id, test
+            name and result
+
+    Returns:
+        dict: keys are patient ids and values are lists of (test name, test
+            result) tuples for that patient
+    """
+    grouped = {}
+    for entry in test_list:
+        test_data = (entry["test_name"], entry["test_result"])
+        grouped.setdefault(entry["id"], []).append(test_data)
+    return grouped
+
+
+def add_test_results(test_list):
+    """Adds many test results to the database with one bulk write
+
+    The tests are first grouped by patient id using `group_tests_by_patient`
+    and then sent to the storage backend at once.  For MongoDB, `$push`
+    updates containing all of each patient's new tests (using `$each`) are
+    sent to their result buckets with one `bulk_write` call, and then one
+    `update_many` call increases the version of every patient and finds
+    whether any of them do not exist.  So, the number of trips to the
+    database does not depend on the number of patients or tests.  The
+    cached records of the patients that received tests
+    are removed from the patient cache.
+
+    Args:
+        test_list (list of dict): dictionaries containing patient id, test
+            name and result
+
+    Returns:
+        int, list of int: the number of tests added, the patient ids that
+            were not found in the database
+    """
+    grouped = group_tests_by_patient(test_list)
+    if len(grouped) == 0:
+        return 0, []
+    unknown_ids = storage.add_tests(grouped)
+    added = 0
+    for id_no, tests in grouped.items():
+        forget_patient(id_no)
+        if id_no not in unknown_ids:
+            added += len(tests)
+    return added, unknown_ids
 
 
 @app.route("/get_results/<patient_id>", methods=["GET"])
@@ -231,12 +1080,34 @@ def get_results(patient_id):
     This function implements a GET route with a variable URL.  The desired
     patient id number is included as part of the URL.  The function calls a
     validation function to ensure that the given id is an integer and that the
-    patient exists in the database.  If the validation passes, the function
-    calls a function to that generates a string with the patient results
-    and returns that string to the caller with a status code of 200.  If the
+    patient exists in the database.  If the validation passes, the validation
+    function returns the Patient it loaded from the database and this Patient
+    is sent to a function that generates a string with the patient results,
+    so the patient is only read from the database once.  That string is
+    returned to the caller with a status code of 200.  If the
     validation fails, an appropriate message is returned with a status code
     of 400.
 
+    The caller can ask for only some of the test results by adding query
+    parameters to the URL, for example
+    `/get_results/201?test_name=HDL&order=newest&limit=10&offset=20`.  These
+    are checked by `parse_results_query` and then used by the database to
+    select the tests, so only the requested tests are sent to the server.
+
+    If the caller adds `format=ndjson` to the query parameters, or sends an
+    `Accept: application/x-ndjson` header, the results are instead streamed
+    by `stream_results` with one JSON object per line per test.
+
+    The caller can also ask for the whole answer as JSON or MessagePack, see
+    `response_encoding`.  It is then made by `results_data` instead of
+    `generate_results`, and errors are sent as {"error": str}.
+
+    Except for streamed answers, the response has an `ETag` header made by
+    `results_etag` from the version of the patient.  A caller that polls for
+    new results can send it back in an `If-None-Match` header.  If no tests
+    have been added since, `not_modified_response` answers with status 304
+    and no body after reading only the version number from the database.
+
     Args:
         patient_id (str): the patient id taken from the variable URL
 
@@ -245,30 +1116,228 @@ def get_results(patient_id):
         string containing the patient data, plus a status code.
 
     """
-    validation_response, status_code = validate_patient_id(patient_id)
+    encoding = response_encoding(("text", "json", "msgpack", "ndjson"))
+    results_query, status_code = parse_results_query(request.args)
+    if status_code != 200:
+        return encoded_error(encoding, results_query, status_code)
+    if encoding == "ndjson":
+        return stream_results(patient_id, results_query)
+    if request.if_none_match:
+        not_modified = not_modified_response(patient_id, encoding)
+        if not_modified is not None:
+            return not_modified
+    validation_response, status_code = validate_patient_id(patient_id,
+                                                           results_query)
     if status_code != 200:
-        return validation_response, status_code
-    results = generate_results(validation_response)
-    return results, 200
+        return encoded_error(encoding, validation_response, status_code)
+    etag = results_etag(validation_response.id, validation_response.version,
+                        encoding, request.query_string)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if encoding == "text":
+        return generate_results(validation_response), 200, headers
+    return encoded_response(encoding, None,
+                            results_data(validation_response),
+                            headers=headers)
+
+
+def results_etag(id_no, version, encoding, query_string=b""):
+    """Makes the ETag of a /get_results answer
+
+    The tag is made of the patient id, the version of the patient, and a
+    checksum of the encoding and query string, since the same patient gives
+    a different answer for each format and selection of tests.  So the tag
+    changes whenever tests are added to the patient.
+
+    Args:
+        id_no (int): id number of the patient
+        version (int): version of the patient, or None for a patient stored
+            before versions were kept
+        encoding (str): encoding returned by `response_encoding`
+        query_string (bytes): query string of the request
+
+    Returns:
+        str: the ETag, in quotes as sent in the header
+    """
+    variant = zlib.crc32(encoding.encode("utf-8") + b"?" + query_string)
+    return '"{}-{}-{:08x}"'.format(id_no, version or 0, variant)
+
+
+def not_modified_response(patient_id, encoding):
+    """Answers a /get_results request with 304 if the patient is unchanged
+
+    Only the version of the patient is read from the database, with
+    `patient_version`, so the patient and their tests are not read or
+    formatted if the caller already has the latest answer.
+
+    Args:
+        patient_id (str): the patient id taken from the variable URL
+        encoding (str): encoding returned by `response_encoding`
+
+    Returns:
+        flask.Response or None: a response with status 304 if the
+            `If-None-Match` header of the request holds the current ETag,
+            otherwise None
+    """
+    try:
+        id_no = int(patient_id)
+    except ValueError:
+        return None
+    version = storage.patient_version(id_no)
+    if version is False:
+        return None
+    etag = results_etag(id_no, version, encoding, request.query_string)
+    if not request.if_none_match.contains_weak(etag.strip('"')):
+        return None
+    return Response(status=304, headers={"ETag": etag,
+                                         "Cache-Control": "no-cache"})
+
+
+@app.route("/stats/blood_types", methods=["GET"])
+def blood_type_stats():
+    """Implements the /stats/blood_types route, which counts the patients
+    with each blood type
+
+    The counting is done by the database (for MongoDB, with an aggregation
+    pipeline), so only the counts are sent to the server.  The response is a
+    dictionary such as:
 
+    {"A+": 12, "O-": 3}
 
-def validate_patient_id(patient_id):
+    Returns:
+        dict, int: the number of patients for each blood type, followed by a
+            status code of 200
+    """
+    return jsonify(storage.count_blood_types()), 200
+
+
+@app.route("/stats/tests", methods=["GET"])
+def result_stats():
+    """Implements the /stats/tests route, which summarizes the results of
+    each test for all patients
+
+    The following optional query parameters are recognized:
+
+    * `test_name`: only include tests with this name
+    * `min_result`: only include results of at least this value
+    * `max_result`: only include results of at most this value
+
+    The summary is worked out by the database (for MongoDB, with an
+    aggregation pipeline over the result buckets), so a question about the
+    whole population is answered with one request instead of a
+    /get_results request for every patient.  The response is a list such as:
+
+    [{"test_name": "HDL", "count": 120, "min": 35, "max": 92, "mean": 58.4}]
+
+    Returns:
+        list or str, int: one summary per test name in order of name, or an
+            error message if a query parameter was not valid, followed by a
+            status code
+    """
+    statistics_query, status_code = parse_statistics_query(request.args)
+    if status_code != 200:
+        return statistics_query, status_code
+    return jsonify(storage.summarize_tests(**statistics_query)), 200
+
+
+def parse_statistics_query(query_args):
+    """Reads the optional query parameters of the /stats/tests route
+
+    `min_result` and `max_result` must be integers, and `min_result` may not
+    be larger than `max_result`.
+
+    Args:
+        query_args (dict): the query parameters of the request, such as
+            `request.args`
+
+    Returns:
+        dict or str, int: a dictionary with the keys "test_name", "minimum"
+            and "maximum", with None for parameters not given, or an error
+            message, followed by a status code
+    """
+    statistics_query = {"test_name": query_args.get("test_name"),
+                        "minimum": None, "maximum": None}
+    for key, name in (("minimum", "min_result"), ("maximum", "max_result")):
+        if name not in query_args:
+            continue
+        try:
+            statistics_query[key] = int(query_args[name])
+        except ValueError:
+            return "{} must be an integer".format(name), 400
+    minimum = statistics_query["minimum"]
+    maximum = statistics_query["maximum"]
+    if minimum is not None and maximum is not None and minimum > maximum:
+        return "min_result must not be larger than max_result", 400
+    return statistics_query, 200
+
+
+def parse_results_query(query_args):
+    """Reads the optional query parameters of the /get_results route
+
+    The following query parameters are recognized:
+
+    * `limit`: the largest number of tests to return
+    * `offset`: the number of tests to skip before the first test returned
+    * `order`: either "oldest" (the default) or "newest" to list the most
+      recent tests first
+    * `test_name`: only return tests with this name
+
+    `limit` must be a positive integer and `offset` must be a non-negative
+    integer.  If none of the
+    parameters are given, None is returned so that the whole patient record
+    is used.
+
+    Args:
+        query_args (dict): the query parameters of the request, such as
+            `request.args`
+
+    Returns:
+        dict or None or str, int: a dictionary with the keys "limit",
+            "offset", "newest_first" and "test_name", or None if no parameters
+            were given, or an error message, followed by a status code
+    """
+    keys = ("limit", "offset", "order", "test_name")
+    if not any(key in query_args for key in keys):
+        return None, 200
+    results_query = {"limit": None, "offset": 0, "newest_first": False,
+                     "test_name": query_args.get("test_name")}
+    for key, smallest, description in (("limit", 1, "a positive"),
+                                       ("offset", 0, "a non-negative")):
+        if key not in query_args:
+            continue
+        try:
+            results_query[key] = int(query_args[key])
+        except ValueError:
+            results_query[key] = smallest - 1
+        if results_query[key] < smallest:
+            return "{} must be {} integer".format(key, description), 400
+    order = query_args.get("order", "oldest")
+    if order not in ("oldest", "newest"):
+        return "order must be oldest or newest", 400
+    results_query["newest_first"] = order == "newest"
+    return results_query, 200
+
+
+def validate_patient_id(patient_id, results_query=None):
     """Validates that the string obtained from the variable URL of
     /get_results/<patient_id> contains an integer and that a patient exists
     in the database with that id.
 
     A string is sent to this function which first checks if the string contains
     an integer.  If not, an appropriate error message is returned.  If the
-    string does contain an integer, that integer is used to check the database.
-    If a patient exists with that id number, then the integer is returned
-    along with a status code of 200.  Otherwise, an error message is returned
-    with a status code of 400.
+    string does contain an integer, that integer is used to get the patient
+    with `get_patient`, or with `find_patient_tests` if a `results_query`
+    is given.  If a patient exists with that id number, then the Patient is
+    returned along with a status code of 200 so that the caller does not need
+    to read it from the database again.  Otherwise, an error message is
+    returned with a status code of 400.
 
     Args:
         patient_id (str): string containing an inputted patient_id
+        results_query (dict): selection of tests to load, as returned by
+            `parse_results_query`.  If None, the whole record is loaded.
 
     Returns:
-        str or int , int: the patient_id if it exists in database or an error
+        str or Patient , int: the Patient if it exists in database or an error
         message followed by a status code
 
     """
@@ -276,32 +1345,136 @@ def validate_patient_id(patient_id):
         id_no = int(patient_id)
     except ValueError:
         return "Patient id was not a valid integer", 400
-    patient = find_patient(id_no)
+    if results_query is None:
+        patient = get_patient(id_no)
+    else:
+        patient = find_patient_tests(id_no, **results_query)
     if patient is False:
         return "Patient id of {} does not exist in database".format(id_no), 400
-    return id_no, 200
+    return patient, 200
+
+
+def find_patient_tests(id_no, limit=None, offset=0, newest_first=False,
+                       test_name=None):
+    """Retrieves a patient with only a selection of their test results
+
+    Rather than loading the full `tests` list and selecting from it in
+    Python, this function asks the storage backend to make the selection so
+    that only the selected tests are sent from the database.  For MongoDB,
+    this is an aggregation pipeline that unwinds the tests of the patient's
+    result buckets and uses `$match`, `$skip` and `$limit` on them.
+
+    The result is a Patient instance that is not put in the patient cache
+    because its `tests` list is incomplete.
+
+    Args:
+        id_no (int): id number of patient to be found in database
+        limit (int): largest number of tests to return, or None for all
+        offset (int): number of tests to skip
+        newest_first (bool): if True, the most recent tests come first
+        test_name (str): if given, only tests with this name are returned
+
+    Returns:
+        Patient or bool: Patient instance with the selected tests if patient
+            found in database, False if not
+    """
+    return storage.find_patient_tests(id_no, limit, offset, newest_first,
+                                      test_name)
+
+
+def stream_results(patient_id, results_query=None):
+    """Streams the test results of a patient as newline-delimited JSON
+
+    Instead of building the whole results string in memory, this function
+    returns a Flask `Response` whose body is produced by a generator.  The
+    generator reads the selected tests from the storage backend's
+    `iter_tests` iterator, which fetches them from the database in small
+    batches, and yields one line of the form
+
+    {"test_name": str, "test_result": int}
+
+    for each.  So, the memory used by the server does not depend on the
+    number of tests and the first line is sent without waiting for the rest.
+
+    `iter_tests` returns False if the patient does not exist, so a status
+    code of 400 can still be returned before streaming begins.
+
+    Args:
+        patient_id (str): the patient id taken from the variable URL
+        results_query (dict): selection of tests, as returned by
+            `parse_results_query`, or None for all tests
+
+    Returns:
+        Response or str, int: streamed response, or an error message and a
+            status code of 400
+    """
+    try:
+        id_no = int(patient_id)
+    except ValueError:
+        return "Patient id was not a valid integer", 400
+    if results_query is None:
+        results_query = {}
+    tests = storage.iter_tests(id_no, **results_query)
+    if tests is False:
+        return "Patient id of {} does not exist in database".format(id_no), 400
+    lines = (format_test_line(test) for test in tests)
+    return Response(stream_with_context(lines),
+                    mimetype="application/x-ndjson")
+
+
+def format_test_line(test):
+    """Formats one stored test as a line of newline-delimited JSON
+
+    Args:
+        test (list): test name and test result as stored in the database
+
+    Returns:
+        str: JSON object for the test followed by a newline
+    """
+    return json.dumps({"test_name": test[0], "test_result": test[1]}) + "\n"
+
+
+def results_data(patient):
+    """Puts a patient's test results in a dictionary to be sent as JSON or
+    MessagePack
+
+    Args:
+        patient (Patient): the patient for whom to get results
+
+    Each test is sent as a [test name, test result] pair rather than as a
+    dictionary, since repeating the key names for every test would make the
+    answer about three times larger for a long test history.
+
+    Returns:
+        dict: {"name": str, "id": int, "blood_type": str, "tests":
+            [[str, int], ...]}
+    """
+    return {"name": patient.name, "id": patient.id,
+            "blood_type": patient.blood_type,
+            "tests": [[test[0], test[1]] for test in patient.tests]}
 
 
-def generate_results(patient_id):
+def generate_results(patient):
     """ Create string the summarizes patient test results
 
-    This function obtains the patient document from the database by calling
-    the find_patient function.  A formatted string is then created that
-    contains the patient name and list of their test results.
+    This function receives the patient document that was loaded while
+    validating the request.  A formatted string is then created that
+    contains the patient name and list of their test results.  The lines of
+    the string are collected in a list and joined at the end, which takes
+    time in proportion to the number of tests, rather than adding to a string
+    over and over, which gets slower as the string grows.
 
     Args:
-        patient_id (int): the id number of the patient for whom to get results
+        patient (Patient): the patient for whom to get results
 
     Returns:
         string: summary of patient test results
 
     """
-    patient = find_patient(patient_id)
-    results = "Patient Name: {}\n".format(patient.name)
-    results += "Test Results:\n"
+    lines = ["Patient Name: {}".format(patient.name), "Test Results:"]
     for test in patient.tests:
-        results += "{}\n".format(test)
-    return results
+        lines.append("{}".format(test))
+    return "\n".join(lines) + "\n"
 
 
 if __name__ == '__main__':
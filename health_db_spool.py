@@ -0,0 +1,287 @@
+"""Disk-backed spool for sending writes to the health database server
+
+Without a spool, `add_patient_to_server` waits for the server to answer, and
+if the server is down the patient is lost.  A `WriteSpool` instead appends
+each write to a journal file on the local disk and returns straight away.  A
+background thread reads the journal and sends its entries to the server in
+batches, through the /new_patients and /add_tests routes.
+
+The spool keeps two files in its folder:
+
+* `journal.ndjson`:  one JSON object per line, {"route": str, "data": dict},
+  in the order the writes were made.  Lines are only ever added to the end.
+* `journal.offset`:  the position in the journal up to which every entry has
+  been delivered.  It is saved, by replacing the file, after every batch the
+  server accepts.
+
+When a new spool is made on the same folder, for example after the program
+is restarted, it carries on sending from the saved position.  Entries that
+were sent but not yet marked as delivered when the program stopped are sent
+again, so every write reaches the server at least once, and a test result
+may occasionally be stored twice.  Once every entry has been delivered, the
+journal is emptied so that it does not grow forever.
+
+Entries refused by the server (a validation error, a patient id that already
+exists or an unknown patient id) count as delivered, since sending them
+again would not help.  They are added to `rejected.ndjson` in the same
+folder with the server's message.  Note that spooled patients are sent with
+/new_patients, which does not replace a patient that already exists.
+
+Only one spool at a time may use a folder.
+
+"""
+import json
+import logging
+import os
+import threading
+
+import requests
+
+from health_db_client import failed_records
+
+
+# Route used to send a batch of each kind of journal entry
+BATCH_ROUTES = {"/new_patient": ("/new_patients", "patients"),
+                "/add_test": ("/add_tests", "tests")}
+
+
+class WriteSpool:
+    """Journals writes on disk and sends them to the server from a background
+    thread
+
+    Args:
+        client (HealthDbClient): client used to send the writes
+        folder (str): folder holding the journal, created if needed
+        batch_size (int): largest number of entries sent in one request
+        retry_delay (float): seconds to wait before trying again after the
+            server could not be reached.  The wait doubles after each failure
+            up to `max_retry_delay`.
+        max_retry_delay (float): longest wait between tries
+        sync (bool): if True, each entry is forced onto the disk with
+            `os.fsync` before `add_patient` or `add_test` returns, so that it
+            survives a power failure and not only the program stopping
+
+    """
+    def __init__(self, client, folder, batch_size=100, retry_delay=0.5,
+                 max_retry_delay=30.0, sync=False):
+        self.client = client
+        self.folder = folder
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.sync = sync
+        self.journal_name = os.path.join(folder, "journal.ndjson")
+        self.offset_name = os.path.join(folder, "journal.offset")
+        self.rejected_name = os.path.join(folder, "rejected.ndjson")
+        os.makedirs(folder, exist_ok=True)
+        self.offset = self._read_offset()
+        self.size = self._repair_journal()
+        self.queued = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.last_error = None
+        self.closed = False
+        self._journal = open(self.journal_name, "ab")
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="write-spool",
+                                        daemon=True)
+        self._thread.start()
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_name, "r") as in_file:
+                return int(in_file.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _save_offset(self, offset):
+        temporary_name = self.offset_name + ".tmp"
+        with open(temporary_name, "w") as out_file:
+            out_file.write(str(offset))
+        os.replace(temporary_name, self.offset_name)
+
+    def _repair_journal(self):
+        """Removes a line left half written when the program stopped, and
+        makes sure the saved position is inside the journal
+
+        Returns:
+            int: size of the journal
+        """
+        if not os.path.exists(self.journal_name):
+            open(self.journal_name, "wb").close()
+        with open(self.journal_name, "r+b") as journal:
+            content = journal.read()
+            end = content.rfind(b"\n") + 1
+            if end != len(content):
+                journal.truncate(end)
+        if self.offset > end:
+            self.offset = 0
+            self._save_offset(0)
+        return end
+
+    def add_patient(self, name, id_no, blood_type):
+        """Puts a new patient in the journal to be sent to the server"""
+        self._append("/new_patient", {"name": name, "id": id_no,
+                                      "blood_type": blood_type})
+
+    def add_test(self, id_no, test_name, test_result):
+        """Puts a test result in the journal to be sent to the server"""
+        self._append("/add_test", {"id": id_no, "test_name": test_name,
+                                   "test_result": test_result})
+
+    def _append(self, route, in_data):
+        line = json.dumps({"route": route, "data": in_data}) + "\n"
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("The write spool is closed")
+            data = line.encode("utf-8")
+            self._journal.write(data)
+            self._journal.flush()
+            if self.sync:
+                os.fsync(self._journal.fileno())
+            self.size += len(data)
+            self.queued += 1
+        self._wake.set()
+
+    def _read_entries(self):
+        """Reads the next run of undelivered entries for the same route
+
+        Returns:
+            str, list of dict, int: the route, the data of the entries, and
+                the journal position after them.  The list is empty if every
+                entry has been delivered.
+        """
+        route = None
+        entries = []
+        end = self.offset
+        with open(self.journal_name, "rb") as journal:
+            journal.seek(self.offset)
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                if route is not None and entry["route"] != route:
+                    break
+                route = entry["route"]
+                entries.append(entry["data"])
+                end += len(line)
+                if len(entries) >= self.batch_size:
+                    break
+        return route, entries, end
+
+    def send_next_batch(self):
+        """Sends the next batch of entries and marks them delivered
+
+        Returns:
+            int: number of entries delivered, 0 if none were waiting
+
+        Raises:
+            requests.exceptions.RequestException: if the server could not be
+                reached or did not accept the batch
+        """
+        route, entries, end = self._read_entries()
+        if len(entries) == 0:
+            return 0
+        batch_route, kind = BATCH_ROUTES[route]
+        r = self.client.post(batch_route, entries)
+        if r.status_code != 200:
+            raise requests.exceptions.HTTPError(
+                "{} answered {}: {}".format(batch_route, r.status_code,
+                                            r.text.strip()), response=r)
+        failures = failed_records(kind, entries, r.json())
+        if len(failures) > 0:
+            with open(self.rejected_name, "a") as out_file:
+                for record, message in failures:
+                    out_file.write(json.dumps({"route": route,
+                                               "data": record,
+                                               "message": message}) + "\n")
+            logging.warning("{} spooled writes were refused by the server"
+                            .format(len(failures)))
+        with self._condition:
+            self.offset = end
+            self._save_offset(end)
+            self.delivered += len(entries)
+            self.rejected += len(failures)
+            self.last_error = None
+            if self.offset == self.size:
+                self._journal.truncate(0)
+                self._journal.seek(0)
+                self.size = 0
+                self.offset = 0
+                self._save_offset(0)
+            self._condition.notify_all()
+        return len(entries)
+
+    def _run(self):
+        delay = self.retry_delay
+        while not self.closed:
+            try:
+                delivered = self.send_next_batch()
+            except (requests.exceptions.RequestException, ValueError) as err:
+                with self._condition:
+                    self.last_error = str(err)
+                logging.error("Sending spooled writes failed: {}".format(err))
+                self._wake.clear()
+                if self.closed:
+                    return
+                self._wake.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            if delivered == 0:
+                self._wake.wait()
+                self._wake.clear()
+
+    def pending_bytes(self):
+        """Returns the size of the part of the journal not yet delivered"""
+        with self._lock:
+            return self.size - self.offset
+
+    def flush(self, timeout=None):
+        """Waits until every entry has been delivered
+
+        Args:
+            timeout (float): longest time to wait in seconds, or None
+
+        Returns:
+            bool: True if everything was delivered, False if the time ran out
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.size == self.offset, timeout)
+
+    def close(self, timeout=5.0):
+        """Tries to deliver the remaining entries, then stops the background
+        thread
+
+        Entries that could not be delivered stay in the journal and are sent
+        by the next spool made on the same folder.
+
+        Args:
+            timeout (float): longest time to wait for delivery in seconds
+
+        Returns:
+            bool: True if everything was delivered
+        """
+        delivered = self.flush(timeout)
+        with self._lock:
+            self.closed = True
+        self._wake.set()
+        self._thread.join()
+        self._journal.close()
+        return delivered
+
+    def stats(self):
+        """Returns counts describing the spool
+
+        Returns:
+            dict: with keys "queued", "delivered" and "rejected" (entries
+                since the spool was made), "pending_bytes" and "last_error"
+        """
+        with self._lock:
+            return {"queued": self.queued, "delivered": self.delivered,
+                    "rejected": self.rejected,
+                    "pending_bytes": self.size - self.offset,
+                    "last_error": self.last_error}
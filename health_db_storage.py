@@ -0,0 +1,1110 @@
+"""Storage backends for the health database server
+
+The server in `health_db_server.py` does not talk to a database directly.
+Instead, it calls the methods of a "storage" object, which can be any of the
+classes in this module:
+
+* `MongoStorage` keeps the data in a MongoDB database using PyMODM.
+* `SQLiteStorage` keeps the data in a SQLite database, either in a file or,
+  with the filename ":memory:", only in memory.  SQLite is part of the
+  Python standard library and runs inside the server process, so there is no
+  network round trip.  The in-memory version is used by the unit tests so
+  they can run without a network connection.
+
+All of the classes have the same methods and return the same types, so the
+server code does not need to know which one it is using.  Patient records are
+returned as instances of `database_definitions.Patient` with each test in the
+`tests` list stored as a [test name, test result] list, which is how MongoDB
+returns them.
+
+The `create_storage` function makes the storage object that matches a
+backend name.
+
+"""
+from datetime import datetime
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+import pymodm.errors
+import pymongo
+import pymongo.errors
+from pymongo import monitoring
+from pymodm import connect
+
+from database_definitions import Patient, ResultBucket
+
+
+BACKENDS = ("mongodb", "sqlite", "memory")
+
+# Largest number of tests stored in one ResultBucket document in MongoDB
+BUCKET_SIZE = 100
+
+# Number of times a bulk write of result buckets is sent when another
+# request keeps opening the same patient's bucket first
+BUCKET_WRITE_ATTEMPTS = 10
+
+
+def create_storage(backend, mongodb_uri=None, sqlite_path=None,
+                   pool_options=None):
+    """Creates the storage object for the given backend name
+
+    Args:
+        backend (str): one of "mongodb", "sqlite" or "memory"
+        mongodb_uri (str): connection string, used by the "mongodb" backend
+        sqlite_path (str): database filename, used by the "sqlite" backend
+        pool_options (dict): connection pool settings passed on as keyword
+            arguments to `MongoStorage`, used by the "mongodb" backend
+
+    Returns:
+        MongoStorage or SQLiteStorage: the storage object
+
+    Raises:
+        ValueError: if the backend name is not recognized
+    """
+    if backend == "mongodb":
+        return MongoStorage(mongodb_uri, **(pool_options or {}))
+    if backend == "sqlite":
+        return SQLiteStorage(sqlite_path)
+    if backend == "memory":
+        return SQLiteStorage(":memory:")
+    raise ValueError("Unknown storage backend {}, expected one of {}"
+                     .format(backend, ", ".join(BACKENDS)))
+
+
+def first_version():
+    """Returns the version number given to a newly added patient
+
+    Every storage backend keeps a version number for each patient, which
+    goes up by 1 each time tests are added to the patient, so that the
+    server can tell whether a patient has changed without reading their
+    tests.  A new patient starts from the current time in nanoseconds rather
+    than from 0, so that a patient that replaces an earlier one with the same
+    id does not repeat any of its version numbers.
+
+    Returns:
+        int: the first version number
+    """
+    return time.time_ns()
+
+
+class PoolCounter(monitoring.ConnectionPoolListener):
+    """Keeps count of the connections in a PyMongo connection pool
+
+    PyMongo calls the methods of this listener whenever a connection is
+    created, closed, checked out for an operation, or checked back in.  From
+    these counts, `stats` works out how many connections are open and how
+    many of them are being used.
+
+    Args:
+        max_size (int): the largest number of connections in the pool
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self._lock = threading.Lock()
+
+    def _add(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def connection_created(self, event):
+        self._add("created")
+
+    def connection_closed(self, event):
+        self._add("closed")
+
+    def connection_checked_out(self, event):
+        self._add("checked_out")
+
+    def connection_checked_in(self, event):
+        self._add("checked_in")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def stats(self):
+        """Returns the number of connections in use and available
+
+        Returns:
+            dict: with keys "in_use", "open", "available" and "max_size".
+                "available" counts connections that are open and not in use.
+        """
+        with self._lock:
+            in_use = self.checked_out - self.checked_in
+            open_connections = self.created - self.closed
+        return {"in_use": in_use, "open": open_connections,
+                "available": open_connections - in_use,
+                "max_size": self.max_size}
+
+
+class MongoStorage:
+    """Stores patient records in MongoDB using PyMODM
+
+    Each patient is one document of the `Patient` model.  The test results
+    are kept in a separate collection of `ResultBucket` documents, each
+    holding up to BUCKET_SIZE tests of one patient.  So, the patient
+    document stays small however many tests are added, and the tests are
+    only read when they are needed.  New tests go into the patient's one
+    open bucket, see `bucket_updates`, and the patient document increases
+    its `version` whenever tests are added.
+
+    The connection pool of the PyMongo client is configured with the keyword
+    arguments.  The client is created with `connect=False`, so no connection
+    is opened until the first database operation, or until `ping` is called
+    to "warm up" the connection.  This also makes it safe to create the
+    storage object before a server forks its worker processes, as long as
+    each worker creates its own storage object after the fork (see
+    `health_db_server.initialize_server`).  A `PoolCounter` is registered
+    with the client so that `pool_stats` can report how busy the pool is.
+
+    Args:
+        connection_string (str): MongoDB connection string
+        max_pool_size (int): largest number of connections to keep open
+        min_pool_size (int): number of connections the pool keeps open,
+            opened in the background once the client connects
+        connect_timeout_ms (int): milliseconds to wait for a new connection
+        server_selection_timeout_ms (int): milliseconds to wait for a usable
+            server before an operation fails
+        wait_queue_timeout_ms (int): milliseconds an operation waits for a
+            free connection when all are in use, or None to wait forever
+
+    """
+    def __init__(self, connection_string, max_pool_size=100,
+                 min_pool_size=0, connect_timeout_ms=5000,
+                 server_selection_timeout_ms=5000,
+                 wait_queue_timeout_ms=None):
+        self.pool_counter = PoolCounter(max_pool_size)
+        connect(connection_string,
+                maxPoolSize=max_pool_size,
+                minPoolSize=min_pool_size,
+                connectTimeoutMS=connect_timeout_ms,
+                serverSelectionTimeoutMS=server_selection_timeout_ms,
+                waitQueueTimeoutMS=wait_queue_timeout_ms,
+                connect=False,
+                event_listeners=[self.pool_counter])
+        self._unfinished_batches = set()
+
+    def ping(self):
+        """Checks that the database can be reached
+
+        A `ping` command is sent to the server.  If this is the first
+        operation, it also opens the first connection of the pool.
+
+        Raises:
+            pymongo.errors.PyMongoError: if the database cannot be reached
+        """
+        client = Patient._mongometa.collection.database.client
+        client.admin.command("ping")
+
+    def pool_stats(self):
+        """Returns the number of pool connections in use and available
+
+        Returns:
+            dict: see `PoolCounter.stats`
+        """
+        return self.pool_counter.stats()
+
+    def add_patient(self, patient_name, id_no, blood_type):
+        """Saves a new patient, replacing any patient with the same id
+
+        Note that only the `name`, `id` and `blood_type` fields are
+        initialized.  Since the `tests` list is empty, there is no need to
+        initialize it here.  In fact, doing so causes problems later.  The
+        tests of any earlier patient with the same id are deleted.
+
+        Args:
+            patient_name (str): name of patient
+            id_no (int):  patient id number
+            blood_type (str):  patient blood type, ex. "AB+"
+
+        Returns:
+            Patient: contains the data saved to database
+        """
+        ResultBucket._mongometa.collection.delete_many({"patient_id": id_no})
+        patient_to_add = Patient(name=patient_name,
+                                 id=id_no,
+                                 blood_type=blood_type,
+                                 version=first_version())
+        return patient_to_add.save()
+
+    def add_patients(self, patient_list):
+        """Adds many patients with a single unordered bulk insert
+
+        An instance of the Patient class is created for each dictionary so
+        that the documents have the same format as those saved by
+        `add_patient`.  All of the documents are then sent with a single
+        unordered `insert_many` call.  The PyMongo driver splits very large
+        lists into as few messages as the server allows.
+
+        Because the insert is unordered, a document that cannot be inserted
+        does not stop the others.  If a patient id already exists, MongoDB
+        reports a duplicate key error (code 11000) for that document.
+
+        Args:
+            patient_list (list of dict): dictionaries with the `name`, `id`
+                and `blood_type` of each patient
+
+        Returns:
+            list of int: index in `patient_list` of each patient that was not
+                added because its id already exists
+        """
+        documents = [Patient(name=patient["name"],
+                             id=patient["id"],
+                             blood_type=patient["blood_type"],
+                             version=first_version()).to_son()
+                     for patient in patient_list]
+        try:
+            Patient._mongometa.collection.insert_many(documents,
+                                                      ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            duplicates = [error["index"]
+                          for error in err.details["writeErrors"]
+                          if error["code"] == 11000]
+            if len(duplicates) != len(err.details["writeErrors"]):
+                raise
+            return sorted(duplicates)
+        return []
+
+    def find_patient(self, id_no):
+        """Retrieves the patient document with the given id, and their tests
+
+        The patient document is read without any `tests` list it may still
+        hold from an older version of the server, and then the patient's
+        buckets are read in order to fill in `tests`.
+
+        Args:
+            id_no (int): id number of patient to be found
+
+        Returns:
+            Patient or bool: Patient instance if found, False if not
+        """
+        patient = self._find_patient_only(id_no)
+        if patient is False:
+            return False
+        buckets = ResultBucket._mongometa.collection.find(
+            {"patient_id": id_no}, {"_id": 0, "tests": 1}).sort("number", 1)
+        patient.tests = [test for bucket in buckets
+                         for test in bucket["tests"]]
+        return patient
+
+    def _find_patient_only(self, id_no):
+        """Returns the patient without tests, or False if not found"""
+        try:
+            return Patient.objects.raw({"_id": id_no}).exclude("tests").first()
+        except pymodm.errors.DoesNotExist:
+            return False
+
+    def patient_version(self, id_no):
+        """Returns the version number of a patient
+
+        Only the `version` field of the patient document is read, using the
+        index on `_id`, so this is much cheaper than reading the patient.
+
+        Args:
+            id_no (int): id number of the patient
+
+        Returns:
+            int or bool: the version number, or False if the patient was not
+                found
+        """
+        document = Patient._mongometa.collection.find_one({"_id": id_no},
+                                                          {"version": 1})
+        if document is None:
+            return False
+        return document.get("version", 0)
+
+    def add_test(self, id_no, test_name, test_result):
+        """Appends a test to a patient's open bucket
+
+        See `add_tests`, which this calls with the one test.  This takes two
+        trips to the database:  one conditional `$push` that adds the test
+        to the patient's open bucket, or opens a new one, and one update of
+        the patient's `version`.  Only the new test is sent, so the cost of
+        adding a test does not depend on how many tests are already stored,
+        and two simultaneous updates cannot overwrite each other.
+
+        Args:
+            id_no (int): patient id number
+            test_name (str): name of the test
+            test_result (int): result of the test
+
+        Returns:
+            bool: True if the test was added, False if the patient was not
+                found
+        """
+        return self.add_tests({id_no: [(test_name, test_result)]}) == []
+
+    def add_tests(self, grouped_tests, batch_id=None):
+        """Adds tests for many patients with two trips to the database
+
+        One ordered bulk write, made by `bucket_updates`, adds every
+        patient's new tests to their open buckets, opening new buckets where
+        there is no room.  A single `update_many` then increases the
+        `version` of all of the patients, and the number of patients it
+        matched tells whether any of them do not exist.  The buckets are
+        written first so that a new `version` is never seen before the tests
+        it stands for.  Only when some patients are missing are more trips
+        needed, to find which ones and delete the buckets made for them.
+
+        Each group of tests written to a bucket is recorded in the bucket's
+        `groups` under a name made from `batch_id`.  If the same batch is
+        given again after a call that failed part way through, for example
+        by the write-behind queue, the groups that were already written are
+        looked up and skipped, so no test is stored twice.
+
+        Args:
+            grouped_tests (dict): keys are patient ids and values are lists
+                of (test name, test result) tuples
+            batch_id (str): name of this batch of tests, which must be given
+                again when the same batch is retried, or None to make a new
+                one
+
+        Returns:
+            list of int: the patient ids that were not found
+        """
+        if batch_id is None:
+            batch_id = uuid.uuid4().hex
+        ids = list(grouped_tests)
+        written = set()
+        if batch_id in self._unfinished_batches:
+            written = self._written_groups(ids, batch_id)
+        self._unfinished_batches.add(batch_id)
+        now = datetime.utcnow()
+        updates = [update for id_no, tests in grouped_tests.items()
+                   for update in bucket_updates(id_no, tests, now, batch_id,
+                                                written)]
+        if len(updates) > 0:
+            self._write_buckets(updates)
+        patients = Patient._mongometa.collection
+        result = patients.update_many({"_id": {"$in": ids}},
+                                      {"$inc": {"version": 1}})
+        unknown_ids = []
+        if result.matched_count < len(ids):
+            found = {document["_id"] for document in
+                     patients.find({"_id": {"$in": ids}}, {"_id": 1})}
+            unknown_ids = [id_no for id_no in ids if id_no not in found]
+            ResultBucket._mongometa.collection.delete_many(
+                {"patient_id": {"$in": unknown_ids}})
+        self._unfinished_batches.discard(batch_id)
+        return unknown_ids
+
+    def _written_groups(self, ids, batch_id):
+        """Returns the names of the groups of a batch that are already in
+        the patients' buckets"""
+        prefix = re.compile("^" + re.escape(batch_id) + ":")
+        buckets = ResultBucket._mongometa.collection.find(
+            {"patient_id": {"$in": ids}, "groups": prefix},
+            {"_id": 0, "groups": 1})
+        return {name for bucket in buckets for name in bucket["groups"]}
+
+    def _write_buckets(self, updates):
+        """Sends bucket updates made by `bucket_updates` in one bulk write
+
+        The updates are ordered so that tests reach each bucket in the order
+        they were given.  Two requests can both try to open a new bucket for
+        the same patient, and the one that loses gets a duplicate key error
+        from the unique index on open buckets.  The updates from that pair
+        onwards are then sent again, see `requests_to_resend`.
+        """
+        collection = ResultBucket._mongometa.collection
+        requests = bucket_requests(updates)
+        for attempt in range(BUCKET_WRITE_ATTEMPTS - 1):
+            try:
+                collection.bulk_write(requests)
+                return
+            except pymongo.errors.BulkWriteError as err:
+                requests = requests_to_resend(requests, err)
+        collection.bulk_write(requests)
+
+    def find_patient_tests(self, id_no, limit=None, offset=0,
+                           newest_first=False, test_name=None):
+        """Retrieves a patient with only a selection of their test results
+
+        The patient document is read without tests, and then an aggregation
+        pipeline built by `bucket_tests_pipeline` selects the tests from the
+        patient's buckets, so the selection happens in the database and only
+        the selected tests are sent.
+
+        Args:
+            id_no (int): id number of patient to be found
+            limit (int): largest number of tests to return, or None for all
+            offset (int): number of tests to skip
+            newest_first (bool): if True, the most recent tests come first
+            test_name (str): if given, only tests with this name are returned
+
+        Returns:
+            Patient or bool: Patient instance with the selected tests if
+                found, False if not
+        """
+        patient = self._find_patient_only(id_no)
+        if patient is False:
+            return False
+        pipeline = bucket_tests_pipeline(id_no, limit, offset, newest_first,
+                                         test_name)
+        documents = ResultBucket._mongometa.collection.aggregate(pipeline)
+        patient.tests = [document["tests"] for document in documents]
+        return patient
+
+    def iter_tests(self, id_no, limit=None, offset=0, newest_first=False,
+                   test_name=None, batch_size=100):
+        """Returns an iterator over a selection of a patient's tests
+
+        After checking that the patient exists, the pipeline of
+        `bucket_tests_pipeline` is run and the returned generator reads one
+        document per test from the database cursor in batches of
+        `batch_size`.
+
+        Args:
+            id_no (int): id number of the patient
+            limit, offset, newest_first, test_name: see `find_patient_tests`
+            batch_size (int): number of tests fetched from the database at
+                a time
+
+        Returns:
+            generator or bool: yields [test name, test result] lists, or
+                False if the patient was not found
+        """
+        if Patient._mongometa.collection.find_one({"_id": id_no},
+                                                  {"_id": 1}) is None:
+            return False
+        pipeline = bucket_tests_pipeline(id_no, limit, offset, newest_first,
+                                         test_name)
+        cursor = ResultBucket._mongometa.collection.aggregate(
+            pipeline, batchSize=batch_size)
+        return (document["tests"] for document in cursor)
+
+    def delete_patient(self, id_no):
+        """Deletes a patient and their tests
+
+        Args:
+            id_no (int): id number of the patient to delete
+
+        Returns:
+            None
+        """
+        Patient.objects.raw({"_id": id_no}).delete()
+        ResultBucket._mongometa.collection.delete_many({"patient_id": id_no})
+
+    def count_blood_types(self):
+        """Counts the patients with each blood type
+
+        An aggregation pipeline groups the patient documents by blood type
+        in the database.  The pipeline first sorts by `blood_type`, which
+        lets MongoDB read the blood types from the `blood_type` index of
+        `Patient` instead of reading every patient document.
+
+        Returns:
+            dict: blood types as keys and numbers of patients as values
+        """
+        pipeline = [{"$sort": {"blood_type": 1}},
+                    {"$project": {"_id": 0, "blood_type": 1}},
+                    {"$group": {"_id": "$blood_type", "count": {"$sum": 1}}},
+                    {"$sort": {"_id": 1}}]
+        documents = Patient._mongometa.collection.aggregate(pipeline)
+        return {document["_id"]: document["count"] for document in documents}
+
+    def summarize_tests(self, test_name=None, minimum=None, maximum=None):
+        """Finds the number, smallest, largest and mean result of each test
+
+        The pipeline of `summarize_tests_pipeline` does the work in the
+        database, so only one summary per test name is sent back.
+
+        Args:
+            test_name (str): if given, only tests with this name are included
+            minimum (int): if given, only results of at least this are
+                included
+            maximum (int): if given, only results of at most this are
+                included
+
+        Returns:
+            list of dict: one dictionary per test name, in order of name,
+                with the keys "test_name", "count", "min", "max" and "mean"
+        """
+        pipeline = summarize_tests_pipeline(test_name, minimum, maximum)
+        documents = ResultBucket._mongometa.collection.aggregate(pipeline)
+        return [{"test_name": document["_id"], "count": document["count"],
+                 "min": document["min"], "max": document["max"],
+                 "mean": document["mean"]} for document in documents]
+
+
+def bucket_updates(id_no, tests, now, batch_id, written=()):
+    """Builds the updates that add tests to a patient's result buckets
+
+    Each patient has at most one "open" bucket, which new tests are added
+    to.  The tests are split into groups of up to BUCKET_SIZE, and each
+    group gets a pair of updates.  The first closes the open bucket if it
+    does not have room for the whole group.  The second appends the group
+    to the open bucket with `$push` and `$each`, but only if it has room,
+    and keeps the bucket's `count`, `start`, `end`, `names` and `groups` up
+    to date.  It is used with `upsert=True`, so when there is no open bucket
+    with room, a new one is opened with the group as its first tests.  A
+    new bucket is numbered with the time, so buckets read in order of
+    `number` give the tests from oldest to newest.
+
+    Args:
+        id_no (int): patient id number
+        tests (list of tuple): (test name, test result) tuples to add
+        now (datetime): time to record as when the tests were stored
+        batch_id (str): name of the batch, used to name each group
+        written (set of str): names of groups already stored, which are
+            left out
+
+    Returns:
+        list of tuple: (query, update, upsert) tuples, two per group
+    """
+    updates = []
+    for index, added in enumerate(range(0, len(tests), BUCKET_SIZE)):
+        group_name = "{}:{}:{}".format(batch_id, id_no, index)
+        if group_name in written:
+            continue
+        group = [list(test) for test in tests[added:added + BUCKET_SIZE]]
+        names = sorted({test[0] for test in group})
+        room = BUCKET_SIZE - len(group)
+        updates.append(({"patient_id": id_no, "open": True,
+                         "count": {"$gt": room}},
+                        {"$set": {"open": False}}, False))
+        updates.append(({"patient_id": id_no, "open": True,
+                         "count": {"$lte": room}},
+                        {"$push": {"tests": {"$each": group}},
+                         "$addToSet": {"names": {"$each": names},
+                                       "groups": group_name},
+                         "$inc": {"count": len(group)},
+                         "$min": {"start": now},
+                         "$max": {"end": now},
+                         "$setOnInsert": {"number": time.time_ns() + index}},
+                        True))
+    return updates
+
+
+def bucket_requests(updates):
+    """Turns the tuples made by `bucket_updates` into PyMongo requests"""
+    return [pymongo.UpdateOne(query, update, upsert=upsert)
+            for query, update, upsert in updates]
+
+
+def requests_to_resend(requests, err):
+    """Returns the bucket requests to send again after a failed bulk write
+
+    The bulk write is ordered, so it stopped at the failed request and the
+    ones before it were written.  A duplicate key error means another
+    request opened a bucket for the same patient first, so the pair holding
+    the failed request is sent again, starting with its update that closes
+    the open bucket if it has no room left.
+
+    Args:
+        requests (list of UpdateOne): the requests that were sent
+        err (BulkWriteError): the error raised by the bulk write
+
+    Returns:
+        list of UpdateOne: the requests to send again
+
+    Raises:
+        BulkWriteError: `err` again, if it is not a duplicate key error
+    """
+    error = err.details["writeErrors"][0]
+    if error["code"] != 11000:
+        raise err
+    return requests[error["index"] - error["index"] % 2:]
+
+
+def bucket_tests_pipeline(id_no, limit=None, offset=0, newest_first=False,
+                          test_name=None):
+    """Builds the aggregation pipeline that selects tests from a patient's
+    result buckets
+
+    The pipeline is built from these stages, some of which are only added if
+    needed:
+
+    1. `$match` finds the buckets of the patient, using the
+       (patient_id, number) index.
+    2. `$sort` puts the buckets in order of `number`, or in reverse order if
+       the newest tests should come first, in which case `$reverseArray`
+       also reverses the tests inside each bucket.
+    3. `$unwind` makes one document for each test.
+    4. `$match` keeps only the tests whose name (the first item of each
+       stored test) matches `test_name`.
+    5. `$skip` skips `offset` tests and `$limit` keeps at most `limit`.
+
+    Args:
+        id_no (int): patient id number
+        limit, offset, newest_first, test_name: see
+            `MongoStorage.find_patient_tests`
+
+    Returns:
+        list of dict: the pipeline.  Each document it produces has a single
+            `tests` key holding one [test name, test result] list.
+    """
+    if newest_first:
+        direction, tests = -1, {"$reverseArray": "$tests"}
+    else:
+        direction, tests = 1, 1
+    pipeline = [{"$match": {"patient_id": id_no}},
+                {"$sort": {"number": direction}},
+                {"$project": {"_id": 0, "tests": tests}},
+                {"$unwind": "$tests"}]
+    if test_name is not None:
+        pipeline.append({"$match": {"tests.0": test_name}})
+    if offset > 0:
+        pipeline.append({"$skip": offset})
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    return pipeline
+
+
+def summarize_tests_pipeline(test_name=None, minimum=None, maximum=None):
+    """Builds the aggregation pipeline that summarizes the results of each
+    test for all patients
+
+    The pipeline works on the result buckets:
+
+    1. If `test_name` is given, `$match` keeps only the buckets whose
+       `names` list includes it, using the `names` index of `ResultBucket`,
+       so buckets without that test are not read.
+    2. `$unwind` makes one document for each test, and `$project` splits it
+       into its name and result.
+    3. `$match` keeps only the tests with the given name and with a result
+       in the given range.
+    4. `$group` counts the tests of each name and finds the smallest, largest
+       and mean result, and `$sort` puts the names in order.
+
+    Args:
+        test_name, minimum, maximum: see `MongoStorage.summarize_tests`
+
+    Returns:
+        list of dict: the pipeline
+    """
+    pipeline = []
+    if test_name is not None:
+        pipeline.append({"$match": {"names": test_name}})
+    pipeline.append({"$unwind": "$tests"})
+    pipeline.append({"$project": {
+        "_id": 0, "name": {"$arrayElemAt": ["$tests", 0]},
+        "result": {"$arrayElemAt": ["$tests", 1]}}})
+    conditions = {}
+    if test_name is not None:
+        conditions["name"] = test_name
+    result_range = {}
+    if minimum is not None:
+        result_range["$gte"] = minimum
+    if maximum is not None:
+        result_range["$lte"] = maximum
+    if len(result_range) > 0:
+        conditions["result"] = result_range
+    if len(conditions) > 0:
+        pipeline.append({"$match": conditions})
+    pipeline.append({"$group": {"_id": "$name", "count": {"$sum": 1},
+                                "min": {"$min": "$result"},
+                                "max": {"$max": "$result"},
+                                "mean": {"$avg": "$result"}}})
+    pipeline.append({"$sort": {"_id": 1}})
+    return pipeline
+
+
+class SQLiteStorage:
+    """Stores patient records in a SQLite database
+
+    Two tables are used.  `patients` has one row per patient, with the
+    patient id as its primary key so that looking up a patient uses an
+    index.  `tests` has one row per test result.  Its `seq` column is
+    assigned in increasing order as tests are added and gives the order of
+    the tests, and an index on (patient_id, seq) lets the tests of one
+    patient be found and paged through without reading the rest of the
+    table.  The `version` column of `patients` goes up by 1 whenever tests
+    are added to the patient, see `first_version`.  Indexes on the blood
+    type of the patients and on (test_name, test_result) let the statistics
+    be worked out from the indexes alone.
+
+    A single connection is shared by all the threads of the server, so each
+    method holds a lock while it uses the connection.
+
+    Args:
+        filename (str): database file, or ":memory:" for a database that
+            only exists while the server is running
+
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            blood_type TEXT,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tests (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            test_name TEXT,
+            test_result INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS tests_by_patient
+            ON tests (patient_id, seq);
+        CREATE INDEX IF NOT EXISTS patients_by_blood_type
+            ON patients (blood_type);
+        CREATE INDEX IF NOT EXISTS tests_by_name
+            ON tests (test_name, test_result);
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename,
+                                           check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(self.SCHEMA)
+            columns = [row[1] for row in self._connection.execute(
+                "PRAGMA table_info(patients)")]
+            if "version" not in columns:
+                # Database file made before versions were added
+                self._connection.execute(
+                    "ALTER TABLE patients "
+                    "ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def ping(self):
+        """Checks that the database can be used by running a simple query
+
+        Raises:
+            sqlite3.Error: if the database cannot be used
+        """
+        with self._lock:
+            self._connection.execute("SELECT 1").fetchone()
+
+    def pool_stats(self):
+        """Returns whether the single shared connection is in use
+
+        Returns:
+            dict: with keys "in_use", "open", "available" and "max_size", the
+                same as `MongoStorage.pool_stats`
+        """
+        in_use = 1 if self._lock.locked() else 0
+        return {"in_use": in_use, "open": 1, "available": 1 - in_use,
+                "max_size": 1}
+
+    def add_patient(self, patient_name, id_no, blood_type):
+        """Saves a new patient, replacing any patient with the same id
+
+        Like `MongoStorage.add_patient`, an existing patient with the same id
+        is replaced by a patient with no tests.
+
+        Args:
+            patient_name (str): name of patient
+            id_no (int):  patient id number
+            blood_type (str):  patient blood type, ex. "AB+"
+
+        Returns:
+            Patient: contains the data saved to database
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM tests WHERE patient_id = ?", (id_no,))
+            version = first_version()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO patients "
+                "(id, name, blood_type, version) VALUES (?, ?, ?, ?)",
+                (id_no, patient_name, blood_type, version))
+        return Patient(name=patient_name, id=id_no, blood_type=blood_type,
+                       tests=[], version=version)
+
+    def add_patients(self, patient_list):
+        """Adds many patients in one transaction
+
+        Each insert that fails because the id already exists is recorded and
+        the others continue, the same as the unordered bulk insert of
+        `MongoStorage.add_patients`.
+
+        Args:
+            patient_list (list of dict): dictionaries with the `name`, `id`
+                and `blood_type` of each patient
+
+        Returns:
+            list of int: index in `patient_list` of each patient that was not
+                added because its id already exists
+        """
+        duplicates = []
+        with self._lock, self._connection:
+            for index, patient in enumerate(patient_list):
+                try:
+                    self._connection.execute(
+                        "INSERT INTO patients (id, name, blood_type, version) "
+                        "VALUES (?, ?, ?, ?)",
+                        (patient["id"], patient["name"],
+                         patient["blood_type"], first_version()))
+                except sqlite3.IntegrityError:
+                    duplicates.append(index)
+        return duplicates
+
+    def find_patient(self, id_no):
+        """Retrieves the patient with the given id, including their tests
+
+        Args:
+            id_no (int): id number of patient to be found
+
+        Returns:
+            Patient or bool: Patient instance if found, False if not
+        """
+        return self.find_patient_tests(id_no)
+
+    def patient_version(self, id_no):
+        """Returns the version number of a patient
+
+        Args:
+            id_no (int): id number of the patient
+
+        Returns:
+            int or bool: the version number, or False if the patient was not
+                found
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version FROM patients WHERE id = ?",
+                (id_no,)).fetchone()
+        if row is None:
+            return False
+        return row[0]
+
+    def add_test(self, id_no, test_name, test_result):
+        """Adds a test for a patient
+
+        The version of the patient is increased first.  If no row was
+        changed, the patient does not exist and the test is not added.
+
+        Args:
+            id_no (int): patient id number
+            test_name (str): name of the test
+            test_result (int): result of the test
+
+        Returns:
+            bool: True if the test was added, False if the patient was not
+                found
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE patients SET version = version + 1 WHERE id = ?",
+                (id_no,))
+            if cursor.rowcount == 0:
+                return False
+            self._connection.execute(
+                "INSERT INTO tests (patient_id, test_name, test_result) "
+                "VALUES (?, ?, ?)", (id_no, test_name, test_result))
+        return True
+
+    def add_tests(self, grouped_tests, batch_id=None):
+        """Adds tests for many patients in one transaction
+
+        A failed transaction stores none of the tests, so a batch can be
+        retried without `batch_id`, which is only accepted to match
+        `MongoStorage.add_tests`.
+
+        Args:
+            grouped_tests (dict): keys are patient ids and values are lists
+                of (test name, test result) tuples
+            batch_id (str): not used
+
+        Returns:
+            list of int: the patient ids that were not found
+        """
+        with self._lock, self._connection:
+            existing_ids = self._existing_ids(list(grouped_tests))
+            rows = [(id_no, test_name, test_result)
+                    for id_no, tests in grouped_tests.items()
+                    if id_no in existing_ids
+                    for test_name, test_result in tests]
+            self._connection.executemany(
+                "INSERT INTO tests (patient_id, test_name, test_result) "
+                "VALUES (?, ?, ?)", rows)
+            self._connection.executemany(
+                "UPDATE patients SET version = version + 1 WHERE id = ?",
+                [(id_no,) for id_no in existing_ids])
+        return [id_no for id_no in grouped_tests if id_no not in existing_ids]
+
+    def _existing_ids(self, id_list, chunk_size=500):
+        """Returns the ids in `id_list` that are in the patients table
+
+        The ids are looked up in chunks because SQLite limits the number of
+        values in one statement.  The lock must already be held.
+        """
+        existing_ids = set()
+        for start in range(0, len(id_list), chunk_size):
+            chunk = id_list[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = self._connection.execute(
+                "SELECT id FROM patients WHERE id IN ({})"
+                .format(placeholders), chunk)
+            existing_ids.update(row[0] for row in rows)
+        return existing_ids
+
+    def find_patient_tests(self, id_no, limit=None, offset=0,
+                           newest_first=False, test_name=None):
+        """Retrieves a patient with only a selection of their test results
+
+        The selection is done by the SQL query using the index on
+        (patient_id, seq).
+
+        Args:
+            id_no (int): id number of patient to be found
+            limit (int): largest number of tests to return, or None for all
+            offset (int): number of tests to skip
+            newest_first (bool): if True, the most recent tests come first
+            test_name (str): if given, only tests with this name are returned
+
+        Returns:
+            Patient or bool: Patient instance with the selected tests if
+                found, False if not
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT name, blood_type, version FROM patients WHERE id = ?",
+                (id_no,)).fetchone()
+            if row is None:
+                return False
+            rows = self._select_tests(id_no, limit, offset, newest_first,
+                                      test_name)
+        tests = [[name, result] for name, result, seq in rows]
+        return Patient(name=row[0], id=id_no, blood_type=row[1], tests=tests,
+                       version=row[2])
+
+    def _select_tests(self, id_no, limit, offset, newest_first, test_name,
+                      after_seq=None):
+        """Runs the query that selects tests for `find_patient_tests` and
+        `iter_tests` and returns a list of (test name, test result, seq)
+        tuples.  The lock must already be held.
+
+        If `after_seq` is given, only tests that come after the test with
+        that `seq` (in the requested order) are returned.
+        """
+        query = "SELECT test_name, test_result, seq FROM tests " \
+                "WHERE patient_id = ?"
+        parameters = [id_no]
+        if test_name is not None:
+            query += " AND test_name = ?"
+            parameters.append(test_name)
+        if after_seq is not None:
+            query += " AND seq < ?" if newest_first else " AND seq > ?"
+            parameters.append(after_seq)
+        query += " ORDER BY seq DESC" if newest_first else " ORDER BY seq"
+        query += " LIMIT ? OFFSET ?"
+        parameters += [-1 if limit is None else limit, offset]
+        return self._connection.execute(query, parameters).fetchall()
+
+    def iter_tests(self, id_no, limit=None, offset=0, newest_first=False,
+                   test_name=None, batch_size=100):
+        """Returns an iterator over a selection of a patient's tests
+
+        The tests are read `batch_size` at a time.  Each batch continues
+        after the `seq` of the last test of the previous batch, so the lock
+        is only held while a batch is read and each query uses the index.
+
+        Args:
+            id_no (int): id number of the patient
+            limit, offset, newest_first, test_name: see `find_patient_tests`
+            batch_size (int): number of tests read from the database at a
+                time
+
+        Returns:
+            generator or bool: yields [test name, test result] lists, or
+                False if the patient was not found
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM patients WHERE id = ?", (id_no,)).fetchone()
+        if row is None:
+            return False
+
+        def generate_tests():
+            remaining = limit
+            skip = offset
+            last_seq = None
+            while remaining is None or remaining > 0:
+                size = batch_size if remaining is None \
+                    else min(batch_size, remaining)
+                with self._lock:
+                    rows = self._select_tests(id_no, size, skip,
+                                              newest_first, test_name,
+                                              after_seq=last_seq)
+                if len(rows) == 0:
+                    return
+                for name, result, seq in rows:
+                    yield [name, result]
+                last_seq = rows[-1][2]
+                skip = 0
+                if remaining is not None:
+                    remaining -= len(rows)
+
+        return generate_tests()
+
+    def delete_patient(self, id_no):
+        """Deletes a patient and their tests
+
+        Args:
+            id_no (int): id number of the patient to delete
+
+        Returns:
+            None
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM tests WHERE patient_id = ?", (id_no,))
+            self._connection.execute(
+                "DELETE FROM patients WHERE id = ?", (id_no,))
+
+    def count_blood_types(self):
+        """Counts the patients with each blood type
+
+        Returns:
+            dict: blood types as keys and numbers of patients as values
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT blood_type, COUNT(*) FROM patients "
+                "GROUP BY blood_type ORDER BY blood_type").fetchall()
+        return dict(rows)
+
+    def summarize_tests(self, test_name=None, minimum=None, maximum=None):
+        """Finds the number, smallest, largest and mean result of each test
+
+        See `MongoStorage.summarize_tests`.
+
+        Returns:
+            list of dict: one dictionary per test name, in order of name,
+                with the keys "test_name", "count", "min", "max" and "mean"
+        """
+        conditions = []
+        parameters = []
+        for condition, value in (("test_name = ?", test_name),
+                                 ("test_result >= ?", minimum),
+                                 ("test_result <= ?", maximum)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        where = ""
+        if len(conditions) > 0:
+            where = " WHERE " + " AND ".join(conditions)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT test_name, COUNT(*), MIN(test_result), "
+                "MAX(test_result), AVG(test_result) FROM tests" + where +
+                " GROUP BY test_name ORDER BY test_name",
+                parameters).fetchall()
+        return [{"test_name": name, "count": count, "min": smallest,
+                 "max": largest, "mean": mean}
+                for name, count, smallest, largest, mean in rows]
@@ -0,0 +1,269 @@
+"""Validation of the JSON input received by the health database server
+
+A "schema" describes what the input to a route should look like.  It is a
+dictionary whose keys are the keys needed in the input and whose values
+describe the value each key should have.  A value can be:
+
+* a Python type, such as `str` or `int`, meaning the input value must be of
+  exactly that type
+* a `Field`, for a value that is optional or has extra limits, such as a
+  list of allowed choices or a smallest value
+* another schema dictionary, for a value that is itself a dictionary
+* a `ListOf`, for a value that is a list whose entries are all described by
+  the same type or schema
+
+For example:
+
+    {"name": str, "id": int,
+     "blood_type": Field(str, choices=("A+", "A-", "O+", "O-"))}
+
+`compile_schema` turns a schema into a validator function.  All the work of
+reading the schema is done once, when it is compiled, so that validating each
+request only runs the checks.  Each part of the schema becomes a small check
+function (a closure) holding the types, limits and error messages it needs,
+and these are put together into one function for the whole schema.
+Compiled validators are cached, so compiling the same schema again returns
+the same function.
+
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+
+class Field(namedtuple("Field", ["type", "required", "choices", "minimum",
+                                 "maximum"])):
+    """Describes one value in a schema that needs more than a type check
+
+    Args:
+        type (type or dict or ListOf): the type, schema or list description
+            the value must match
+        required (bool): if False, the key may be missing from the input
+        choices (tuple): if given, the value must be one of these
+        minimum (int or float): if given, the smallest allowed value
+        maximum (int or float): if given, the largest allowed value
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, type, required=True, choices=None, minimum=None,
+                maximum=None):
+        if choices is not None:
+            choices = tuple(choices)
+        return super().__new__(cls, type, required, choices, minimum,
+                               maximum)
+
+
+class ListOf(namedtuple("ListOf", ["item", "max_length"])):
+    """Describes a value that must be a list of entries that all match the
+    same type or schema
+
+    Args:
+        item (type or dict or Field): description of each entry in the list
+        max_length (int): if given, the largest allowed number of entries
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, item, max_length=None):
+        return super().__new__(cls, item, max_length)
+
+
+def compile_schema(schema):
+    """Creates a validator function for a schema
+
+    The validator function receives the input data to a route, after it has
+    been deserialized from JSON, and returns True, 200 if it matches the
+    schema, or an error message and 400 if it does not.  These are the same
+    return values as `health_db_server.validate_server_input`.
+
+    If the schema is a `ListOf`, the validator checks that the input is a
+    list and that every entry matches.
+
+    Args:
+        schema (dict or ListOf): the schema to compile
+
+    Returns:
+        callable: the validator function
+    """
+    return _compile_cached(_freeze(schema))
+
+
+def _freeze(schema):
+    """Converts schema dictionaries into tuples of (key, value) pairs so that
+    a schema can be used as the key of the compiled-validator cache.
+    """
+    if type(schema) is dict:
+        return ("dict", tuple((key, _freeze(value))
+                              for key, value in schema.items()))
+    if type(schema) is Field:
+        return schema._replace(type=_freeze(schema.type))
+    if type(schema) is ListOf:
+        return schema._replace(item=_freeze(schema.item))
+    return schema
+
+
+@lru_cache(maxsize=None)
+def _compile_cached(frozen_schema):
+    check = _compile(frozen_schema, None)
+
+    def validate(in_data):
+        error = check(in_data)
+        if error is not None:
+            return error, 400
+        return True, 200
+
+    return validate
+
+
+def _compile(frozen, key):
+    """Returns a check function for a frozen schema value.  The check
+    function returns None if the value is valid and an error message if it
+    is not.  `key` is the key that holds the value, used in error messages,
+    or None for the whole input.
+    """
+    if type(frozen) is tuple and frozen[:1] == ("dict",):
+        return _compile_dict(frozen[1], key)
+    if type(frozen) is ListOf:
+        return _compile_list(frozen, key)
+    if type(frozen) is Field:
+        return _compile_field(frozen, key)
+    return _compile_type(frozen, key)
+
+
+def _describe(key):
+    """Returns how a value is named in error messages"""
+    if key is None:
+        return "The value"
+    return "The key {}".format(key)
+
+
+def _compile_type(expected_type, key):
+    message = "{} has the wrong data type".format(_describe(key))
+
+    def check_type(value):
+        if type(value) is not expected_type:
+            return message
+        return None
+
+    return check_type
+
+
+def _compile_field(field, key):
+    checks = [_compile(field.type, key)]
+    if field.choices is not None:
+        choices = frozenset(field.choices)
+        choices_message = "{} must be one of {}".format(
+            _describe(key), ", ".join(str(c) for c in field.choices))
+
+        def check_choices(value):
+            if value not in choices:
+                return choices_message
+            return None
+
+        checks.append(check_choices)
+    if field.minimum is not None:
+        minimum = field.minimum
+        minimum_message = "{} must be at least {}".format(_describe(key),
+                                                          minimum)
+
+        def check_minimum(value):
+            if value < minimum:
+                return minimum_message
+            return None
+
+        checks.append(check_minimum)
+    if field.maximum is not None:
+        maximum = field.maximum
+        maximum_message = "{} must be at most {}".format(_describe(key),
+                                                         maximum)
+
+        def check_maximum(value):
+            if value > maximum:
+                return maximum_message
+            return None
+
+        checks.append(check_maximum)
+    if len(checks) == 1:
+        return checks[0]
+
+    def check_field(value):
+        for check in checks:
+            error = check(value)
+            if error is not None:
+                return error
+        return None
+
+    return check_field
+
+
+def _compile_dict(frozen_items, key):
+    """Returns the check function for a dictionary.  Keys whose value only
+    needs a type check are checked in the loop itself, so validating a
+    dictionary of plain types needs a single function call.
+    """
+    if key is None:
+        not_dict_message = "The input was not a dictionary."
+    else:
+        not_dict_message = "The key {} was not a dictionary".format(key)
+    items = []
+    for item_key, item in frozen_items:
+        required = type(item) is not Field or item.required
+        missing_message = "The key {} is missing from input".format(item_key)
+        if type(item) is type:
+            items.append((item_key, required, missing_message, item,
+                          "{} has the wrong data type".format(
+                              _describe(item_key)), None))
+        else:
+            items.append((item_key, required, missing_message, None, None,
+                          _compile(item, item_key)))
+    items = tuple(items)
+
+    def check_dict(value):
+        if type(value) is not dict:
+            return not_dict_message
+        for (item_key, required, missing_message, item_type, type_message,
+             check) in items:
+            try:
+                item = value[item_key]
+            except KeyError:
+                if required:
+                    return missing_message
+                continue
+            if check is None:
+                if type(item) is not item_type:
+                    return type_message
+            else:
+                error = check(item)
+                if error is not None:
+                    return error
+        return None
+
+    return check_dict
+
+
+def _compile_list(list_of, key):
+    if key is None:
+        not_list_message = "The input was not a list."
+        entry_message = "Entry {} of the input: {}"
+        length_message = "The input has more than {} entries".format(
+            list_of.max_length)
+    else:
+        not_list_message = "The key {} was not a list".format(key)
+        entry_message = "Entry {} of key " + str(key) + ": {}"
+        length_message = "The key {} has more than {} entries".format(
+            key, list_of.max_length)
+    max_length = list_of.max_length
+    check_item = _compile(list_of.item, None)
+
+    def check_list(value):
+        if type(value) is not list:
+            return not_list_message
+        if max_length is not None and len(value) > max_length:
+            return length_message
+        for index, entry in enumerate(value):
+            error = check_item(entry)
+            if error is not None:
+                return entry_message.format(index, error)
+        return None
+
+    return check_list
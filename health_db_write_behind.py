@@ -0,0 +1,250 @@
+"""Write-behind queue that combines test results before saving them
+
+When an analyzer sends a burst of results, the same patient can receive many
+/add_test requests within a few milliseconds, and saving each one separately
+means one database update per test.  With write-behind, a test is put in a
+queue in memory and the request is answered straight away.  A background
+thread waits a short time (the "window") so that more tests can arrive, then
+saves everything in the queue at once, grouped by patient, so that each
+patient receives one update no matter how many tests arrived for them.
+
+The queue holds at most `max_pending` tests.  When it is full, new tests are
+refused so that the server can tell the client to try again later instead of
+using more and more memory while the database falls behind.
+
+If saving fails, for example because the database cannot be reached, the
+tests stay in the queue and the thread tries again, waiting longer after
+each failure (`retry_delay`, then twice as long, and so on up to
+`max_retry_delay`) so that a database that is down is not flooded with
+attempts.  A batch that failed is sent again unchanged, with the same batch
+id, before any tests that arrived later, so a storage backend that saved
+part of it the first time can tell which part is already saved.
+
+Tests in the queue have not been saved yet, so they are lost if the process
+is killed.  `close` saves everything still in the queue and should be called
+when the server shuts down.  If the tests still cannot be saved after a few
+tries, they are written to the `dead_letter_path` file, one /add_test input
+dictionary per line, so that they can be sent again later with
+`health_db_loader.py`.
+
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+
+
+class WriteBehindQueue:
+    """Collects test results and saves them in groups from a background
+    thread
+
+    Args:
+        flush_function (callable): called with a dictionary of patient id to
+            list of (test_name, test_result) tuples and a batch id string to
+            save them, such as the `add_tests` method of a storage object
+        window (float): seconds to wait after the first test arrives before
+            saving, so that more tests can be combined with it
+        max_pending (int): largest number of tests that may wait in the queue
+        retry_delay (float): seconds to wait after the first failed save
+        max_retry_delay (float): longest wait between tries
+        dead_letter_path (str): file to which tests that could not be saved
+            by `close` are added, or None to only log them
+
+    """
+    def __init__(self, flush_function, window=0.05, max_pending=10000,
+                 retry_delay=0.1, max_retry_delay=30.0,
+                 dead_letter_path=None):
+        self.flush_function = flush_function
+        self.window = window
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.dead_letter_path = dead_letter_path
+        self.pending = {}
+        self.pending_count = 0
+        self.failed_batch = None
+        self.flushed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.failures = 0
+        self.closed = False
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="write-behind",
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, id_no, test_name, test_result):
+        """Puts a test in the queue to be saved
+
+        Args:
+            id_no (int): id of the patient
+            test_name (str): name of the test
+            test_result (int): result of the test
+
+        Returns:
+            bool: True if the test was queued, False if the queue is full
+
+        Raises:
+            RuntimeError: if the queue has been closed
+        """
+        with self._condition:
+            if self.closed:
+                raise RuntimeError("The write-behind queue is closed")
+            if self.pending_count >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending.setdefault(id_no, []).append((test_name,
+                                                       test_result))
+            self.pending_count += 1
+            if self.pending_count == 1:
+                self._condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self.pending_count == 0 and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                if self._condition.wait_for(lambda: self.closed, self.window):
+                    return
+            self.flush()
+            with self._condition:
+                if self.failures > 0:
+                    self._condition.wait_for(lambda: self.closed,
+                                             self.next_retry_delay())
+
+    def next_retry_delay(self):
+        """Returns the seconds to wait before trying again after the failed
+        saves counted in `failures`"""
+        return min(self.retry_delay * 2 ** (self.failures - 1),
+                   self.max_retry_delay)
+
+    def flush(self):
+        """Saves all the tests in the queue now
+
+        A batch that failed before is given to the flush function again
+        first, and if that works, the other tests in the queue are taken out
+        and given to it as a new batch in one call.  If the flush function
+        raises an exception, the batch is kept as `failed_batch` to be tried
+        again before any other tests, so the order of each patient's tests
+        is kept, and `failures` is increased.  The error is logged on the
+        first failure and then every tenth one, so a database that stays
+        down does not fill the log.
+
+        Returns:
+            int: the number of tests saved
+        """
+        with self._flush_lock:
+            saved = 0
+            for retry in (True, False):
+                with self._condition:
+                    if retry:
+                        batch = self.failed_batch
+                        self.failed_batch = None
+                    elif self.pending_count > 0:
+                        batch = (self.pending, self.pending_count,
+                                 uuid.uuid4().hex)
+                        self.pending = {}
+                    else:
+                        batch = None
+                if batch is None:
+                    continue
+                grouped, count, batch_id = batch
+                try:
+                    self.flush_function(grouped, batch_id)
+                except Exception as err:
+                    with self._condition:
+                        self.failed_batch = batch
+                        self.failures += 1
+                        failures = self.failures
+                    if failures == 1 or failures % 10 == 0:
+                        logging.error("Saving {} queued tests failed {} "
+                                      "times in a row: {}"
+                                      .format(count, failures, err))
+                    return saved
+                with self._condition:
+                    self.pending_count -= count
+                    self.flushed += count
+                    self.failures = 0
+                saved += count
+            return saved
+
+    def close(self, retries=3):
+        """Stops the background thread and saves the tests still queued
+
+        If saving fails, it is tried again up to `retries` more times,
+        waiting as the background thread would.  Tests that still could not
+        be saved are dropped:  they are logged, added to `dead_letter_path`
+        if one was given, and counted in `dropped`.
+
+        Args:
+            retries (int): largest number of extra tries
+
+        Returns:
+            int: the number of tests dropped, 0 if everything was saved
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+        self._thread.join()
+        for attempt in range(retries + 1):
+            self.flush()
+            if self.pending_count == 0 or attempt == retries:
+                break
+            time.sleep(self.next_retry_delay())
+        return self._drop_pending()
+
+    def _drop_pending(self):
+        """Takes the tests out of the queue and writes them to the dead
+        letter file
+
+        Returns:
+            int: the number of tests dropped
+        """
+        with self._condition:
+            batches = [self.pending]
+            if self.failed_batch is not None:
+                batches.insert(0, self.failed_batch[0])
+            count = self.pending_count
+            self.pending = {}
+            self.failed_batch = None
+            self.pending_count = 0
+            self.dropped += count
+        if count == 0:
+            return 0
+        lines = [json.dumps({"id": id_no, "test_name": test_name,
+                             "test_result": test_result}) + "\n"
+                 for grouped in batches
+                 for id_no, tests in grouped.items()
+                 for test_name, test_result in tests]
+        if self.dead_letter_path is not None:
+            try:
+                with open(self.dead_letter_path, "a") as out_file:
+                    out_file.writelines(lines)
+                logging.error("Could not save {} queued tests, they were "
+                              "written to {}".format(count,
+                                                     self.dead_letter_path))
+                return count
+            except OSError as err:
+                logging.error("Could not write {}: {}"
+                              .format(self.dead_letter_path, err))
+        logging.error("Could not save {} queued tests, they were dropped:\n{}"
+                      .format(count, "".join(lines)))
+        return count
+
+    def stats(self):
+        """Returns counts describing the queue
+
+        Returns:
+            dict: with keys "pending", "max_pending", "flushed", "rejected",
+                "dropped" and "failures"
+        """
+        with self._condition:
+            return {"pending": self.pending_count,
+                    "max_pending": self.max_pending,
+                    "flushed": self.flushed, "rejected": self.rejected,
+                    "dropped": self.dropped, "failures": self.failures}
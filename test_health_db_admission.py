@@ -0,0 +1,44 @@
+import threading
+
+
+def test_admission_limiter_rejects_when_full():
+    from health_db_admission import AdmissionLimiter
+    limiter = AdmissionLimiter(2, max_waiting=0)
+    answer = [limiter.acquire() for i in range(3)]
+    assert answer == [True, True, False]
+    limiter.release()
+    assert limiter.acquire() is True
+    assert limiter.stats() == {"active": 2, "waiting": 0, "max_active": 2,
+                               "max_waiting": 0, "admitted": 3,
+                               "rejected": 1}
+
+
+def test_admission_limiter_no_limit():
+    from health_db_admission import AdmissionLimiter
+    limiter = AdmissionLimiter(0)
+    assert all(limiter.acquire() for i in range(100))
+
+
+def test_admission_limiter_wait_timeout():
+    from health_db_admission import AdmissionLimiter
+    limiter = AdmissionLimiter(1, max_waiting=1, wait_timeout=0.01)
+    limiter.acquire()
+    assert limiter.acquire() is False
+    assert limiter.stats()["waiting"] == 0
+
+
+def test_admission_limiter_waits_for_release():
+    from health_db_admission import AdmissionLimiter
+    limiter = AdmissionLimiter(1, max_waiting=1, wait_timeout=5)
+    limiter.acquire()
+    answers = []
+    waiter = threading.Thread(target=lambda: answers.append(
+        limiter.acquire()))
+    waiter.start()
+    while limiter.stats()["waiting"] == 0:
+        pass
+    assert limiter.acquire() is False
+    limiter.release()
+    waiter.join()
+    assert answers == [True]
+    assert limiter.stats()["active"] == 1
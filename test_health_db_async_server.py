@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    """Gives the async server an empty in-memory database for each test,
+    without the log file set up by `initialize_server`
+    """
+    import health_db_async_server
+    from health_db_async_storage import create_async_storage
+    monkeypatch.setattr(health_db_async_server, "storage",
+                        create_async_storage("memory"))
+    health_db_async_server.patient_cache.clear()
+    yield
+    health_db_async_server.patient_cache.clear()
+
+
+def run_requests(request_list):
+    """Sends each (method, url, json) request to the async server in order
+    using the Quart test client and returns a list of (status code, text)
+    """
+    from health_db_async_server import app
+
+    async def send_all():
+        client = app.test_client()
+        answers = []
+        for method, url, json in request_list:
+            if method == "post":
+                response = await client.post(url, json=json)
+            else:
+                response = await client.get(url)
+            answers.append((response.status_code,
+                            await response.get_data(as_text=True)))
+        return answers
+
+    return asyncio.run(send_all())
+
+
+def test_status():
+    answer = run_requests([("get", "/", None)])
+    assert answer == [(200, "Server is on")]
+
+
+@pytest.mark.parametrize("test_id, expected", [
+    (30001, (200, "Added test to patient id 30001")),
+    (30002, (400, "Patient ID 30002 not found in database"))
+])
+def test_add_test(test_id, expected):
+    answer = run_requests([
+        ("post", "/new_patient",
+         {"name": "David Testing", "id": 30001, "blood_type": "O+"}),
+        ("post", "/add_test",
+         {"id": test_id, "test_name": "HDL", "test_result": 50})])
+    assert answer[0][0] == 200
+    assert answer[1] == expected
+
+
+def test_get_results():
+    answer = run_requests([
+        ("post", "/new_patient",
+         {"name": "David Testing", "id": 30003, "blood_type": "O+"}),
+        ("post", "/add_test",
+         {"id": 30003, "test_name": "HDL", "test_result": 50}),
+        ("post", "/add_test",
+         {"id": 30003, "test_name": "LDL", "test_result": 80}),
+        ("get", "/get_results/30003", None),
+        ("get", "/get_results/30003?order=newest&limit=1", None)])
+    assert answer[3] == (200, "Patient Name: David Testing\n"
+                              "Test Results:\n"
+                              "['HDL', 50]\n"
+                              "['LDL', 80]\n")
+    assert answer[4] == (200, "Patient Name: David Testing\n"
+                              "Test Results:\n"
+                              "['LDL', 80]\n")
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("/get_results/dog", (400, "Patient id was not a valid integer")),
+    ("/get_results/30999",
+     (400, "Patient id of 30999 does not exist in database")),
+    ("/get_results/30999?limit=0", (400, "limit must be a positive integer"))
+])
+def test_get_results_errors(url, expected):
+    answer = run_requests([("get", url, None)])
+    assert answer == [expected]
+
+
+def test_new_patient_validation():
+    answer = run_requests([("post", "/new_patient",
+                            {"name": "David Testing", "id": "1",
+                             "blood_type": "O+"})])
+    assert answer == [(400, "The key id has the wrong data type")]
@@ -0,0 +1,99 @@
+import pytest
+
+
+def test_patient_cache_get_put():
+    from health_db_cache import PatientCache
+    cache = PatientCache(max_size=5, ttl=30)
+    cache.put(1, "patient one")
+    assert cache.get(1) == "patient one"
+    assert cache.get(2) is None
+    assert cache.stats() == {"size": 1, "max_size": 5, "hits": 1,
+                             "misses": 1}
+
+
+def test_patient_cache_negative_entry():
+    from health_db_cache import PatientCache
+    cache = PatientCache()
+    cache.put(1, False)
+    assert cache.get(1) is False
+
+
+def test_patient_cache_least_recently_used_removed():
+    from health_db_cache import PatientCache
+    cache = PatientCache(max_size=2, ttl=30)
+    cache.put(1, "one")
+    cache.put(2, "two")
+    cache.get(1)
+    cache.put(3, "three")
+    assert cache.get(2) is None
+    assert cache.get(1) == "one"
+    assert cache.get(3) == "three"
+
+
+def test_patient_cache_expired():
+    from health_db_cache import PatientCache
+    cache = PatientCache(max_size=2, ttl=-1)
+    cache.put(1, "one")
+    assert cache.get(1) is None
+    assert cache.stats()["size"] == 0
+
+
+@pytest.mark.parametrize("max_size, expected", [
+    (0, None),
+    (1, "one")
+])
+def test_patient_cache_size(max_size, expected):
+    from health_db_cache import PatientCache
+    cache = PatientCache(max_size=max_size)
+    cache.put(1, "one")
+    assert cache.get(1) == expected
+
+
+def test_patient_cache_invalidate():
+    from health_db_cache import PatientCache
+    cache = PatientCache()
+    cache.put(1, "one")
+    cache.invalidate(1)
+    cache.invalidate(2)
+    assert cache.get(1) is None
+
+
+def test_patient_cache_stale_put_skipped():
+    from health_db_cache import PatientCache
+    cache = PatientCache()
+    cache.put(1, "old")
+    generation = cache.generation()
+    cache.invalidate(1)
+    assert cache.put(1, "read before change", generation) is False
+    assert cache.get(1) is None
+    assert cache.put(1, "read after change", cache.generation()) is True
+    assert cache.get(1) == "read after change"
+
+
+def test_patient_cache_readers_do_not_block_each_other():
+    from health_db_cache import PatientCache
+    cache = PatientCache()
+    first = cache.generation()
+    second = cache.generation()
+    assert cache.put(1, "read by second", second) is True
+    assert cache.put(1, "read by first", first) is True
+    assert cache.put(1, "saved", cache.generation(), changed=True) is True
+    assert cache.put(1, "read before save", first) is False
+    assert cache.get(1) == "saved"
+
+
+def test_patient_cache_stale_put_after_clear():
+    from health_db_cache import PatientCache
+    cache = PatientCache()
+    generation = cache.generation()
+    cache.clear()
+    assert cache.put(2, "two", generation) is False
+
+
+def test_patient_cache_negative_ttl():
+    from health_db_cache import PatientCache
+    cache = PatientCache(ttl=30, negative_ttl=-1)
+    cache.put(1, False)
+    cache.put(2, "two")
+    assert cache.get(1) is None
+    assert cache.get(2) == "two"
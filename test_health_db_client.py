@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+
+@pytest.fixture
+def flaky_server():
+    """Runs a small HTTP server that answers 503 to the first two requests
+    and then 200, and records the method of each request
+    """
+    calls = []
+
+    @Request.application
+    def application(request):
+        calls.append(request.method)
+        if len(calls) <= 2:
+            return Response("busy", status=503)
+        return Response("ok")
+
+    server = make_server("127.0.0.1", 0, application, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_port), calls
+    server.shutdown()
+
+
+def test_client_retries_get(flaky_server):
+    from health_db_client import HealthDbClient
+    url, calls = flaky_server
+    with HealthDbClient(url, backoff_factor=0) as client:
+        r = client.get_results(201)
+    assert r.status_code == 200
+    assert calls == ["GET", "GET", "GET"]
+
+
+def test_client_does_not_retry_post(flaky_server):
+    from health_db_client import HealthDbClient
+    url, calls = flaky_server
+    with HealthDbClient(url, backoff_factor=0) as client:
+        r = client.add_test(201, "HDL", 160)
+    assert r.status_code == 503
+    assert calls == ["POST"]
+
+
+def test_client_base_url(monkeypatch):
+    from health_db_client import HealthDbClient
+    monkeypatch.setenv("HEALTH_DB_SERVER_URL", "http://example.com:8000/")
+    client = HealthDbClient()
+    assert client.base_url == "http://example.com:8000"
+
+
+def test_add_patient_to_server_spool(server_url, tmp_path, monkeypatch):
+    import health_db_client
+    import health_db_server
+    from health_db_client import HealthDbClient, add_patient_to_server
+    monkeypatch.setenv("HEALTH_DB_CLIENT_SPOOL", str(tmp_path))
+    monkeypatch.setattr(health_db_client, "default_client",
+                        HealthDbClient(server_url))
+    monkeypatch.setattr(health_db_client, "default_spool", None)
+    answer = add_patient_to_server("Ann Ables", "201", "A+")
+    assert health_db_client.default_spool.close() is True
+    assert answer == "Patient 201 saved, it will be sent to the server"
+    assert health_db_server.storage.find_patient(201).name == "Ann Ables"
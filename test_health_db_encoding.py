@@ -0,0 +1,36 @@
+import pytest
+from werkzeug.datastructures import MIMEAccept
+
+
+@pytest.mark.parametrize("accept, format_name, allowed, expected", [
+    ([], None, ("text", "json", "msgpack"), "text"),
+    ([("*/*", 1)], None, ("text", "json", "msgpack"), "text"),
+    ([("application/json", 1)], None, ("text", "json", "msgpack"), "json"),
+    ([("application/x-msgpack", 1)], None, ("text", "json", "msgpack"),
+     "msgpack"),
+    ([("application/json", 0.5), ("application/msgpack", 1)], None,
+     ("text", "json", "msgpack"), "msgpack"),
+    ([("application/json", 1)], "text", ("text", "json", "msgpack"),
+     "text"),
+    ([], "msgpack", ("text", "json", "msgpack"), "msgpack"),
+    ([], "ndjson", ("text", "json", "msgpack"), "text"),
+    ([("application/x-ndjson", 1)], None, ("text", "ndjson"), "ndjson"),
+    ([("image/png", 1)], None, ("text", "json"), "text")
+])
+def test_choose_encoding(accept, format_name, allowed, expected):
+    from health_db_encoding import choose_encoding
+    answer = choose_encoding(MIMEAccept(accept), format_name, allowed)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("encoding", ["json", "msgpack"])
+def test_encode(encoding):
+    import json
+    import msgpack
+    from health_db_encoding import encode
+    data = {"name": "Ann", "tests": [{"test_name": "HDL", "test_result": 5}]}
+    answer = encode(data, encoding)
+    if encoding == "json":
+        assert json.loads(answer) == data
+    else:
+        assert msgpack.unpackb(answer) == data
@@ -0,0 +1,51 @@
+import threading
+import time
+
+
+class FakeAfter:
+    """Stands in for `root.after` and keeps the scheduled functions so that
+    a test can run them as the tkinter main loop would
+    """
+    def __init__(self):
+        self.scheduled = []
+
+    def __call__(self, milliseconds, function):
+        self.scheduled.append(function)
+
+    def run_until_idle(self):
+        while self.scheduled:
+            function = self.scheduled.pop(0)
+            time.sleep(0.01)
+            function()
+
+
+def test_task_runner_calls_back():
+    from health_db_gui_tasks import TaskRunner
+    after = FakeAfter()
+    runner = TaskRunner(after)
+    answers = []
+    errors = []
+    runner.submit(lambda x: x * 2, (21,), on_done=answers.append)
+    runner.submit(lambda: 1 / 0, on_error=errors.append)
+    assert len(after.scheduled) == 1
+    after.run_until_idle()
+    assert answers == [42]
+    assert type(errors[0]) is ZeroDivisionError
+    assert runner.busy() is False
+    assert runner.polling is False
+
+
+def test_task_runner_close():
+    from health_db_gui_tasks import TaskRunner
+    after = FakeAfter()
+    runner = TaskRunner(after, max_workers=1)
+    release = threading.Event()
+    answers = []
+    first = runner.submit(release.wait, on_done=answers.append)
+    second = runner.submit(lambda: "late", on_done=answers.append)
+    runner.close()
+    release.set()
+    first.result()
+    after.run_until_idle()
+    assert second.cancelled()
+    assert answers == []
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+from PIL import Image
+
+
+@pytest.mark.parametrize("size, box, expected", [
+    ((800, 600), (400, 300), (400, 300)),
+    ((850, 559), (400, 300), (400, 263)),
+    ((415, 415), (400, 300), (300, 300)),
+    ((100, 50), (400, 300), (400, 200)),
+    ((5000, 10), (400, 300), (400, 1))
+])
+def test_fit_size(size, box, expected):
+    from health_db_images import fit_size
+    assert fit_size(size, box) == expected
+
+
+def test_decode_image_jpeg(tmp_path):
+    from health_db_images import decode_image
+    filename = str(tmp_path / "large.jpeg")
+    Image.new("RGB", (2000, 1000), "red").save(filename)
+    answer = decode_image(filename, (400, 300))
+    assert answer.size == (400, 200)
+    assert answer.getpixel((200, 100))[0] > 200
+
+
+def test_image_cache(tmp_path):
+    from health_db_images import ImageCache
+    first = str(tmp_path / "first.png")
+    second = str(tmp_path / "second.png")
+    Image.new("RGB", (100, 100), "blue").save(first)
+    Image.new("RGB", (100, 100), "green").save(second)
+    cache = ImageCache(max_bytes=100 * 100 * 3)
+    image1 = cache.get(first, (100, 100))
+    image2 = cache.get(first, (100, 100))
+    cache.get(first, (50, 50))
+    cache.get(second, (100, 100))
+    stats = cache.stats()
+    assert image1 is image2
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
+    assert stats["images"] == 1
+    assert stats["bytes"] == 100 * 100 * 3
+    Image.new("RGB", (100, 100), "white").save(second)
+    os.utime(second, ns=(1, 1))
+    assert cache.get(second, (100, 100)).getpixel((0, 0)) == (255, 255, 255)
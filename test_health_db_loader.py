@@ -0,0 +1,89 @@
+import json
+
+
+def test_convert_record():
+    from health_db_loader import convert_record
+    answer = convert_record({"id": "12", "test_name": "HDL",
+                             "test_result": "high"})
+    assert answer == {"id": 12, "test_name": "HDL", "test_result": "high"}
+
+
+def test_load_progress():
+    from health_db_loader import LoadProgress
+    progress = LoadProgress(10)
+    assert progress.finish(20, 10) is False
+    assert progress.done == 10
+    assert progress.finish(10, 10) is True
+    assert progress.done == 30
+
+
+def test_load_file(server_url, tmp_path):
+    import health_db_server
+    from health_db_client import HealthDbClient
+    from health_db_loader import load_file
+    patients = tmp_path / "patients.csv"
+    patients.write_text("name,id,blood_type\n"
+                        "Ann Ables,1,A+\nBob Boyles,2,O-\n"
+                        "Chris Cooper,2,AB+\nDee Dodd,4,B+\n")
+    tests = tmp_path / "tests.ndjson"
+    tests.write_text("\n".join(json.dumps({"id": i % 5, "test_name": "HDL",
+                                           "test_result": i})
+                               for i in range(1, 11)) + "\n")
+    checkpoint = str(tmp_path / "tests.checkpoint")
+    failures = tmp_path / "failures.ndjson"
+    with HealthDbClient(server_url) as client:
+        answer1 = load_file(client, str(patients), batch_size=2,
+                            concurrency=2, failures=str(failures))
+        answer2 = load_file(client, str(tests), batch_size=3, concurrency=2,
+                            checkpoint=checkpoint)
+        answer3 = load_file(client, str(tests), checkpoint=checkpoint)
+    assert answer1["sent"] == 4
+    assert answer1["failed"] == 1
+    assert json.loads(failures.read_text())["record"]["id"] == 2
+    assert answer2["sent"] == 10
+    assert answer2["failed"] == 4
+    assert answer3["skipped"] == 10
+    assert answer3["sent"] == 0
+    assert sorted(health_db_server.storage.find_patient(1).tests) == [
+        ["HDL", 1], ["HDL", 6]]
+
+
+class FakeAnswer:
+    status_code = 200
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def json(self):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class BadAnswerClient:
+    """Answers every batch with 200, but the second batch's answer is not
+    JSON"""
+    def __init__(self):
+        self.batches = []
+
+    def post(self, path, batch):
+        self.batches.append(batch)
+        if len(self.batches) == 2:
+            return FakeAnswer(ValueError("not JSON"))
+        return FakeAnswer({"errors": [], "unknown_ids": []})
+
+
+def test_load_file_bad_answer(tmp_path):
+    from health_db_loader import load_file
+    tests = tmp_path / "tests.ndjson"
+    tests.write_text("\n".join(json.dumps({"id": 1, "test_name": "HDL",
+                                           "test_result": i})
+                               for i in range(6)) + "\n")
+    failures = tmp_path / "failures.ndjson"
+    answer = load_file(BadAnswerClient(), str(tests), batch_size=2,
+                       concurrency=1, failures=str(failures))
+    lines = [json.loads(line) for line in failures.read_text().splitlines()]
+    assert answer["sent"] == 6
+    assert answer["failed"] == 2
+    assert [line["record"]["test_result"] for line in lines] == [2, 3]
+    assert lines[0]["message"] == "ValueError: not JSON"
@@ -0,0 +1,59 @@
+import pytest
+
+
+@pytest.mark.parametrize("values, fraction, expected", [
+    ([], 0.5, 0.0),
+    ([1, 2, 3, 4], 0.5, 2),
+    ([1, 2, 3, 4], 0.95, 4),
+    (list(range(1, 101)), 0.99, 99),
+    ([5], 0.0, 5)
+])
+def test_percentile(values, fraction, expected):
+    from health_db_loadtest import percentile
+    answer = percentile(values, fraction)
+    assert answer == expected
+
+
+def test_run_load_test():
+    import health_db_server
+    from health_db_loadtest import run_load_test
+    original_storage = health_db_server.storage
+    answer = run_load_test(number_of_requests=40, concurrency=4,
+                           history_size=5, number_of_patients=3)
+    assert health_db_server.storage is original_storage
+    assert answer["errors"] == 0
+    assert answer["total"]["requests"] == 40
+    assert sum(route["requests"]
+               for route in answer["routes"].values()) == 40
+    assert set(answer["total"]) == {"requests", "requests_per_second",
+                                    "p50_ms", "p95_ms", "p99_ms"}
+
+
+def make_results(p95, rate):
+    summary = {"requests": 10, "requests_per_second": rate,
+               "p50_ms": 1.0, "p95_ms": p95, "p99_ms": 5.0}
+    return {"total": summary, "routes": {"add_test": summary}}
+
+
+@pytest.mark.parametrize("current, expected", [
+    (make_results(2.0, 100), []),
+    (make_results(2.1, 95), []),
+    (make_results(3.0, 100), ["total p95_ms rose from 2.00 to 3.00",
+                              "add_test p95_ms rose from 2.00 to 3.00"]),
+    (make_results(2.0, 50), ["total requests_per_second fell from 100.0 "
+                             "to 50.0",
+                             "add_test requests_per_second fell from 100.0 "
+                             "to 50.0"])
+])
+def test_compare_results(current, expected):
+    from health_db_loadtest import compare_results
+    answer = compare_results(make_results(2.0, 100), current)
+    assert answer == expected
+
+
+def test_save_and_load_results(tmp_path):
+    from health_db_loadtest import save_results, load_results
+    results = make_results(2.0, 100)
+    filename = str(tmp_path / "results.json")
+    save_results(results, filename)
+    assert load_results(filename) == results
@@ -0,0 +1,68 @@
+import logging
+import queue
+
+
+def make_record(name="test", level=logging.DEBUG, message="message"):
+    return logging.makeLogRecord({"name": name, "levelno": level,
+                                  "levelname": logging.getLevelName(level),
+                                  "msg": message})
+
+
+def test_sampling_filter():
+    from health_db_logging import SamplingFilter
+    skipped = []
+    sampler = SamplingFilter(every=3, on_skip=lambda: skipped.append(1))
+    kept = [sampler.filter(make_record()) for i in range(7)]
+    other = sampler.filter(make_record(name="other"))
+    warning = [sampler.filter(make_record(level=logging.WARNING))
+               for i in range(3)]
+    assert kept == [True, False, False, True, False, False, True]
+    assert other is True
+    assert warning == [True, True, True]
+    assert sampler.skipped == 4
+    assert len(skipped) == 4
+
+
+def test_dropping_queue_handler():
+    from health_db_logging import DroppingQueueHandler
+    dropped = []
+    handler = DroppingQueueHandler(queue.Queue(2),
+                                   on_drop=lambda: dropped.append(1))
+    for i in range(5):
+        handler.handle(make_record(level=logging.INFO))
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+    assert len(dropped) == 3
+
+
+def test_queued_logging(tmp_path):
+    from health_db_logging import QueuedLogging
+    filename = tmp_path / "server.log"
+    log = QueuedLogging(str(filename), level=logging.DEBUG,
+                        levels={"test_health_db_logging.quiet": "WARNING"},
+                        debug_sample=2)
+    log.start()
+    for i in range(4):
+        logging.getLogger("test_health_db_logging").debug("debug %d", i)
+    logging.getLogger("test_health_db_logging.quiet").info("not shown")
+    logging.getLogger("test_health_db_logging").error("an error")
+    stats = log.stats()
+    log.stop()
+    root = logging.getLogger()
+    assert log.handler not in root.handlers
+    root.setLevel(logging.WARNING)
+    text = filename.read_text()
+    assert "debug 0" in text
+    assert "debug 1" not in text
+    assert "debug 2" in text
+    assert "not shown" not in text
+    assert "ERROR test_health_db_logging: an error" in text
+    assert stats["sampled_out"] == 2
+    assert stats["dropped"] == 0
+
+
+def test_parse_levels():
+    from health_db_logging import parse_levels
+    assert parse_levels("") == {}
+    assert parse_levels("werkzeug=warning, pymongo=INFO") == {
+        "werkzeug": "WARNING", "pymongo": "INFO"}
@@ -0,0 +1,71 @@
+import pytest
+
+
+def test_counter_render():
+    from health_db_metrics import Counter
+    counter = Counter("requests_total", "Requests", ("route", "status"))
+    counter.inc("/b", "200")
+    counter.inc("/a", "400")
+    counter.inc("/b", "200", amount=2)
+    answer = counter.render()
+    assert answer == ['requests_total{route="/a",status="400"} 1',
+                      'requests_total{route="/b",status="200"} 3']
+
+
+def test_gauge_render():
+    from health_db_metrics import Gauge
+    gauge = Gauge("waiting", "Waiting", ("group",),
+                  lambda: {("write",): 2, ("read",): 0})
+    answer = gauge.render()
+    assert answer == ['waiting{group="read"} 0', 'waiting{group="write"} 2']
+
+
+def test_histogram_render():
+    from health_db_metrics import Histogram
+    histogram = Histogram("latency", "Latency", ("route",),
+                          buckets=(0.1, 1))
+    histogram.observe(0.05, "/")
+    histogram.observe(0.1, "/")
+    histogram.observe(0.5, "/")
+    histogram.observe(3, "/")
+    answer = histogram.render()
+    assert answer == ['latency_bucket{route="/",le="0.1"} 2',
+                      'latency_bucket{route="/",le="1"} 3',
+                      'latency_bucket{route="/",le="+Inf"} 4',
+                      'latency_sum{route="/"} 3.65',
+                      'latency_count{route="/"} 4']
+
+
+def test_histogram_time():
+    from health_db_metrics import Histogram
+    histogram = Histogram("latency", "Latency", ("function",))
+
+    @histogram.time("fails")
+    def fails():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        fails()
+    assert histogram.render()[-1] == 'latency_count{function="fails"} 1'
+
+
+@pytest.mark.parametrize("label, expected", [
+    ("plain", 'name{label="plain"} 1'),
+    ('say "hi"', 'name{label="say \\"hi\\""} 1'),
+    ("back\\slash\n", 'name{label="back\\\\slash\\n"} 1')
+])
+def test_label_escaping(label, expected):
+    from health_db_metrics import Counter
+    counter = Counter("name", "Help", ("label",))
+    counter.inc(label)
+    assert counter.render() == [expected]
+
+
+def test_registry_render():
+    from health_db_metrics import MetricsRegistry
+    registry = MetricsRegistry()
+    registry.counter("things_total", "Number of things").inc()
+    answer = registry.render()
+    assert answer == ("# HELP things_total Number of things\n"
+                      "# TYPE things_total counter\n"
+                      "things_total 1\n")
@@ -0,0 +1,19 @@
+import pytest
+
+
+@pytest.mark.parametrize("number_of_tests, expected", [
+    (0, []),
+    (2, [(-1, 2)]),
+    (3, [(-1, 3)]),
+    (7, [(-3, 3), (-2, 3), (-1, 1)])
+])
+def test_legacy_buckets(number_of_tests, expected, monkeypatch):
+    import health_db_migrate
+    from health_db_migrate import legacy_buckets
+    monkeypatch.setattr(health_db_migrate, "BUCKET_SIZE", 3)
+    tests = [["HDL", result] for result in range(number_of_tests)]
+    answer = legacy_buckets(12345, tests)
+    assert [(bucket["number"], bucket["count"])
+            for bucket in answer] == expected
+    assert [test for bucket in answer for test in bucket["tests"]] == tests
+    assert all(bucket["patient_id"] == 12345 for bucket in answer)
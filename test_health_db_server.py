@@ -1,7 +1,48 @@
+import os
 import pytest
 from health_db_server import initialize_server
 
-initialize_server()
+# The tests use a SQLite database kept in memory so that they can run without
+# a network connection.  To run them against MongoDB instead, set the
+# environment variable HEALTH_DB_TEST_BACKEND to "mongodb".
+initialize_server(os.environ.get("HEALTH_DB_TEST_BACKEND", "memory"))
+
+
+def delete_entry(patient):
+    """Deletes a patient that was added to the database for a test
+    """
+    from health_db_server import storage
+    storage.delete_patient(patient.id)
+
+
+class StorageCallCounter:
+    """Stands in for the storage object and records the name of every method
+    called on it before passing the call on, so that tests can check how many
+    trips to the database a route makes.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def counted_method(*args, **kwargs):
+            self.calls.append(name)
+            return method(*args, **kwargs)
+
+        return counted_method
+
+
+@pytest.fixture(autouse=True)
+def empty_patient_cache():
+    """The tests delete their database entries directly with
+    `delete_entry()`, which the patient cache does not know about.  So, the
+    cache is emptied before each test to make sure every test starts from the
+    database.
+    """
+    from health_db_server import patient_cache
+    patient_cache.clear()
 
 
 @pytest.mark.parametrize("in_data, expected", [
@@ -29,11 +70,30 @@ def test_add_database_entry():
     from health_db_server import add_database_entry
     expected_name = "David Testing"
     answer = add_database_entry(expected_name, 5, "O+")
-    answer.delete()  # This deletes the entry in the database, it does not
-    # delete the answer variable
+    delete_entry(answer)  # This deletes the entry in the database, it does
+    # not delete the answer variable
     assert answer.name == expected_name
 
 
+def test_add_database_entries():
+    from health_db_server import add_database_entries
+    from health_db_server import add_database_entry
+    from health_db_server import find_patient
+    existing = add_database_entry("David Testing", 12345, "O+")
+    patient_list = [{"name": "New One", "id": 12346, "blood_type": "A+"},
+                    {"name": "Repeat", "id": 12345, "blood_type": "B-"},
+                    {"name": "New Two", "id": 12347, "blood_type": "AB+"}]
+    answer = add_database_entries(patient_list)
+    first_added = find_patient(12346)
+    second_added = find_patient(12347)
+    not_changed = find_patient(12345)
+    delete_entry(existing)
+    delete_entry(first_added)
+    delete_entry(second_added)
+    assert answer == [1]
+    assert not_changed.name == "David Testing"
+
+
 def test_find_patient():
     from health_db_server import find_patient
     from health_db_server import add_database_entry
@@ -41,7 +101,7 @@ def test_find_patient():
     expected_id = 12345
     entry_to_delete = add_database_entry(expected_name, expected_id, "O+")
     answer = find_patient(expected_id)
-    entry_to_delete.delete()
+    delete_entry(entry_to_delete)
     assert answer.id == expected_id
     assert answer.name == expected_name
 
@@ -54,14 +114,97 @@ def test_find_patient_missing():
     assert answer is False
 
 
+def test_find_patient_uses_cache():
+    from health_db_server import find_patient
+    from health_db_server import add_database_entry
+    from health_db_server import patient_cache
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    patient_cache.clear()
+    first = find_patient(12345)
+    second = find_patient(12345)
+    delete_entry(entry_to_delete)
+    assert first is second
+    assert patient_cache.stats()["hits"] == 1
+    assert patient_cache.stats()["misses"] == 1
+
+
+def test_find_patient_caches_missing():
+    from health_db_server import find_patient
+    from health_db_server import add_database_entry
+    find_patient(12345)
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    answer = find_patient(12345)
+    delete_entry(entry_to_delete)
+    assert answer.name == "David Testing"
+
+
+def test_find_patient_changed_while_reading(monkeypatch):
+    import health_db_server
+    from health_db_server import find_patient, add_database_entry
+    from health_db_server import add_test_result, patient_cache
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    patient_cache.clear()
+    storage_find_patient = health_db_server.storage.find_patient
+
+    def find_then_add_test(id_no):
+        patient = storage_find_patient(id_no)
+        add_test_result({"id": 12345, "test_name": "HDL", "test_result": 1})
+        return patient
+
+    monkeypatch.setattr(health_db_server.storage, "find_patient",
+                        find_then_add_test)
+    stale = find_patient(12345)
+    monkeypatch.undo()
+    answer = find_patient(12345)
+    delete_entry(entry_to_delete)
+    assert stale.tests == []
+    assert answer.tests == [["HDL", 1]]
+
+
 def test_add_test_result():
     from health_db_server import add_test_result
     from health_db_server import add_database_entry
-    add_database_entry("David Testing", 12345, "O+")
+    from health_db_server import find_patient
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
     out_data = {"id": 12345, "test_name": "HDL", "test_result": 123}
     answer = add_test_result(out_data)
-    answer.delete()
-    assert answer.tests[-1] == ("HDL", 123)
+    patient = find_patient(12345)
+    delete_entry(entry_to_delete)
+    assert answer is True
+    assert patient.tests[-1] == ["HDL", 123]
+
+
+def test_add_test_result_missing():
+    from health_db_server import add_test_result
+    out_data = {"id": 56451897, "test_name": "HDL", "test_result": 123}
+    answer = add_test_result(out_data)
+    assert answer is False
+
+
+def test_group_tests_by_patient():
+    from health_db_server import group_tests_by_patient
+    test_list = [{"id": 2, "test_name": "HDL", "test_result": 50},
+                 {"id": 1, "test_name": "LDL", "test_result": 120},
+                 {"id": 2, "test_name": "LDL", "test_result": 80}]
+    answer = group_tests_by_patient(test_list)
+    expected = {2: [("HDL", 50), ("LDL", 80)], 1: [("LDL", 120)]}
+    assert answer == expected
+    assert list(answer) == [2, 1]
+
+
+def test_add_test_results():
+    from health_db_server import add_test_results
+    from health_db_server import add_database_entry
+    from health_db_server import find_patient
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    test_list = [{"id": 12345, "test_name": "HDL", "test_result": 50},
+                 {"id": 56451897, "test_name": "HDL", "test_result": 60},
+                 {"id": 12345, "test_name": "LDL", "test_result": 80}]
+    answer = add_test_results(test_list)
+    patient = find_patient(12345)
+    delete_entry(entry_to_delete)
+    assert answer == (2, [56451897])
+    assert patient.tests == [["HDL", 50], ["LDL", 80]]
 
 
 @pytest.mark.parametrize("id_to_add, id_to_search, expected", [
@@ -73,14 +216,17 @@ def test_validate_patient_id(id_to_add, id_to_search, expected):
     from health_db_server import validate_patient_id
     from health_db_server import add_database_entry
     entry_to_delete = add_database_entry("David Testing", id_to_add, "O+")
-    answer = validate_patient_id(id_to_search)
-    entry_to_delete.delete()
-    assert answer == expected
+    answer, status_code = validate_patient_id(id_to_search)
+    delete_entry(entry_to_delete)
+    if status_code == 200:
+        answer = answer.id
+    assert (answer, status_code) == expected
 
 
 def test_generate_results():
     from health_db_server import generate_results
     from health_db_server import add_database_entry
+    from health_db_server import find_patient
     from health_db_server import add_test_result
     entry_to_delete = add_database_entry("David Testing", 12345, "O+")
     out_data = {"id": 12345, "test_name": "HDL", "test_result": 123}
@@ -88,16 +234,374 @@ def test_generate_results():
     out_data["test_name"] = "LDL"
     out_data["test_result"] = 50
     add_test_result(out_data)
-    answer = generate_results(12345)
+    answer = generate_results(find_patient(12345))
     expected = "Patient Name: David Testing\n" \
                "Test Results:\n" \
                "['HDL', 123]\n" \
                "['LDL', 50]\n"
     """Note that even though the data were initially put into the record
-       as tuples, MongoDB stores all "array"-type variables the same and 
+       as tuples, MongoDB stores all "array"-type variables the same and
        they are returned as lists to Python."""
-    entry_to_delete.delete()
+    delete_entry(entry_to_delete)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("method, url, json, expected_calls", [
+    ("get", "/get_results/12345", None, ["find_patient"]),
+    ("get", "/get_results/56451897", None, ["find_patient"]),
+    ("get", "/get_results/dog", None, []),
+    ("post", "/add_test", {"id": 12345, "test_name": "HDL",
+                           "test_result": 50}, ["add_test"]),
+])
+def test_database_calls_per_route(method, url, json, expected_calls,
+                                  monkeypatch):
+    import health_db_server
+    from health_db_server import app
+    from health_db_server import add_database_entry
+    from health_db_server import patient_cache
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    monkeypatch.setattr(patient_cache, "max_size", 0)
+    patient_cache.clear()
+    counter = StorageCallCounter(health_db_server.storage)
+    monkeypatch.setattr(health_db_server, "storage", counter)
+    client = app.test_client()
+    getattr(client, method)(url, json=json)
+    monkeypatch.undo()
+    delete_entry(entry_to_delete)
+    assert counter.calls == expected_calls
+
+
+@pytest.mark.parametrize("query_args, expected", [
+    ({}, (None, 200)),
+    ({"limit": "2"}, ({"limit": 2, "offset": 0, "newest_first": False,
+                       "test_name": None}, 200)),
+    ({"offset": "1", "order": "newest", "test_name": "HDL"},
+     ({"limit": None, "offset": 1, "newest_first": True,
+       "test_name": "HDL"}, 200)),
+    ({"limit": "0"}, ("limit must be a positive integer", 400)),
+    ({"offset": "dog"}, ("offset must be a non-negative integer", 400)),
+    ({"order": "sideways"}, ("order must be oldest or newest", 400))
+])
+def test_parse_results_query(query_args, expected):
+    from health_db_server import parse_results_query
+    answer = parse_results_query(query_args)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("results_query, expected", [
+    ({}, [["HDL", 50], ["LDL", 80], ["HDL", 60], ["HDL", 70]]),
+    ({"limit": 2}, [["HDL", 50], ["LDL", 80]]),
+    ({"offset": 3}, [["HDL", 70]]),
+    ({"newest_first": True, "limit": 1}, [["HDL", 70]]),
+    ({"test_name": "HDL", "offset": 1}, [["HDL", 60], ["HDL", 70]]),
+    ({"test_name": "HDL", "newest_first": True, "offset": 1, "limit": 1},
+     [["HDL", 60]]),
+])
+def test_find_patient_tests(results_query, expected):
+    from health_db_server import find_patient_tests
+    from health_db_server import add_database_entry
+    from health_db_server import add_test_results
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    add_test_results([{"id": 12345, "test_name": name, "test_result": result}
+                      for name, result in [("HDL", 50), ("LDL", 80),
+                                           ("HDL", 60), ("HDL", 70)]])
+    answer = find_patient_tests(12345, **results_query)
+    delete_entry(entry_to_delete)
+    assert answer.name == "David Testing"
+    assert answer.tests == expected
+
+
+def test_find_patient_tests_missing():
+    from health_db_server import find_patient_tests
+    answer = find_patient_tests(56451897, limit=2)
+    assert answer is False
+
+
+def test_format_test_line():
+    from health_db_server import format_test_line
+    answer = format_test_line(["HDL", 50])
+    assert answer == '{"test_name": "HDL", "test_result": 50}\n'
+
+
+@pytest.mark.parametrize("url, headers, tests_to_add, expected", [
+    ("/get_results/12345?format=ndjson", {}, [("HDL", 50), ("LDL", 80)],
+     '{"test_name": "HDL", "test_result": 50}\n'
+     '{"test_name": "LDL", "test_result": 80}\n'),
+    ("/get_results/12345?order=newest&limit=1",
+     {"Accept": "application/x-ndjson"}, [("HDL", 50), ("LDL", 80)],
+     '{"test_name": "LDL", "test_result": 80}\n'),
+    ("/get_results/12345?format=ndjson", {}, [], ""),
+])
+def test_stream_results(url, headers, tests_to_add, expected):
+    from health_db_server import app
+    from health_db_server import add_database_entry
+    from health_db_server import add_test_result
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    for name, result in tests_to_add:
+        add_test_result({"id": 12345, "test_name": name,
+                         "test_result": result})
+    r = app.test_client().get(url, headers=headers)
+    answer = r.get_data(as_text=True)
+    delete_entry(entry_to_delete)
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
     assert answer == expected
 
 
+def test_stream_results_missing():
+    from health_db_server import app
+    r = app.test_client().get("/get_results/56451897?format=ndjson")
+    assert r.status_code == 400
+
+
+def test_ready():
+    from health_db_server import app
+    r = app.test_client().get("/ready")
+    answer = r.get_json()
+    assert r.status_code == 200
+    assert answer["ready"] is True
+    assert answer["database"] == "reachable"
+    assert answer["pool"]["max_size"] == 1
+
+
+def test_ready_unreachable(monkeypatch):
+    import health_db_server
+    from health_db_server import app
+
+    def failing_ping():
+        raise ConnectionError("no database")
+
+    monkeypatch.setattr(health_db_server.storage, "ping", failing_ping)
+    r = app.test_client().get("/ready")
+    answer = r.get_json()
+    assert r.status_code == 503
+    assert answer["ready"] is False
+    assert answer["database"] == "unreachable"
+
+
+@pytest.mark.parametrize("settings, expected", [
+    (None, "initialize_server"),
+    ({"backend": "memory"}, "reconnect_after_fork")])
+def test_ensure_storage(monkeypatch, settings, expected):
+    import health_db_server
+    calls = []
+    monkeypatch.setattr(health_db_server, "storage_settings", settings)
+    monkeypatch.setattr(health_db_server, "storage_pid", -1)
+    for name in ("initialize_server", "reconnect_after_fork"):
+        monkeypatch.setattr(health_db_server, name,
+                            lambda name=name: calls.append(name))
+    health_db_server.ensure_storage()
+    assert calls == [expected]
+    monkeypatch.setattr(health_db_server, "storage_pid", os.getpid())
+    health_db_server.ensure_storage()
+    assert calls == [expected]
+
+
+def test_metrics():
+    from health_db_server import app
+    client = app.test_client()
+    client.get("/get_results/56451897")
+    r = client.get("/metrics")
+    answer = r.get_data(as_text=True)
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    assert ('health_db_requests_total{route="/get_results/<patient_id>",'
+            'method="GET",status="400"}') in answer
+    assert ('health_db_request_duration_seconds_count{route='
+            '"/get_results/<patient_id>",method="GET"}') in answer
+    assert ('health_db_function_duration_seconds_count{function='
+            '"find_patient"}') in answer
+
+
+@pytest.mark.parametrize("in_data, max_pending, expected_status", [
+    ({"id": 12345, "test_name": "HDL", "test_result": 50}, 10, 202),
+    ({"id": 56451897, "test_name": "HDL", "test_result": 50}, 10, 400),
+    ({"id": 12345, "test_name": "HDL", "test_result": 50}, 0, 503)
+])
+def test_add_test_write_behind(in_data, max_pending, expected_status,
+                               monkeypatch):
+    import health_db_server
+    from health_db_server import app
+    from health_db_server import add_database_entry
+    from health_db_server import flush_test_results
+    from health_db_server import find_patient
+    from health_db_write_behind import WriteBehindQueue
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    queue = WriteBehindQueue(flush_test_results, window=60,
+                             max_pending=max_pending)
+    monkeypatch.setattr(health_db_server, "write_behind", queue)
+    r = app.test_client().post("/add_test", json=in_data)
+    queue.close()
+    answer = find_patient(12345)
+    delete_entry(entry_to_delete)
+    assert r.status_code == expected_status
+    if expected_status == 202:
+        assert answer.tests == [["HDL", 50]]
+    else:
+        assert answer.tests == []
+
+
+@pytest.mark.parametrize("query_args, expected", [
+    ({}, ({"test_name": None, "minimum": None, "maximum": None}, 200)),
+    ({"test_name": "HDL", "min_result": "40", "max_result": "60"},
+     ({"test_name": "HDL", "minimum": 40, "maximum": 60}, 200)),
+    ({"min_result": "dog"}, ("min_result must be an integer", 400)),
+    ({"min_result": "60", "max_result": "40"},
+     ("min_result must not be larger than max_result", 400))
+])
+def test_parse_statistics_query(query_args, expected):
+    from health_db_server import parse_statistics_query
+    answer = parse_statistics_query(query_args)
+    assert answer == expected
+
+
+def test_statistics_routes():
+    from health_db_server import app
+    from health_db_server import add_database_entry
+    from health_db_server import add_test_results
+    entries = [add_database_entry("David Testing", 12345, "O+"),
+               add_database_entry("Ann Testing", 12346, "O+"),
+               add_database_entry("Bob Testing", 12347, "A-")]
+    add_test_results([{"id": 12345, "test_name": "HDL", "test_result": 40},
+                      {"id": 12346, "test_name": "HDL", "test_result": 60},
+                      {"id": 12346, "test_name": "LDL", "test_result": 100},
+                      {"id": 12347, "test_name": "HDL", "test_result": 80}])
+    client = app.test_client()
+    blood_types = client.get("/stats/blood_types").get_json()
+    all_tests = client.get("/stats/tests").get_json()
+    filtered = client.get("/stats/tests?test_name=HDL&max_result=60")
+    for entry in entries:
+        delete_entry(entry)
+    assert blood_types == {"A-": 1, "O+": 2}
+    assert all_tests == [{"test_name": "HDL", "count": 3, "min": 40,
+                          "max": 80, "mean": 60},
+                         {"test_name": "LDL", "count": 1, "min": 100,
+                          "max": 100, "mean": 100}]
+    assert filtered.get_json() == [{"test_name": "HDL", "count": 2,
+                                    "min": 40, "max": 60, "mean": 50}]
+
+
+@pytest.mark.parametrize("url, headers, expected_status, expected", [
+    ("/get_results/12345?format=json", {}, 200,
+     {"name": "David Testing", "id": 12345, "blood_type": "O+",
+      "tests": [["HDL", 50]]}),
+    ("/get_results/12345", {"Accept": "application/json"}, 200,
+     {"name": "David Testing", "id": 12345, "blood_type": "O+",
+      "tests": [["HDL", 50]]}),
+    ("/get_results/56451897?format=json", {}, 400,
+     {"error": "Patient id of 56451897 does not exist in database"}),
+    ("/get_results/12345?format=json&limit=0", {}, 400,
+     {"error": "limit must be a positive integer"})
+])
+def test_get_results_json(url, headers, expected_status, expected):
+    from health_db_server import app
+    from health_db_server import add_database_entry
+    from health_db_server import add_test_result
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    add_test_result({"id": 12345, "test_name": "HDL", "test_result": 50})
+    r = app.test_client().get(url, headers=headers)
+    delete_entry(entry_to_delete)
+    assert r.status_code == expected_status
+    assert r.mimetype == "application/json"
+    assert r.get_json() == expected
+
+
+def test_post_routes_msgpack():
+    import msgpack
+    from health_db_server import app
+    from health_db_server import find_patient
+    client = app.test_client()
+    headers = {"Accept": "application/msgpack"}
+    r1 = client.post("/new_patient", headers=headers,
+                     json={"name": "David Testing", "id": 12345,
+                           "blood_type": "O+"})
+    r2 = client.post("/add_test", headers=headers,
+                     json={"id": 12345, "test_name": "HDL",
+                           "test_result": 50})
+    r3 = client.post("/add_test", headers=headers,
+                     json={"id": 12345, "test_name": "HDL"})
+    delete_entry(find_patient(12345))
+    assert r1.mimetype == "application/msgpack"
+    assert msgpack.unpackb(r1.data) == {"name": "David Testing",
+                                        "id": 12345, "blood_type": "O+"}
+    assert msgpack.unpackb(r2.data) == {"id": 12345, "test_name": "HDL",
+                                        "test_result": 50, "status": "added"}
+    assert r3.status_code == 400
+    assert msgpack.unpackb(r3.data) == {
+        "error": "The key test_result is missing from input"}
+
+
+def test_new_patient_any_blood_type():
+    from health_db_server import app
+    from health_db_server import find_patient
+    r = app.test_client().post("/new_patient",
+                               json={"name": "David Testing", "id": 12345,
+                                     "blood_type": "-"})
+    delete_entry(find_patient(12345))
+    assert r.status_code == 200
+
+
+def test_get_results_not_modified(monkeypatch):
+    import health_db_server
+    from health_db_server import app
+    from health_db_server import add_database_entry
+    from health_db_server import add_test_result
+    entry_to_delete = add_database_entry("David Testing", 12345, "O+")
+    add_test_result({"id": 12345, "test_name": "HDL", "test_result": 50})
+    client = app.test_client()
+    r1 = client.get("/get_results/12345")
+    etag = r1.headers["ETag"]
+    counter = StorageCallCounter(health_db_server.storage)
+    monkeypatch.setattr(health_db_server, "storage", counter)
+    r2 = client.get("/get_results/12345", headers={"If-None-Match": etag})
+    monkeypatch.undo()
+    r3 = client.get("/get_results/12345?format=json",
+                    headers={"If-None-Match": etag})
+    add_test_result({"id": 12345, "test_name": "LDL", "test_result": 80})
+    r4 = client.get("/get_results/12345", headers={"If-None-Match": etag})
+    delete_entry(entry_to_delete)
+    assert r1.status_code == 200
+    assert r1.headers["Cache-Control"] == "no-cache"
+    assert r2.status_code == 304
+    assert r2.data == b""
+    assert r2.headers["ETag"] == etag
+    assert counter.calls == ["patient_version"]
+    assert r3.status_code == 200
+    assert r3.headers["ETag"] != etag
+    assert r4.status_code == 200
+    assert r4.headers["ETag"] != etag
+    assert "LDL" in r4.get_data(as_text=True)
+
+
+def test_results_etag():
+    from health_db_server import results_etag
+    etag = results_etag(12345, 7, "text")
+    assert etag.startswith('"12345-7-')
+    assert results_etag(12345, 8, "text") != etag
+    assert results_etag(12345, 7, "text", b"limit=2") != etag
+    assert results_etag(12345, None, "json") == results_etag(12345, 0, "json")
+
 
+def test_admission_busy(monkeypatch):
+    import health_db_server
+    from health_db_admission import AdmissionLimiter
+    from health_db_server import app
+    limiter = AdmissionLimiter(1, max_waiting=0)
+    limiter.acquire()
+    monkeypatch.setitem(health_db_server.admission_limiters, "read", limiter)
+    client = app.test_client()
+    r1 = client.get("/get_results/56451897")
+    r2 = client.post("/add_test", json={"id": 56451897, "test_name": "HDL",
+                                        "test_result": 50})
+    r3 = client.get("/ready")
+    limiter.release()
+    r4 = client.get("/get_results/56451897")
+    r5 = client.get("/metrics")
+    assert r1.status_code == 503
+    assert r1.headers["Retry-After"] == "1"
+    assert r2.status_code == 400
+    assert r3.get_json()["admission"]["read"]["active"] == 1
+    assert r4.status_code == 400
+    assert limiter.stats()["active"] == 0
+    assert ('health_db_requests_rejected_total{group="read"} 1'
+            in r5.get_data(as_text=True))
@@ -0,0 +1,58 @@
+import json
+
+
+def test_spool_delivers(server_url, tmp_path):
+    import health_db_server
+    from health_db_client import HealthDbClient
+    from health_db_spool import WriteSpool
+    folder = tmp_path / "spool"
+    with HealthDbClient(server_url) as client:
+        spool = WriteSpool(client, str(folder))
+        spool.add_patient("Ann Ables", 1, "A+")
+        spool.add_test(1, "HDL", 50)
+        spool.add_test(2, "HDL", 60)
+        spool.add_test(1, "LDL", 80)
+        answer = spool.close()
+    assert answer is True
+    assert spool.stats()["delivered"] == 4
+    assert spool.stats()["rejected"] == 1
+    assert health_db_server.storage.find_patient(1).tests == [
+        ["HDL", 50], ["LDL", 80]]
+    rejected = json.loads((folder / "rejected.ndjson").read_text())
+    assert rejected["data"]["id"] == 2
+    assert (folder / "journal.ndjson").read_text() == ""
+
+
+def test_spool_keeps_writes_while_server_down(server_url, tmp_path):
+    import health_db_server
+    from health_db_client import HealthDbClient
+    from health_db_spool import WriteSpool
+    folder = str(tmp_path / "spool")
+    with HealthDbClient("http://127.0.0.1:1", retries=0) as client:
+        spool = WriteSpool(client, folder, retry_delay=0.01)
+        spool.add_patient("Ann Ables", 1, "A+")
+        answer1 = spool.close(timeout=0.1)
+    assert spool.stats()["last_error"] is not None
+    with HealthDbClient(server_url) as client:
+        spool = WriteSpool(client, folder)
+        answer2 = spool.close()
+    assert answer1 is False
+    assert answer2 is True
+    assert health_db_server.storage.find_patient(1).name == "Ann Ables"
+
+
+def test_spool_repairs_journal(tmp_path):
+    from health_db_client import HealthDbClient
+    from health_db_spool import WriteSpool
+    folder = tmp_path / "spool"
+    folder.mkdir()
+    line = json.dumps({"route": "/add_test",
+                       "data": {"id": 1, "test_name": "HDL",
+                                "test_result": 50}}) + "\n"
+    (folder / "journal.ndjson").write_text(line + '{"route": "/ad')
+    (folder / "journal.offset").write_text("1000")
+    with HealthDbClient("http://127.0.0.1:1", retries=0) as client:
+        spool = WriteSpool(client, str(folder), retry_delay=0.01)
+        spool.close(timeout=0)
+    assert (folder / "journal.ndjson").read_text() == line
+    assert spool.offset == 0
@@ -0,0 +1,188 @@
+import pytest
+
+
+def make_storage():
+    from health_db_storage import create_storage
+    storage = create_storage("memory")
+    storage.add_patient("David Testing", 12345, "O+")
+    return storage
+
+
+def test_create_storage_unknown():
+    from health_db_storage import create_storage
+    with pytest.raises(ValueError):
+        create_storage("paper")
+
+
+def test_sqlite_add_patient_replaces():
+    storage = make_storage()
+    storage.add_test(12345, "HDL", 50)
+    storage.add_patient("New Name", 12345, "A-")
+    answer = storage.find_patient(12345)
+    assert answer.name == "New Name"
+    assert answer.blood_type == "A-"
+    assert answer.tests == []
+
+
+def test_sqlite_add_patients():
+    storage = make_storage()
+    patient_list = [{"name": "One", "id": 1, "blood_type": "A+"},
+                    {"name": "Repeat", "id": 12345, "blood_type": "B+"},
+                    {"name": "Two", "id": 1, "blood_type": "O-"}]
+    answer = storage.add_patients(patient_list)
+    assert answer == [1, 2]
+    assert storage.find_patient(1).name == "One"
+
+
+@pytest.mark.parametrize("id_no, expected", [
+    (12345, True),
+    (1, False)
+])
+def test_sqlite_add_test(id_no, expected):
+    storage = make_storage()
+    answer = storage.add_test(id_no, "HDL", 50)
+    assert answer is expected
+
+
+def test_sqlite_add_tests():
+    storage = make_storage()
+    answer = storage.add_tests({12345: [("HDL", 50), ("LDL", 80)],
+                                1: [("HDL", 60)]})
+    assert answer == [1]
+    assert storage.find_patient(12345).tests == [["HDL", 50], ["LDL", 80]]
+
+
+@pytest.mark.parametrize("results_query, expected", [
+    ({}, list(range(7))),
+    ({"limit": 3, "offset": 2}, [2, 3, 4]),
+    ({"newest_first": True, "offset": 1}, [5, 4, 3, 2, 1, 0]),
+    ({"test_name": "odd"}, [1, 3, 5]),
+    ({"test_name": "even", "newest_first": True, "limit": 2}, [6, 4]),
+])
+def test_sqlite_iter_tests(results_query, expected):
+    storage = make_storage()
+    for result in range(7):
+        name = "even" if result % 2 == 0 else "odd"
+        storage.add_test(12345, name, result)
+    tests = storage.iter_tests(12345, batch_size=2, **results_query)
+    answer = [result for name, result in tests]
+    assert answer == expected
+
+
+def test_sqlite_iter_tests_missing():
+    storage = make_storage()
+    answer = storage.iter_tests(1)
+    assert answer is False
+
+
+def test_sqlite_delete_patient():
+    storage = make_storage()
+    storage.add_test(12345, "HDL", 50)
+    storage.delete_patient(12345)
+    assert storage.find_patient(12345) is False
+    storage.add_patient("David Testing", 12345, "O+")
+    assert storage.find_patient(12345).tests == []
+
+
+def test_pool_counter_stats():
+    from health_db_storage import PoolCounter
+    counter = PoolCounter(max_size=10)
+    for i in range(3):
+        counter.connection_created(None)
+    counter.connection_closed(None)
+    counter.connection_checked_out(None)
+    counter.connection_checked_out(None)
+    counter.connection_checked_in(None)
+    answer = counter.stats()
+    assert answer == {"in_use": 1, "open": 2, "available": 1, "max_size": 10}
+
+
+def test_sqlite_ping():
+    storage = make_storage()
+    assert storage.ping() is None
+    assert storage.pool_stats()["in_use"] == 0
+
+
+@pytest.mark.parametrize("number_of_tests, written, expected", [
+    (1, set(), [(2, 1, "batch:12345:0")]),
+    (3, set(), [(0, 3, "batch:12345:0")]),
+    (5, set(), [(0, 3, "batch:12345:0"), (1, 2, "batch:12345:1")]),
+    (5, {"batch:12345:0"}, [(1, 2, "batch:12345:1")])
+])
+def test_bucket_updates(number_of_tests, written, expected, monkeypatch):
+    import health_db_storage
+    from health_db_storage import bucket_updates
+    monkeypatch.setattr(health_db_storage, "BUCKET_SIZE", 3)
+    tests = [("HDL", result) for result in range(number_of_tests)]
+    answer = bucket_updates(12345, tests, "now", "batch", written)
+    closes, pushes = answer[0::2], answer[1::2]
+    assert [(query["count"]["$gt"], update, upsert)
+            for query, update, upsert in closes] == \
+        [(room, {"$set": {"open": False}}, False)
+         for room, count, group_name in expected]
+    assert [(query["count"]["$lte"], update["$inc"]["count"],
+             update["$addToSet"]["groups"], upsert)
+            for query, update, upsert in pushes] == \
+        [(room, count, group_name, True)
+         for room, count, group_name in expected]
+
+
+def test_requests_to_resend():
+    import pymongo.errors
+    from health_db_storage import requests_to_resend
+    requests = list(range(6))
+    err = pymongo.errors.BulkWriteError(
+        {"writeErrors": [{"index": 3, "code": 11000}]})
+    assert requests_to_resend(requests, err) == [2, 3, 4, 5]
+    err = pymongo.errors.BulkWriteError(
+        {"writeErrors": [{"index": 3, "code": 121}]})
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        requests_to_resend(requests, err)
+
+
+@pytest.mark.parametrize("results_query, expected", [
+    ({}, [{"$match": {"patient_id": 1}},
+          {"$sort": {"number": 1}},
+          {"$project": {"_id": 0, "tests": 1}},
+          {"$unwind": "$tests"}]),
+    ({"limit": 2, "offset": 1, "newest_first": True, "test_name": "HDL"},
+     [{"$match": {"patient_id": 1}},
+      {"$sort": {"number": -1}},
+      {"$project": {"_id": 0, "tests": {"$reverseArray": "$tests"}}},
+      {"$unwind": "$tests"},
+      {"$match": {"tests.0": "HDL"}},
+      {"$skip": 1},
+      {"$limit": 2}])
+])
+def test_bucket_tests_pipeline(results_query, expected):
+    from health_db_storage import bucket_tests_pipeline
+    answer = bucket_tests_pipeline(1, **results_query)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("test_name, minimum, maximum, expected", [
+    (None, None, None, [{"$unwind": "$tests"}]),
+    ("HDL", None, 60, [{"$match": {"names": "HDL"}},
+                       {"$unwind": "$tests"},
+                       {"$match": {"name": "HDL",
+                                   "result": {"$lte": 60}}}]),
+    (None, 40, 60, [{"$unwind": "$tests"},
+                    {"$match": {"result": {"$gte": 40, "$lte": 60}}}])
+])
+def test_summarize_tests_pipeline(test_name, minimum, maximum, expected):
+    from health_db_storage import summarize_tests_pipeline
+    answer = summarize_tests_pipeline(test_name, minimum, maximum)
+    assert [stage for stage in answer
+            if "$project" not in stage and "$group" not in stage
+            and "$sort" not in stage] == expected
+    assert "$group" in answer[-2]
+
+
+def test_sqlite_patient_version():
+    storage = make_storage()
+    first = storage.patient_version(12345)
+    storage.add_test(12345, "HDL", 50)
+    storage.add_tests({12345: [("HDL", 60), ("LDL", 80)]})
+    assert storage.patient_version(12345) == first + 2
+    assert storage.find_patient(12345).version == first + 2
+    assert storage.patient_version(1) is False
@@ -0,0 +1,60 @@
+import pytest
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ({"name": "Test Name", "id": 1, "blood_type": "O+"}, (True, 200)),
+    ({"name": "Test Name", "id": 1}, (True, 200)),
+    ({"name": "Test Name", "id": 1, "blood_type": "Q"},
+     ("The key blood_type must be one of A+, O+", 400)),
+    ({"name": "Test Name", "id": 0},
+     ("The key id must be at least 1", 400)),
+    ({"id": 1}, ("The key name is missing from input", 400)),
+    ({"name": 2, "id": 1}, ("The key name has the wrong data type", 400)),
+    (["name"], ("The input was not a dictionary.", 400))
+])
+def test_compile_schema_field(in_data, expected):
+    from health_db_validation import compile_schema, Field
+    schema = {"name": str, "id": Field(int, minimum=1),
+              "blood_type": Field(str, required=False, choices=("A+", "O+"))}
+    validate = compile_schema(schema)
+    answer = validate(in_data)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ([{"id": 1, "tests": [1, 2]}], (True, 200)),
+    ([], (True, 200)),
+    ({"id": 1}, ("The input was not a list.", 400)),
+    ([{"id": 1, "tests": [1, "2"]}],
+     ("Entry 0 of the input: Entry 1 of key tests: "
+      "The value has the wrong data type", 400)),
+    ([{"id": 1, "tests": [1]}, {"id": 2, "tests": 3}],
+     ("Entry 1 of the input: The key tests was not a list", 400)),
+    ([{"id": 1, "tests": []}] * 3,
+     ("The input has more than 2 entries", 400))
+])
+def test_compile_schema_list(in_data, expected):
+    from health_db_validation import compile_schema, ListOf
+    schema = ListOf({"id": int, "tests": ListOf(int)}, max_length=2)
+    validate = compile_schema(schema)
+    answer = validate(in_data)
+    assert answer == expected
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ({"patient": {"id": 1}}, (True, 200)),
+    ({"patient": 1}, ("The key patient was not a dictionary", 400)),
+    ({"patient": {}}, ("The key id is missing from input", 400))
+])
+def test_compile_schema_nested(in_data, expected):
+    from health_db_validation import compile_schema
+    validate = compile_schema({"patient": {"id": int}})
+    answer = validate(in_data)
+    assert answer == expected
+
+
+def test_compile_schema_cached():
+    from health_db_validation import compile_schema
+    first = compile_schema({"name": str, "id": int})
+    second = compile_schema({"name": str, "id": int})
+    assert first is second
@@ -0,0 +1,111 @@
+import pytest
+
+
+class FlushRecorder:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.batch_ids = []
+        self.fail = fail
+
+    def __call__(self, grouped, batch_id):
+        self.batch_ids.append(batch_id)
+        if self.fail:
+            raise ConnectionError("no database")
+        self.calls.append(grouped)
+
+
+def test_write_behind_coalesces():
+    from health_db_write_behind import WriteBehindQueue
+    recorder = FlushRecorder()
+    queue = WriteBehindQueue(recorder, window=60)
+    queue.submit(1, "HDL", 50)
+    queue.submit(2, "LDL", 80)
+    queue.submit(1, "HDL", 55)
+    answer = queue.flush()
+    queue.close()
+    assert answer == 3
+    assert recorder.calls == [{1: [("HDL", 50), ("HDL", 55)],
+                               2: [("LDL", 80)]}]
+
+
+def test_write_behind_background_flush():
+    import time
+    from health_db_write_behind import WriteBehindQueue
+    recorder = FlushRecorder()
+    queue = WriteBehindQueue(recorder, window=0.01)
+    queue.submit(1, "HDL", 50)
+    for i in range(200):
+        if queue.stats()["flushed"] == 1:
+            break
+        time.sleep(0.01)
+    queue.close()
+    assert recorder.calls == [{1: [("HDL", 50)]}]
+
+
+def test_write_behind_full():
+    from health_db_write_behind import WriteBehindQueue
+    queue = WriteBehindQueue(FlushRecorder(), window=60, max_pending=2)
+    answer = [queue.submit(1, "HDL", result) for result in range(3)]
+    stats = queue.stats()
+    queue.close()
+    assert answer == [True, True, False]
+    assert stats == {"pending": 2, "max_pending": 2, "flushed": 0,
+                     "rejected": 1, "dropped": 0, "failures": 0}
+
+
+def test_write_behind_close_flushes():
+    from health_db_write_behind import WriteBehindQueue
+    recorder = FlushRecorder()
+    queue = WriteBehindQueue(recorder, window=60)
+    queue.submit(1, "HDL", 50)
+    queue.close()
+    assert recorder.calls == [{1: [("HDL", 50)]}]
+    with pytest.raises(RuntimeError):
+        queue.submit(1, "HDL", 50)
+
+
+def test_write_behind_failed_flush_keeps_tests():
+    from health_db_write_behind import WriteBehindQueue
+    recorder = FlushRecorder(fail=True)
+    queue = WriteBehindQueue(recorder, window=60)
+    queue.submit(1, "HDL", 50)
+    assert queue.flush() == 0
+    queue.submit(1, "HDL", 55)
+    assert queue.stats()["pending"] == 2
+    recorder.fail = False
+    queue.close()
+    assert recorder.calls == [{1: [("HDL", 50)]}, {1: [("HDL", 55)]}]
+    assert recorder.batch_ids[0] == recorder.batch_ids[1]
+    assert recorder.batch_ids[1] != recorder.batch_ids[2]
+
+
+def test_write_behind_retry_delay_grows():
+    from health_db_write_behind import WriteBehindQueue
+    queue = WriteBehindQueue(FlushRecorder(fail=True), window=60,
+                             retry_delay=0.5, max_retry_delay=3)
+    queue.submit(1, "HDL", 50)
+    delays = []
+    for i in range(4):
+        queue.flush()
+        delays.append(queue.next_retry_delay())
+    queue.close(retries=0)
+    assert delays == [0.5, 1, 2, 3]
+
+
+def test_write_behind_close_drops_unsaved(tmp_path):
+    import json
+    from health_db_write_behind import WriteBehindQueue
+    dead_letter_path = tmp_path / "dropped.ndjson"
+    queue = WriteBehindQueue(FlushRecorder(fail=True), window=60,
+                             retry_delay=0.001,
+                             dead_letter_path=str(dead_letter_path))
+    queue.submit(1, "HDL", 50)
+    queue.submit(2, "LDL", 80)
+    answer = queue.close(retries=2)
+    lines = dead_letter_path.read_text().splitlines()
+    assert answer == 2
+    assert queue.stats()["dropped"] == 2
+    assert queue.stats()["failures"] == 3
+    assert [json.loads(line) for line in lines] == [
+        {"id": 1, "test_name": "HDL", "test_result": 50},
+        {"id": 2, "test_name": "LDL", "test_result": 80}]